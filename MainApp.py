@@ -22,18 +22,181 @@ from PyQt6.QtWidgets import (
     QGraphicsScene,
     QGraphicsPixmapItem,
 )
-from PyQt6.QtGui import QPixmap, QPainter
-from PyQt6.QtCore import Qt, QTimer, QRectF
+from PyQt6.QtGui import QPixmap, QPainter, QImage
+from PyQt6.QtCore import (
+    Qt,
+    QTimer,
+    QRectF,
+    QObject,
+    QRunnable,
+    QThreadPool,
+    pyqtSignal,
+)
 import qdarkstyle
 import os
-import shutil
+import cv2 as cv
+import numpy as np
 
 import main_p2_origin as p2
 import main_p3_starnet as p3
+import pipeline
+from cache import StageCache
+from catalog import THRESHOLD_MIN
+from fits_loader import LazyFits
 
 FOLDER_EXAMPLES = "./examples"
 FOLDER_STARNET = "./star_reduction"
 
+# size in pixels of the previews (longest side)
+PREVIEW_SIZE = 500
+VIEW_SIZE = 650
+
+
+def array_to_qimage(image, size=PREVIEW_SIZE):
+    """
+    Convert an image (float32 array) to a QImage without writing a PNG file
+
+    the image is first reduced at the preview resolution, then stretched between
+    its min and max in uint8 (like plt.imsave) : the stretch is only done on the
+    small image.
+    The QImage use directly the buffer of the uint8 array (no copy),
+    so the array is kept as attribute of the QImage.
+
+    :param image: grey (height, width) or RGB (height, width, 3) image
+    :param size: longest side of the preview in pixels
+    :return: QImage
+    """
+    h, w = image.shape[:2]
+    scale = min(1.0, size / max(h, w))
+    if scale < 1.0:
+        image = cv.resize(
+            image,
+            (max(1, round(w * scale)), max(1, round(h * scale))),
+            interpolation=cv.INTER_AREA,
+        )
+
+    # stretch in [0, 255] at the preview resolution
+    lo = float(image.min())
+    hi = float(image.max())
+    gain = 255.0 / (hi - lo) if hi > lo else 0.0
+    display = np.ascontiguousarray(
+        np.clip((image - lo) * gain, 0, 255).astype(np.uint8)
+    )
+
+    h, w = display.shape[:2]
+    if display.ndim == 3:
+        fmt = QImage.Format.Format_RGB888
+    else:
+        fmt = QImage.Format.Format_Grayscale8
+    qimage = QImage(display.data, w, h, display.strides[0], fmt)
+    # keep the buffer alive as long as the QImage
+    qimage.buffer = display
+    return qimage
+
+
+def array_to_pixmap(image, size=PREVIEW_SIZE):
+    """
+    Convert an image (float32 array) to a QPixmap for the ZoomView
+
+    :param image: grey or RGB image
+    :param size: longest side of the preview in pixels
+    :return: QPixmap
+    """
+    return QPixmap.fromImage(array_to_qimage(image, size))
+
+
+def load_standard_thumbnail(cache, fits_path):
+    """
+    Load a FITS file in the cache of the stages (see pipeline.load_standard)
+    and prepare its preview, called in a thread of the pool
+
+    :param cache: the cache of the stages
+    :param fits_path: the FITS file's path
+    :return: dict with the QImage of the normalized image
+    """
+    _, image, _ = pipeline.load_standard(cache, fits_path)
+    return {"original": array_to_qimage(image)}
+
+
+def load_starnet_thumbnails(cache, starless_path, staronly_path):
+    """
+    Load the StarNet files in the cache of the stages (see pipeline.load_starnet)
+    and prepare their previews, called in a thread of the pool
+
+    :param cache: the cache of the stages
+    :param starless_path: the starless FITS file's path
+    :param staronly_path: the staronly FITS file's path
+    :return: dict with the QImages of the starless and staronly images
+    """
+    *_, (starless, staronly) = pipeline.load_starnet(
+        cache, starless_path, staronly_path
+    )
+    return {
+        "starless": array_to_qimage(starless),
+        "staronly": array_to_qimage(staronly),
+    }
+
+
+def fits_tooltip(path):
+    """
+    Describe a FITS file with its header only (no pixels read)
+
+    :param path: the file's path
+    :return: text with the size and the type of the image
+    """
+    try:
+        lazy = LazyFits(path)
+        h, w = lazy.image_shape
+        color = "color" if lazy.layout != "mono" else "mono"
+        return f"{w} x {h} {color}, BITPIX {lazy.header.get('BITPIX')}"
+    except OSError:
+        return "Not a FITS file"
+
+
+class WorkerSignals(QObject):
+    """
+    Signals of the PipelineWorker (a QRunnable can't emit signals itself)
+    """
+
+    finished = pyqtSignal(int, object)
+    failed = pyqtSignal(int, str)
+
+
+class PipelineWorker(QRunnable):
+    """
+    This class run a function of the pipeline in a thread of a QThreadPool
+    so the GUI is never blocked during the calculation
+    """
+
+    def __init__(self, generation, signals, is_current, fn, *args):
+        """Initialize the worker
+        :param generation: generation number of the request
+        :param signals: WorkerSignals used to send the result to the GUI thread
+        :param is_current: function which return if the generation is still the last one
+        :param fn: function of the pipeline
+        :param args: arguments of the function"""
+        super().__init__()
+        self.generation = generation
+        self.signals = signals
+        self.is_current = is_current
+        self.fn = fn
+        self.args = args
+
+    def run(self):
+        """Calculate the result and send it to the GUI thread"""
+        # a newer request arrived while this one was waiting : don't calculate
+        if not self.is_current(self.generation):
+            return
+        try:
+            result = self.fn(*self.args)
+            # the preview is also prepared here, the GUI only create the QPixmap
+            if result is not None and "final" in result:
+                result["preview"] = array_to_qimage(result["final"])
+        except Exception as error:
+            self.signals.failed.emit(self.generation, str(error))
+            return
+        self.signals.finished.emit(self.generation, result)
+
 
 class ZoomView(QGraphicsView):
     """
@@ -124,11 +287,48 @@ class StarReducApp(QMainWindow):
         self.before = None
         self.after = None
 
+        # arrays displayed in the right box (final, overlay, mask), no PNG files
+        self.views = {}
+
+        # cache of the pipeline's stages : a slider only recalculate the stages after it
+        self.cache = StageCache()
+
+        # the calculations are done in a thread : only one at a time,
+        # the requests waiting for an older generation are ignored
+        self.thread_pool = QThreadPool(self)
+        self.thread_pool.setMaxThreadCount(1)
+        self.generation = 0
+        self.on_result = None
+        self.worker_signals = WorkerSignals(self)
+        self.worker_signals.finished.connect(self.on_worker_finished)
+        self.worker_signals.failed.connect(self.on_worker_failed)
+        # the loads of files have their own generations : the calculation asked
+        # just after the click doesn't make the thumbnails old
+        self.load_generation = 0
+        self.on_load = None
+        self.load_signals = WorkerSignals(self)
+        self.load_signals.finished.connect(self.on_load_finished)
+        self.load_signals.failed.connect(self.on_load_failed)
+        # the catalog is lowered to the minimum of the threshold slider in a
+        # pool of its own : the previews and results don't wait for it
+        self.catalog_pool = QThreadPool(self)
+        self.catalog_pool.setMaxThreadCount(1)
+        self.catalog_request = None
+        self.catalog_signals = WorkerSignals(self)
+        self.catalog_signals.finished.connect(self.on_catalog_extended)
+        self.catalog_signals.failed.connect(self.on_catalog_failed)
+
         # timer anti-spam (debounce) in order to avoid too many calculations
         self.update_timer = QTimer(self)
         self.update_timer.setSingleShot(True)
         self.update_timer.timeout.connect(self.update_process_image_choice)
 
+        # quick preview on a reduced image while the sliders are moved,
+        # the full resolution is calculated when update_timer ends
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.timeout.connect(self.update_preview)
+
         # main layout for window
         main_widget = QWidget(self)
         self.setCentralWidget(main_widget)
@@ -208,8 +408,11 @@ class StarReducApp(QMainWindow):
         self.left_list.setFixedHeight(450)
 
         # infill list with files from folder example
+        # only the headers are read (size of the image in tooltip), not the pixels
         for nameFiles in os.listdir(FOLDER_EXAMPLES):
             self.left_list.addItem(nameFiles)
+            item = self.left_list.item(self.left_list.count() - 1)
+            item.setToolTip(fits_tooltip(os.path.join(FOLDER_EXAMPLES, nameFiles)))
 
         self.left_list.itemClicked.connect(self.on_item_clicked_choice)
 
@@ -303,7 +506,7 @@ class StarReducApp(QMainWindow):
         self.slider_threshold_label.setToolTip("The detection threshold")
         self.slider_threshold_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.slider_threshold = QSlider(Qt.Orientation.Horizontal)
-        self.slider_threshold.setMinimum(1)
+        self.slider_threshold.setMinimum(THRESHOLD_MIN)
         self.slider_threshold.setMaximum(20)
         self.slider_threshold.setValue(5)
         self.slider_threshold.setTickPosition(QSlider.TickPosition.TicksBelow)
@@ -315,6 +518,7 @@ class StarReducApp(QMainWindow):
         self.slider_threshold.valueChanged.connect(
             lambda v: (
                 self.value_label_slider_threshold.setText(str(v)),
+                self.update_nb_stars(),
                 self.schedule_update(),
             )
         )
@@ -391,6 +595,7 @@ class StarReducApp(QMainWindow):
         self.slider_netstar_threshold.valueChanged.connect(
             lambda v: (
                 self.value_label_slider_netstar_threshold.setText(str(v)),
+                self.update_nb_stars(),
                 self.schedule_update(),
             )
         )
@@ -444,6 +649,11 @@ class StarReducApp(QMainWindow):
         self.param_nb_stars.setReadOnly(True)
         right_form_layout.addRow("Number stars :", self.param_nb_stars)
 
+        # starnet model : pixels of the mask, given at once when the threshold move
+        self.param_nb_pixels = QLineEdit()
+        self.param_nb_pixels.setReadOnly(True)
+        right_form_layout.addRow("Masked pixels :", self.param_nb_pixels)
+
         # advanced buttons
         buttons_row1 = QHBoxLayout()
         buttons_row2 = QHBoxLayout()
@@ -529,21 +739,22 @@ class StarReducApp(QMainWindow):
 
         self.current_fits = fits_path
 
-        # Load fits
-        data, header = p2.load_fits(fits_path)
+        # Load fits (kept in cache for the process) in a thread,
+        # the original image is displayed by show_standard_thumbnail
+        self.start_load(
+            self.show_standard_thumbnail,
+            load_standard_thumbnail,
+            self.cache,
+            fits_path,
+        )
 
-        # Create original.png
-        p2.handler_color_image(data)
+    def show_standard_thumbnail(self, result):
+        """
+        Display the original image of the selected fits
 
-        # Update original Image
-        self.img_left.setPixmap(
-            QPixmap("results/original/original.png").scaled(
-                500,
-                500,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
-            )
-        )
+        :param result: dict returned by load_standard_thumbnail
+        """
+        self.img_left.setPixmap(QPixmap.fromImage(result["original"]))
 
     def on_item_clicked_starnet(self, item):
         """
@@ -559,47 +770,28 @@ class StarReducApp(QMainWindow):
             f"starless_{name}.fit"  # starless_starless_test_M31_linear.fit
         )
         image_name_staronly = f"starmask_{name}.fit"
-        image_png_name_starless = (
-            f"starless_{name}.png"  # starless_starless_test_M31_linear.png
-        )
-        image_png_name_staronly = f"starmask_{name}.png"
 
         self.current_fits_starless = os.path.join(FOLDER_STARNET, image_name_starless)
         self.current_fits_staronly = os.path.join(FOLDER_STARNET, image_name_staronly)
 
-        # Load starless and apply handler_color_image for normalization
-        data_starless, header_starless = p3.load_fits(
-            FOLDER_STARNET + "/" + image_name_starless
+        # Load (kept in cache for the process) in a thread, the thumbnails
+        # are displayed by show_starnet_thumbnails
+        self.start_load(
+            self.show_starnet_thumbnails,
+            load_starnet_thumbnails,
+            self.cache,
+            self.current_fits_starless,
+            self.current_fits_staronly,
         )
-        starless = p3.handler_color_image(data_starless)
 
-        # Load staronly and apply handler_color_image for normalization
-        data_staronly, header_staronly = p3.load_fits(
-            FOLDER_STARNET + "/" + image_name_staronly
-        )
-        staronly = p3.handler_color_image(data_staronly)
-
-        p3.save_image(FOLDER_STARNET + "/" + image_png_name_starless, starless)
-        p3.save_image(FOLDER_STARNET + "/" + image_png_name_staronly, staronly)
-
-        # Update original Image
-        self.img_left.setPixmap(
-            QPixmap(FOLDER_STARNET + "/" + image_png_name_staronly).scaled(
-                500,
-                500,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
-            )
-        )
+    def show_starnet_thumbnails(self, result):
+        """
+        Display the staronly and starless images of the selected fits
 
-        self.img_center.setPixmap(
-            QPixmap(FOLDER_STARNET + "/" + image_png_name_starless).scaled(
-                500,
-                500,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
-            )
-        )
+        :param result: dict returned by load_starnet_thumbnails
+        """
+        self.img_left.setPixmap(QPixmap.fromImage(result["staronly"]))
+        self.img_center.setPixmap(QPixmap.fromImage(result["starless"]))
 
     def on_item_clicked_choice(self, item):
         """
@@ -630,14 +822,49 @@ class StarReducApp(QMainWindow):
             if not self.current_fits_starless or not self.current_fits_staronly:
                 return
 
+        self.preview_timer.start(30)  # 30 ms
         self.update_timer.start(200)  # 200 ms
 
-    def update_process_image(self):
+    def update_nb_stars(self):
+        """
+        Display at once the number of stars of the threshold, without waiting
+        for the calculation (only if the catalog of the image contains the threshold)
+
+        with the starnet model, the number of masked pixels of the threshold
+        (only if the staronly image is already indexed)
+        """
+        if self.is_starnet_model():
+            if not self.current_fits_starless or not self.current_fits_staronly:
+                return
+            count = pipeline.cached_starnet_count(
+                self.cache,
+                self.current_fits_starless,
+                self.current_fits_staronly,
+                self.slider_netstar_threshold.value() / 100.0,
+            )
+            if count is not None:
+                self.param_nb_pixels.setText(str(count))
+            return
+        if not self.current_fits:
+            return
+        count = pipeline.cached_star_count(
+            self.cache,
+            self.current_fits,
+            self.slider_fwhm.value() / 10.0,
+            self.slider_threshold.value(),
+        )
+        if count is not None:
+            self.param_nb_stars.setText(str(count))
+
+    def update_process_image(self, preview=False):
         """
         Calculate all processus for create the final image with the standard model
 
-        Read sliders'values for use in parameters of the differents function
-        and display the final image in appropriate box
+        Read sliders'values for use in parameters of the differents function,
+        the calculation is done in a thread and the final image is displayed
+        in appropriate box by show_result_standard (show_preview_standard for a preview)
+
+        :param preview: if True, calculate quickly on a reduced image
         """
         if not self.current_fits:
             return
@@ -648,42 +875,118 @@ class StarReducApp(QMainWindow):
         erode_kernel = self.slider_erode_kernel.value()
         nb_iter = self.slider_nb_iteration.value()
 
-        # do processus starless
-        data, header = p2.load_fits(self.current_fits)
-        image = p2.handler_color_image(data)
-        image_gray = p2.convert_in_grey(image)
+        # do processus starless, only the stages with changed parameters are done
+        self.start_worker(
+            self.show_preview_standard if preview else self.show_result_standard,
+            pipeline.process_standard,
+            self.cache,
+            self.current_fits,
+            fwhm,
+            threshold,
+            erode_kernel,
+            nb_iter,
+            preview,
+        )
+
+    def show_result_standard(self, result):
+        """
+        Display the results of the standard model
 
-        sources = p2.detect_stars(image_gray, fwhm, threshold)
+        :param result: dict returned by pipeline.process_standard
+        """
         # avoid errors if source is None
-        if sources is None:
+        if result is None:
             self.nb_stars = 0
             return
 
-        self.nb_stars = 0 if sources is None else len(sources)
+        self.nb_stars = result["nb_stars"]
         self.param_nb_stars.setText(str(self.nb_stars))
-        mask = p2.star_mask(image_gray, sources)
-        mask_blur = p2.mask_effects(mask, (3, 3), (3, 3))
 
-        Ierode = p2.erode_image(image_gray, (erode_kernel, erode_kernel), nb_iter)
+        self.views = {
+            "final": result["final"],
+            "mask": result["mask"],
+            # the overlay is only created if the user ask it
+            "overlay": lambda: cv.cvtColor(
+                p2.overlay_stars(result["image_gray"], result["mask_points"]),
+                cv.COLOR_BGR2RGB,
+            ),
+        }
 
-        final_image = p2.combinate_mask_image(mask_blur, Ierode, image_gray)
+        # display the final image
+        self.img_right.setPixmap(QPixmap.fromImage(result["preview"]))
+        self.extend_catalog()
 
-        # load the final image
-        self.img_right.setPixmap(
-            QPixmap("results/final_image/image_finale.png").scaled(
-                500,
-                500,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
+    def extend_catalog(self):
+        """
+        Lower the catalog of the selected fits to the minimum of the threshold
+        slider in the background (see pipeline.extend_catalog), then the number
+        of stars of every threshold is displayed at once by update_nb_stars.
+        The job is skipped if another file is selected before it starts.
+        """
+        fwhm = self.slider_fwhm.value() / 10.0
+        request = (self.load_generation, self.current_fits, fwhm)
+        if request == self.catalog_request:
+            return
+        if (
+            pipeline.cached_star_count(
+                self.cache, self.current_fits, fwhm, THRESHOLD_MIN
             )
+            is not None
+        ):
+            return
+        self.catalog_request = request
+        worker = PipelineWorker(
+            self.load_generation,
+            self.catalog_signals,
+            self.is_current_load,
+            pipeline.extend_catalog,
+            self.cache,
+            self.current_fits,
+            fwhm,
         )
+        self.catalog_pool.start(worker)
+
+    def on_catalog_extended(self, generation, result):
+        """
+        Receive the end of extend_catalog in the GUI thread
+
+        :param generation: load generation of the request
+        :param result: None
+        """
+        self.catalog_request = None
+        if generation == self.load_generation and not self.is_starnet_model():
+            self.update_nb_stars()
+
+    def on_catalog_failed(self, generation, message):
+        """
+        The catalog stays at its threshold : the next results detect the stars again
+
+        :param generation: load generation of the request
+        :param message: the error
+        """
+        self.catalog_request = None
+        print(f"catalog not extended : {message}")
+
+    def show_preview_standard(self, result):
+        """
+        Display the preview of the standard model (reduced image)
+
+        only the displayed image change : the number of stars and the views
+        (exported by save_image_as) stay the ones of the full resolution
+
+        :param result: dict returned by pipeline.process_standard with preview
+        """
+        if result is None:
+            return
+        self.img_right.setPixmap(QPixmap.fromImage(result["preview"]))
 
     def update_process_starnet(self):
         """
         Calculate all processus for create the final image with the starnet model
 
-        Read sliders'values for use in parameters of the differents function
-        and display the final image in appropriate box
+        Read sliders'values for use in parameters of the differents function,
+        the calculation is done in a thread and the final image is displayed
+        in appropriate box by show_result_starnet
         """
 
         if not self.current_fits_starless or not self.current_fits_staronly:
@@ -693,50 +996,48 @@ class StarReducApp(QMainWindow):
         alpha = self.slider_netstar_alpha.value() / 10.0
         thresh = self.slider_netstar_threshold.value() / 100.0
 
-        coeff_dilate = (3, 3)
-        coeff_gauss = (3, 3)
-
-        # Load starless and apply handler_color_image for normalization
-        data_starless, header_starless = p3.load_fits(self.current_fits_starless)
-        starless = p3.handler_color_image(data_starless)
-
-        # Load staronly and apply handler_color_image for normalization
-        data_staronly, header_staronly = p3.load_fits(self.current_fits_staronly)
-        staronly = p3.handler_color_image(data_staronly)
-
-        # Convert in grey
-        staronly_gray = p3.convert_in_grey(staronly)
-        starless_file_gray = p3.convert_in_grey(starless)
-
-        # Create mask from staronly image
-        mask = p3.mask_from_stars_starnet(staronly_gray, thresh)
-
-        # Apply Gaussian Blur
-        maskFlouGaussien = p3.mask_effects(
-            mask, coeff_dilate, coeff_gauss, iterations=1
+        self.start_worker(
+            self.show_result_starnet,
+            pipeline.process_starnet,
+            self.current_fits_starless,
+            self.current_fits_staronly,
+            thresh,
+            alpha,
+            None,
+            self.cache,
         )
 
-        # Reduce staronly image with the mask and alpha factor
-        star_reduced = p3.reduce_stars(staronly_gray, maskFlouGaussien, alpha)
+    def show_result_starnet(self, result):
+        """
+        Display the results of the starnet model
 
-        self.before, self.after, diff_abs = p3.save_diff_img(
-            starless_file_gray, staronly_gray, star_reduced
-        )
+        :param result: dict returned by pipeline.process_starnet
+        """
+        self.param_nb_stars.setText(str(result["nb_stars"]))
+        self.param_nb_pixels.setText(str(result["nb_pixels"]))
+
+        # before / after for the blink
+        self.before = result["before"]
+        self.after = result["after"]
 
         # blink = p3.blink_image(before, after, delay=0.5, n=10)
 
-        # Combine starless image and reduced staronly image
-        final = p3.combinate_mask_image(starless_file_gray, star_reduced)
+        self.views = {"final": result["final"], "mask": result["mask"]}
 
-        # load the final image
-        self.img_right.setPixmap(
-            QPixmap("results/final_image/final_combined_phase3.png").scaled(
-                500,
-                500,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
-            )
-        )
+        # display the final image
+        self.img_right.setPixmap(QPixmap.fromImage(result["preview"]))
+
+    def update_preview(self):
+        """
+        Calculate a quick preview of the standard model while the sliders are moved
+        """
+        # starnet model don't have preview
+        if self.is_starnet_model():
+            return
+        # the full resolution is already requested
+        if not self.update_timer.isActive():
+            return
+        self.update_process_image(preview=True)
 
     def update_process_image_choice(self):
         """
@@ -748,6 +1049,103 @@ class StarReducApp(QMainWindow):
         else:
             self.update_process_image()
 
+    def start_worker(self, on_result, fn, *args):
+        """
+        Run a function of the pipeline in the thread pool
+
+        each request have a new generation number : the results of an older
+        request (sliders moved during the calculation) are ignored
+
+        :param on_result: method called in the GUI thread with the result
+        :param fn: function of the pipeline
+        :param args: arguments of the function
+        """
+        self.generation += 1
+        self.on_result = on_result
+        worker = PipelineWorker(
+            self.generation, self.worker_signals, self.is_current_generation, fn, *args
+        )
+        self.thread_pool.start(worker)
+
+    def is_current_generation(self, generation):
+        """
+        Return if the generation is the one of the last request
+        (called from the threads of the pool)
+
+        :param generation: generation number of a request
+        """
+        return generation == self.generation
+
+    def on_worker_finished(self, generation, result):
+        """
+        Receive the result of a worker in the GUI thread
+
+        :param generation: generation number of the request
+        :param result: result of the function of the pipeline
+        """
+        # a newer request was sent : this result is for old sliders'values
+        if generation != self.generation:
+            return
+        self.on_result(result)
+
+    def start_load(self, on_result, fn, *args):
+        """
+        Load a file in the thread pool, before the calculations asked after it
+
+        :param on_result: method called in the GUI thread with the thumbnails
+        :param fn: function which load the file and prepare its thumbnails
+        :param args: arguments of the function
+        """
+        self.load_generation += 1
+        self.on_load = on_result
+        worker = PipelineWorker(
+            self.load_generation, self.load_signals, self.is_current_load, fn, *args
+        )
+        self.thread_pool.start(worker)
+
+    def is_current_load(self, generation):
+        """
+        Return if the generation is the one of the last file loaded
+        (called from the threads of the pool)
+
+        :param generation: generation number of a load
+        """
+        return generation == self.load_generation
+
+    def on_load_finished(self, generation, result):
+        """
+        Receive the thumbnails of a load in the GUI thread
+
+        :param generation: generation number of the load
+        :param result: result of the load function (see start_load)
+        """
+        # another file was selected since
+        if generation != self.load_generation:
+            return
+        self.on_load(result)
+
+    def on_load_failed(self, generation, message):
+        """
+        Display the error of a load
+
+        :param generation: generation number of the load
+        :param message: the error
+        """
+        if generation != self.load_generation:
+            return
+        QMessageBox.warning(self, "Loading error", message)
+
+    def on_worker_failed(self, generation, message):
+        """
+        Display the error of a worker
+
+        :param generation: generation number of the request
+        :param message: the error
+        """
+        if generation != self.generation:
+            return
+        QMessageBox.warning(self, "Processing error", message)
+
     def on_model_changed(self, button, checked):
         """
         handle checked buttonradio for model's choice
@@ -761,14 +1159,14 @@ class StarReducApp(QMainWindow):
 
     def save_image_as(self):
         """
-        Save the final image in a personal folder
+        Export the final image in a personal folder
 
+        the final image is only in memory, it's written here
         """
-        # the final image's path
-        src_path = "results/final_image/image_finale.png"
+        final = self.views.get("final")
 
-        # avoid file exists
-        if not os.path.exists(src_path):
+        # avoid no image calculated
+        if final is None:
             return
 
         # open DialogBox
@@ -779,8 +1177,8 @@ class StarReducApp(QMainWindow):
         if not dest_path:
             return  # annulation user
 
-        # copy image
-        shutil.copyfile(src_path, dest_path)
+        # write image
+        p2.save_image(dest_path, final, cmap="gray")
 
     def apply_models(self):
         """
@@ -806,11 +1204,6 @@ class StarReducApp(QMainWindow):
 
         param: mode str choice on select mode
         """
-        paths_views = {
-            "final": "results/final_image/image_finale.png",
-            "overlay": "results/masks/overlay_stars.png",
-            "mask": "results/masks/maskFlouGaussien.png",
-        }
 
         if mode == "blink":
             if self.before is None or self.after is None:
@@ -821,19 +1214,14 @@ class StarReducApp(QMainWindow):
             p3.blink_image(self.before, self.after)
             return
 
-        path = paths_views.get(mode)
-        if not path or not os.path.exists(path):
+        view = self.views.get(mode)
+        if callable(view):
+            view = view()
+        if view is None:
             QMessageBox.information(self, "Image not found", "Image not found")
             return
 
-        self.img_right.setPixmap(
-            QPixmap(path).scaled(
-                650,
-                650,
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation,
-            )
-        )
+        self.img_right.setPixmap(array_to_pixmap(view, VIEW_SIZE))
 
 
 if __name__ == "__main__":
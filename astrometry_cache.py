@@ -0,0 +1,140 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from astropy.io import fits
+from astropy.table import Table
+
+# directory of the solutions of Astrometry.net already received
+DIR_SOLVE_CACHE = "./resultsAPI/solve_cache/"
+# disk budget of the cache by default (256 MB, a corr file is about 100 KB)
+DEFAULT_SOLVE_CACHE_BYTES = 256 * 1024 * 1024
+
+CORR_FILE = "corr.fits"
+WCS_FILE = "wcs.hdr"
+INFO_FILE = "info.json"
+
+
+def read_corr_sources(corr):
+    """
+    Read the stars of a corr file of Astrometry.net
+
+    :param corr: content of the corr.fits file (bytes)
+    :return: table of stars positions (xcentroid, ycentroid)
+    """
+    with fits.open(io.BytesIO(corr)) as hdul:
+        sources = Table(hdul[1].data)
+    # Astrometry.net use field_x and field_y for positions
+    sources.rename_column("field_x", "xcentroid")
+    sources.rename_column("field_y", "ycentroid")
+    return sources
+
+
+class SolveCache:
+    """
+    Solutions of Astrometry.net on disk, by hash of the pixels of the image
+
+    each solution is a directory <hash>/ with the corr file, the WCS header and
+    the ids of the submission and of the job. A solution is written in a temporary
+    directory then renamed, so a run never read a solution half written.
+    The last use of a solution is the modification time of its directory : when
+    the budget is exceeded, the solutions used the longest time ago are removed.
+    """
+
+    def __init__(self, directory=DIR_SOLVE_CACHE, max_bytes=DEFAULT_SOLVE_CACHE_BYTES):
+        """Initialize the cache
+        :param directory: directory of the solutions
+        :param max_bytes: the disk budget in bytes"""
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def _path(self, key, name=""):
+        return os.path.join(self.directory, key, name)
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key, INFO_FILE))
+
+    def get(self, key):
+        """Return the solution stored for the key (None if unknown) and mark it as recently used
+        :param key: hash of the image (see cache.content_hash)
+        :return: dict with corr (bytes), wcs (fits.Header), submission_id and job_id"""
+        try:
+            with open(self._path(key, INFO_FILE)) as f:
+                info = json.load(f)
+            with open(self._path(key, CORR_FILE), "rb") as f:
+                corr = f.read()
+            with open(self._path(key, WCS_FILE)) as f:
+                wcs = fits.Header.fromstring(f.read())
+        except FileNotFoundError:
+            # unknown, or removed by another run at the same time
+            return None
+        os.utime(self._path(key))
+        return {"corr": corr, "wcs": wcs, **info}
+
+    def put(self, key, corr, wcs, submission_id, job_id):
+        """Store a solution, then remove the oldest solutions if needed
+        :param key: hash of the image (see cache.content_hash)
+        :param corr: content of the corr.fits file
+        :param wcs: WCS header of the solution
+        :param submission_id: id of the submission on Astrometry.net
+        :param job_id: id of the job on Astrometry.net"""
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp_", dir=self.directory)
+        try:
+            with open(os.path.join(tmp, CORR_FILE), "wb") as f:
+                f.write(corr)
+            with open(os.path.join(tmp, WCS_FILE), "w") as f:
+                f.write(wcs.tostring())
+            with open(os.path.join(tmp, INFO_FILE), "w") as f:
+                json.dump(
+                    {
+                        "submission_id": submission_id,
+                        "job_id": job_id,
+                        "solved": time.time(),
+                    },
+                    f,
+                )
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            os.replace(tmp, self._path(key))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def _entries(self):
+        """list of (last use, size, key) of the solutions"""
+        entries = []
+        if not os.path.isdir(self.directory):
+            return entries
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            if key.startswith(".tmp_") or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+                entries.append((os.path.getmtime(path), size, key))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    @property
+    def nbytes(self):
+        """Disk space used by the solutions"""
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """Remove the solutions used the longest time ago until the budget is respected"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the solutions"""
+        for _, _, key in self._entries():
+            shutil.rmtree(self._path(key), ignore_errors=True)
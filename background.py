@@ -0,0 +1,239 @@
+import time
+
+import cv2 as cv
+import numpy as np
+from astropy.stats import sigma_clipped_stats
+from scipy.ndimage import median_filter
+
+from cache import StageCache, content_hash
+
+# one pixel out of SAMPLE_STRIDE in each direction (1/16 of the image) is used
+SAMPLE_STRIDE = 4
+# smaller images are measured on all their pixels
+MIN_SAMPLE_PIXELS = 100_000
+# size in pixels of the cells of the mesh, and size of the median filter of the cells
+MESH_BOX = 64
+MESH_FILTER = 3
+# global : one level and noise measured on all the pixels of the image,
+# sampled : the same on a sample of the pixels (see sample_error), faster on big images,
+# mesh : one level by cell (gradients)
+BACKGROUND_MODES = ("global", "sampled", "mesh")
+
+# results already calculated, by content of the image and parameters
+# (the hash of the image cost about 20 times less than the statistics of the whole image)
+_memo = StageCache(max_bytes=256 * 1024 * 1024, max_entries=64)
+
+
+def sample_stride(shape, stride=SAMPLE_STRIDE):
+    """
+    Return the step of the sample of an image : 1 (all the pixels) for the images
+    smaller than MIN_SAMPLE_PIXELS, stride else
+
+    :param shape: shape of the image
+    :param stride: step between two pixels of the sample for the big images
+    """
+    return 1 if np.prod(shape[:2]) <= MIN_SAMPLE_PIXELS else stride
+
+
+def sample_pixels(image, stride=SAMPLE_STRIDE, size=None, seed=0):
+    """
+    Return the pixels used for the statistics
+
+    :param image: the grey image
+    :param stride: step between two pixels of a regular grid (1 = all the pixels)
+    :param size: if given, number of pixels taken at random (the stride is not used)
+    :param seed: seed of the random sample
+    :return: 1D array of pixels
+    """
+    stride = sample_stride(image.shape, stride)
+    if stride == 1:
+        return image.ravel()
+    if size is not None:
+        rng = np.random.default_rng(seed)
+        index = rng.integers(0, image.size, min(size, image.size))
+        return image.ravel()[index]
+    return image[::stride, ::stride].ravel()
+
+
+def sample_error(std, nb_samples):
+    """
+    Error (1 sigma) of the statistics measured on a sample instead of the whole image
+
+    for a gaussian noise of std s and a sample of n pixels (the clipping at 3 sigma
+    removes only 0.3 % of the noise and don't change these values) :
+    - error of the median = sqrt(pi / 2) * s / sqrt(n)
+    - error of the std = s / sqrt(2 n)
+    With the default stride, a 4000x4000 image give n = 1 000 000 : the level is
+    known at 0.13 % of the noise and the noise at 0.07 %, far below the change
+    of one step of the threshold slider. The stars take the same part of the
+    sample as of the image, so the clipping removes them in the same way.
+
+    :param std: the noise measured
+    :param nb_samples: number of pixels of the sample
+    :return: (error of the median, error of the std)
+    """
+    n = max(1, nb_samples)
+    return np.sqrt(np.pi / 2) * std / np.sqrt(n), std / np.sqrt(2 * n)
+
+
+def background_stats(image_gray, sigma=3.0, stride=1, size=None, seed=0):
+    """
+    Return mean, median (= background level) and std (= background noise) of an image
+
+    sigma_clipped_stats on all the pixels (by default, the same values as on the
+    image) or on a sample of the pixels (see sample_pixels and sample_error),
+    memorized by content of the image : a second call with the same image and the
+    same parameters only cost the hash of the image.
+
+    :param image_gray: the grey image
+    :param sigma: std for delete outliers values
+    :param stride: step between two pixels of the sample (1 = all the pixels,
+        SAMPLE_STRIDE for the mode "sampled")
+    :param size: if given, number of pixels taken at random instead of the grid
+    :param seed: seed of the random sample
+    :return: (mean, median, std)
+    """
+    key = ("stats", content_hash(image_gray), sigma, stride, size, seed)
+    stats = _memo.get(key)
+    if stats is None:
+        sample = sample_pixels(image_gray, stride, size, seed)
+        stats = _memo.put(key, sigma_clipped_stats(sample, sigma=sigma))
+    return stats
+
+
+def background_mesh(
+    image_gray, sigma=3.0, box=MESH_BOX, filter_size=MESH_FILTER, stride=SAMPLE_STRIDE
+):
+    """
+    Return the maps of the background level and noise, for images with gradients
+
+    the image is cut in cells of box x box pixels, sigma_clipped_stats is calculated
+    in each cell (on one pixel out of stride), a median filter on the cells removes
+    the cells disturbed by big stars or nebulae, then the cells are interpolated
+    to the size of the image. Memorized by content of the image like background_stats.
+
+    :param image_gray: the grey image
+    :param sigma: std for delete outliers values
+    :param box: size of the cells in pixels (bigger than the stars)
+    :param filter_size: size of the median filter on the cells
+    :param stride: step between two pixels of the sample of each cell
+    :return: (level, noise) two float32 maps of the size of the image
+    """
+    key = ("mesh", content_hash(image_gray), sigma, box, filter_size, stride)
+    maps = _memo.get(key)
+    if maps is not None:
+        return maps
+
+    h, w = image_gray.shape[:2]
+    ny, nx = -(-h // box), -(-w // box)
+    # the last cells are filled with NaN, which are ignored by sigma_clipped_stats
+    padded = np.full((ny * box, nx * box), np.nan, dtype=np.float32)
+    padded[:h, :w] = image_gray
+    cells = padded.reshape(ny, box, nx, box)[:, ::stride, :, ::stride]
+    cells = cells.transpose(0, 2, 1, 3).reshape(ny, nx, -1)
+    mean, level, noise = sigma_clipped_stats(cells, sigma=sigma, axis=2)
+
+    maps = []
+    for grid in (level, noise):
+        grid = np.asarray(grid, dtype=np.float32)
+        # cells without value (only NaN) get the value of the image
+        grid[~np.isfinite(grid)] = np.nanmedian(grid)
+        if filter_size > 1:
+            grid = median_filter(grid, size=filter_size, mode="nearest")
+        # the center of a cell is at the center of its box of pixels
+        full = cv.resize(grid, (nx * box, ny * box), interpolation=cv.INTER_LINEAR)
+        maps.append(full[:h, :w])
+    return _memo.put(key, tuple(maps))
+
+
+def estimate_background(image_gray, sigma=3.0, mode="global"):
+    """
+    Return the background level and noise used by the detection of stars
+
+    :param image_gray: the grey image
+    :param sigma: std for delete outliers values
+    :param mode: "global" (one value on all the pixels), "sampled" (one value on a
+        sample of the pixels) or "mesh" (level by cell, for gradients)
+    :return: (median, std) : median is a number or a map of the size of the image,
+        std is a number (median of the noise map with mesh, DAOStarFinder need one threshold)
+    """
+    if mode == "mesh":
+        level, noise = background_mesh(image_gray, sigma)
+        return level, float(np.median(noise))
+    if mode not in ("global", "sampled"):
+        raise ValueError(
+            f"unknown background mode : {mode} (choose in {', '.join(BACKGROUND_MODES)})"
+        )
+    stride = SAMPLE_STRIDE if mode == "sampled" else 1
+    mean, median, std = background_stats(image_gray, sigma, stride)
+    return median, std
+
+
+def clear_memo():
+    """Forget the results already calculated"""
+    _memo.clear()
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import sys
+    import warnings
+
+    from photutils.utils.exceptions import NoDetectionsWarning
+
+    import main_p2_origin as p2
+    from detectors import detect_daofind, match_stars, synthetic_field
+
+    warnings.simplefilter("ignore", NoDetectionsWarning)
+    paths = sys.argv[1:] or ["./examples/HorseHead.fits"]
+    print(
+        f"{'image':>24} {'full (s)':>9} {'sample (s)':>11} {'memo (s)':>9} "
+        f"{'median err/bound':>17} {'std err/bound':>14}"
+    )
+    for path in paths:
+        with contextlib.redirect_stdout(io.StringIO()):
+            data, header = p2.load_fits(path)
+            image_gray = p2.convert_in_grey(p2.handler_color_image(data, save=False))
+        start = time.perf_counter()
+        mean, median, std = sigma_clipped_stats(image_gray, sigma=3.0)
+        full_time = time.perf_counter() - start
+
+        clear_memo()
+        start = time.perf_counter()
+        _, sample_median, sample_std = background_stats(
+            image_gray, stride=SAMPLE_STRIDE
+        )
+        sample_time = time.perf_counter() - start
+        start = time.perf_counter()
+        background_stats(image_gray, stride=SAMPLE_STRIDE)
+        memo_time = time.perf_counter() - start
+
+        median_bound, std_bound = sample_error(std, sample_pixels(image_gray).size)
+        print(
+            f"{path[-24:]:>24} {full_time:>9.3f} {sample_time:>11.3f} {memo_time:>9.3f} "
+            f"{abs(sample_median - median) / median_bound:>17.2f} "
+            f"{abs(sample_std - std) / std_bound:>14.2f}"
+        )
+
+    # synthetic field with a gradient : global level against the mesh
+    shape = (2048, 2048)
+    image, true_x, true_y, amplitude = synthetic_field(shape, 5000, 4.0)
+    gradient = np.linspace(0, 0.2, shape[1], dtype=np.float32)[None, :]
+    image = image + gradient
+    print(
+        f"\nsynthetic {shape[1]}x{shape[0]} with a gradient of 20 x noise, 5000 stars"
+    )
+    print(f"{'mode':>8} {'time (s)':>9} {'found':>7} {'recall':>7} {'precision':>9}")
+    for mode in BACKGROUND_MODES:
+        clear_memo()
+        start = time.perf_counter()
+        median, std = estimate_background(image, mode=mode)
+        seconds = time.perf_counter() - start
+        sources = detect_daofind(image, 4.0, 5.0, median, std)
+        found_x = np.asarray(sources["xcentroid"]) if sources else np.empty(0)
+        found_y = np.asarray(sources["ycentroid"]) if sources else np.empty(0)
+        recall, precision, error = match_stars(true_x, true_y, found_x, found_y)
+        print(
+            f"{mode:>8} {seconds:>9.3f} {len(found_x):>7} {recall:>7.1%} {precision:>9.1%}"
+        )
@@ -0,0 +1,366 @@
+import argparse
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from astropy.io import fits
+
+import main_p2_origin as p2
+import pipeline
+import sparse
+import tiling
+from background import BACKGROUND_MODES
+from detectors import DETECTORS
+from run_context import (
+    ARTIFACT_POLICIES,
+    FINAL_SUBDIR,
+    SAMPLE_EVERY,
+    ArtifactWriter,
+    RunContext,
+    run_artifacts,
+)
+
+FOLDER_STARNET = "./star_reduction"
+DIR_RESULTS_BATCH = "./results/batch/"
+FITS_EXTENSIONS = (".fits", ".fit", ".fts")
+
+
+def find_inputs(patterns):
+    """
+    Build the list of FITS files from directories and glob patterns
+
+    :param patterns: list of directories, files or glob patterns
+    :return: sorted list of paths without duplicates
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for name in os.listdir(pattern):
+                if name.lower().endswith(FITS_EXTENSIONS):
+                    paths.add(os.path.join(pattern, name))
+        else:
+            paths.update(glob.glob(pattern))
+    return sorted(paths)
+
+
+def starnet_paths(path, starnet_dir=FOLDER_STARNET):
+    """
+    Return the starless and staronly files made by StarNet for a FITS file
+    (same names as in the GUI : starless_<name>.fit and starmask_<name>.fit)
+
+    :param path: the original FITS file's path
+    :param starnet_dir: directory where Siril saved the StarNet files
+    """
+    name, ext = os.path.splitext(os.path.basename(path))
+    return (
+        os.path.join(starnet_dir, f"starless_{name}.fit"),
+        os.path.join(starnet_dir, f"starmask_{name}.fit"),
+    )
+
+
+def run_standard(path, options, ctx):
+    """
+    Calculate the final image of the standard model (phase 2) for one file
+
+    :param path: the FITS file's path
+    :param options: the arguments of the command line
+    :param ctx: RunContext which receive the intermediate images (not used by tiles)
+    :return: the final image, the header and the number of stars
+    """
+    header = fits.getheader(path)
+    if options.tile:
+        final, sources = tiling.process_standard_tiled(
+            path,
+            options.fwhm,
+            options.threshold,
+            options.erode_kernel,
+            options.iterations,
+            tile=options.tile,
+            detector=options.detector,
+            workers=options.detect_workers,
+        )
+        # no stars : the grey image is kept as it is
+        return final, header, 0 if sources is None else len(sources)
+
+    data, header = p2.load_fits(path)
+    image = p2.handler_color_image(data, ctx=ctx, memo=True)
+    image_gray = p2.convert_in_grey(image)
+    sources = tiling.detect_stars_parallel(
+        image_gray,
+        options.fwhm,
+        options.threshold,
+        workers=options.detect_workers,
+        detector=options.detector,
+        background=options.background,
+    )
+    # no stars : the image is kept as it is
+    if sources is None:
+        return image_gray, header, 0
+
+    # the masks of the whole image are only needed for the images of the run
+    mask_blur = None
+    if ctx.wants("masks"):
+        mask = p2.star_mask(image_gray, sources, ctx=ctx, memo=True)
+        mask_blur = p2.mask_effects(mask, (3, 3), (3, 3), ctx=ctx)
+    # erosion and combination only around the stars,
+    # the final image is written by process_file
+    final_image = sparse.reduce_stars_sparse(
+        image_gray,
+        sources,
+        options.erode_kernel,
+        options.iterations,
+        mask_blur=mask_blur,
+    )
+    return final_image, header, len(sources)
+
+
+def run_starnet(path, options, ctx):
+    """
+    Calculate the final image of the starnet model (phase 3) for one file
+
+    :param path: the original FITS file's path
+    :param options: the arguments of the command line
+    :param ctx: RunContext which receive the intermediate images (not used by tiles)
+    :return: the final image, the header of the starless file and None (no stars count)
+    """
+    starless_path, staronly_path = starnet_paths(path, options.starnet_dir)
+    for starnet_file in (starless_path, staronly_path):
+        if not os.path.exists(starnet_file):
+            raise FileNotFoundError(f"StarNet file not found : {starnet_file}")
+
+    header = fits.getheader(starless_path)
+    if options.tile:
+        final = tiling.process_starnet_tiled(
+            starless_path,
+            staronly_path,
+            options.thresh,
+            options.alpha,
+            tile=options.tile,
+        )
+    else:
+        final = pipeline.process_starnet(
+            starless_path, staronly_path, options.thresh, options.alpha, ctx=ctx
+        )["final"]
+    return final, header, None
+
+
+def process_file(path, options, index=0):
+    """
+    Process one file and write its outputs, called in a process of the pool
+
+    outputs : <out_dir>/<name>_final.fits, <out_dir>/<name>_final.png (unless
+    the policy is none) and the intermediate images in <out_dir>/<name>/ (policy all).
+    The PNG are written by a thread in the background while the stages continue.
+
+    :param path: the FITS file's path
+    :param options: the arguments of the command line
+    :param index: number of the file in the batch (for the policy sampled)
+    :return: dict with the path, the status, the time and the error if any
+    """
+    start = time.perf_counter()
+    report = {
+        "path": path,
+        "ok": False,
+        "seconds": 0.0,
+        "nb_stars": None,
+        "error": None,
+    }
+    name, ext = os.path.splitext(os.path.basename(path))
+    artifacts = run_artifacts(options.artifacts, index, options.sample_every)
+    try:
+        # the writer is closed at the end of the file : all its images are written
+        with ArtifactWriter() as writer:
+            ctx = RunContext(os.path.join(options.out_dir, name), artifacts, writer)
+            # the stage functions print a lot of information, keep them only in verbose
+            output = sys.stdout if options.verbose else io.StringIO()
+            with contextlib.redirect_stdout(output):
+                if options.model == "starnet":
+                    final, header, nb_stars = run_starnet(path, options, ctx)
+                else:
+                    final, header, nb_stars = run_standard(path, options, ctx)
+
+            if final is not None:
+                if ctx.wants(FINAL_SUBDIR):
+                    writer.submit(
+                        p2.save_image,
+                        os.path.join(options.out_dir, f"{name}_final.png"),
+                        final,
+                        "gray",
+                    )
+                fits.writeto(
+                    os.path.join(options.out_dir, f"{name}_final.fits"),
+                    final,
+                    header,
+                    overwrite=True,
+                )
+        report["ok"] = True
+        report["nb_stars"] = nb_stars
+        report["pixels"] = 0 if final is None else final.size
+    except Exception as error:
+        report["error"] = f"{type(error).__name__}: {error}"
+    report["seconds"] = time.perf_counter() - start
+    return report
+
+
+def run_batch(paths, options):
+    """
+    Process all the files in a pool of processes and display a report
+
+    :param paths: list of FITS files
+    :param options: the arguments of the command line
+    :return: list of the reports of each file
+    """
+    os.makedirs(options.out_dir, exist_ok=True)
+    reports = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=options.workers) as executor:
+        futures = [
+            executor.submit(process_file, path, options, index)
+            for index, path in enumerate(paths)
+        ]
+        for future in as_completed(futures):
+            report = future.result()
+            reports.append(report)
+            if report["ok"]:
+                stars = (
+                    ""
+                    if report["nb_stars"] is None
+                    else f", {report['nb_stars']} stars"
+                )
+                print(f"[OK]    {report['path']} : {report['seconds']:.2f} s{stars}")
+            else:
+                print(f"[ERROR] {report['path']} : {report['error']}")
+    elapsed = time.perf_counter() - start
+
+    succeeded = [r for r in reports if r["ok"]]
+    failed = [r for r in reports if not r["ok"]]
+    megapixels = sum(r["pixels"] for r in succeeded) / 1e6
+    print("\n========================== Batch summary ==========================")
+    print(f"files      : {len(reports)} ({len(succeeded)} ok, {len(failed)} failed)")
+    print(f"workers    : {options.workers}")
+    print(f"artifacts  : {options.artifacts}")
+    print(f"total time : {elapsed:.2f} s")
+    if elapsed > 0:
+        print(
+            f"throughput : {len(succeeded) / elapsed:.2f} files/s, {megapixels / elapsed:.2f} Mpx/s"
+        )
+    if succeeded:
+        cpu = sum(r["seconds"] for r in succeeded)
+        print(f"mean time by file : {cpu / len(succeeded):.2f} s")
+    for report in failed:
+        print(f"failed : {report['path']} ({report['error']})")
+    return reports
+
+
+def parse_args(argv=None):
+    """Read the arguments of the command line"""
+    parser = argparse.ArgumentParser(
+        description="Star reduction on a directory or a glob of FITS files"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="directories, FITS files or glob patterns"
+    )
+    parser.add_argument(
+        "--model",
+        choices=("standard", "starnet"),
+        default="standard",
+        help="standard = DAOStarFinder (phase 2), starnet = StarNet mask (phase 3)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="number of processes"
+    )
+    parser.add_argument(
+        "--detect-workers",
+        type=int,
+        default=1,
+        help="processes for the detection of stars in each file (for a few big images)",
+    )
+    parser.add_argument(
+        "--out-dir", default=DIR_RESULTS_BATCH, help="directory of the outputs"
+    )
+    parser.add_argument(
+        "--tile",
+        type=int,
+        default=0,
+        help="process by tiles of this size (0 = whole image)",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="display the outputs of the stages"
+    )
+    parser.add_argument(
+        "--artifacts",
+        choices=ARTIFACT_POLICIES,
+        default="final",
+        help="PNG written : none, final (final image only), all (intermediate images too), "
+        "sampled (all for one file out of --sample-every)",
+    )
+    parser.add_argument(
+        "--sample-every",
+        type=int,
+        default=SAMPLE_EVERY,
+        help="with --artifacts sampled, one file out of this number keep all its images",
+    )
+
+    standard = parser.add_argument_group("standard model")
+    standard.add_argument(
+        "--fwhm", type=float, default=4.0, help="size of star in pixel"
+    )
+    standard.add_argument(
+        "--threshold", type=float, default=5.0, help="detection threshold"
+    )
+    standard.add_argument(
+        "--detector",
+        choices=tuple(DETECTORS),
+        default="daofind",
+        help="star detector : daofind (DAOStarFinder), components (threshold and "
+        "connected components) or matched (local maxima of a matched filter)",
+    )
+    standard.add_argument(
+        "--background",
+        choices=BACKGROUND_MODES,
+        default="global",
+        help="background of the detection : global (one level on all the pixels), "
+        "sampled (one level on a sample, faster on big images) or mesh "
+        "(level by cell of 64 pixels, for gradients). With --tile the level is "
+        "always sampled",
+    )
+    standard.add_argument(
+        "--erode-kernel", type=int, default=2, help="size of the erosion kernel"
+    )
+    standard.add_argument(
+        "--iterations", type=int, default=3, help="number of erosion iterations"
+    )
+
+    starnet = parser.add_argument_group("starnet model")
+    starnet.add_argument(
+        "--starnet-dir",
+        default=FOLDER_STARNET,
+        help="directory of starless_/starmask_ files",
+    )
+    starnet.add_argument(
+        "--thresh", type=float, default=0.05, help="threshold of the stars mask"
+    )
+    starnet.add_argument(
+        "--alpha", type=float, default=0.8, help="reduction factor (0 to 1)"
+    )
+    options = parser.parse_args(argv)
+    if options.tile and options.background == "mesh":
+        # the level by cell is measured on the whole image, the tiles only have
+        # the global level of the image
+        parser.error("--background mesh can't be used with --tile")
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    paths = find_inputs(options.inputs)
+    if not paths:
+        print("No FITS file found")
+        sys.exit(1)
+
+    reports = run_batch(paths, options)
+    sys.exit(0 if all(r["ok"] for r in reports) else 1)
@@ -0,0 +1,128 @@
+import time
+import tracemalloc
+
+import numpy as np
+
+# size in bytes of a block of rows : the temporary buffer stay in the cache of the CPU
+BLOCK_BYTES = 1024 * 1024
+
+
+def _channels(array, ndim):
+    """add an axis to a 2D array (mask, grey image) to use it on each channel"""
+    if array.ndim < ndim:
+        return array[..., None]
+    return array
+
+
+def blend(
+    orig,
+    mask,
+    target=None,
+    alpha=1.0,
+    out=None,
+    block_bytes=BLOCK_BYTES,
+    scratch=None,
+):
+    """
+    Mix two images with a mask : out = orig + alpha * mask * (target - orig)
+
+    it's the same as (mask * target) + ((1 - mask) * orig) with alpha = 1, but
+    calculated by blocks of rows with only one small temporary buffer, without
+    the 4 temporary images of the formula.
+    A 2D mask (or target) is used on each channel of a color image.
+
+    :param orig: the original image (2D or 3D with the channels at the end)
+    :param mask: the mask (0 = orig, 1 = target)
+    :param target: the image where the mask is 1 (eroded image), None for 0 (removal of stars)
+    :param alpha: factor of the mask
+    :param out: array which receive the result (can be orig itself), None to allocate it
+    :param block_bytes: size of a block of rows in bytes
+    :param scratch: 1D array reused as temporary buffer between calls (small images
+        called many times), used if it's of the type of the result and big enough
+    :return: the mixed image
+    """
+    dtype = np.result_type(orig, mask, target if target is not None else orig)
+    if out is None:
+        out = np.empty(orig.shape, dtype=dtype)
+    mask = _channels(mask, orig.ndim)
+    if target is not None:
+        target = _channels(target, orig.ndim)
+
+    row_bytes = max(1, orig[:1].size * dtype.itemsize)
+    # a small image is one block : the buffer isn't bigger than the image
+    rows = max(1, min(orig.shape[0], block_bytes // row_bytes))
+    size = rows * orig[:1].size
+    if scratch is not None and scratch.dtype == dtype and scratch.size >= size:
+        buffer = scratch[:size].reshape((rows,) + orig.shape[1:])
+    else:
+        buffer = np.empty((rows,) + orig.shape[1:], dtype=dtype)
+    for start in range(0, orig.shape[0], rows):
+        stop = min(start + rows, orig.shape[0])
+        part = orig[start:stop]
+        tmp = buffer[: stop - start]
+        # tmp = target - orig (or -orig), then * mask * alpha
+        if target is None:
+            np.negative(part, out=tmp)
+        else:
+            np.subtract(target[start:stop], part, out=tmp)
+        np.multiply(tmp, mask[start:stop], out=tmp)
+        if alpha != 1.0:
+            np.multiply(tmp, alpha, out=tmp)
+        np.add(part, tmp, out=out[start:stop])
+    return out
+
+
+def _formula(orig, mask, target):
+    """formula of combinate_mask_image / combinate_mask_color (reference of the benchmark)"""
+    if orig.ndim == 2:
+        return (mask * target) + ((1 - mask) * orig)
+    final = np.zeros_like(orig)
+    for i in range(orig.shape[2]):
+        final[:, :, i] = (mask * target) + ((1 - mask) * orig[:, :, i])
+    return final
+
+
+def _measure(function, *args):
+    """time and peak memory (over the memory at the start) of a call"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+if __name__ == "__main__":
+    import sys
+
+    # sides of the images, 16384 needs about 6 GB for the formula
+    sides = [int(arg) for arg in sys.argv[1:]] or [4096, 8192]
+    rng = np.random.default_rng(0)
+    mb = 1024 * 1024
+    print(
+        f"{'image':>14} {'formula (s)':>12} {'peak (MB)':>10} "
+        f"{'blend (s)':>10} {'peak (MB)':>10} {'max diff':>9}"
+    )
+    for side in sides:
+        for channels in (0, 3):
+            shape = (side, side, channels) if channels else (side, side)
+            orig = rng.random(shape, dtype=np.float32)
+            eroded = rng.random((side, side), dtype=np.float32)
+            mask = rng.random((side, side), dtype=np.float32)
+
+            reference, formula_time, formula_peak = _measure(
+                _formula, orig, mask, eroded
+            )
+            # the output is allocated once and reused, like a buffer of the pipeline
+            out = np.empty_like(orig)
+            result, blend_time, blend_peak = _measure(
+                blend, orig, mask, eroded, 1.0, out
+            )
+            name = f"{side}x{side}" + (f"x{channels}" if channels else "")
+            print(
+                f"{name:>14} {formula_time:>12.3f} {formula_peak / mb:>10.1f} "
+                f"{blend_time:>10.3f} {blend_peak / mb:>10.1f} "
+                f"{np.abs(result - reference).max():>9.1e}"
+            )
+            del reference, result, out, orig
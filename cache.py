@@ -0,0 +1,135 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# memory budget of the cache by default (1 GB)
+DEFAULT_CACHE_BYTES = 1024 * 1024 * 1024
+
+
+def file_key(path: str):
+    """
+    Build the part of a cache key which identify a file on disk
+
+    the modification time is in the key, so a file rewritten on disk
+    (by Siril for example) is never served from an old result
+
+    :param path: the file's path
+    :return: tuple (absolute path, modification time)
+    """
+    return (os.path.abspath(path), os.path.getmtime(path))
+
+
+def content_hash(array):
+    """
+    Hash of the content of an array (shape, type and data), the same for two equal arrays
+
+    sha1 read about 1 GB/s, much faster than most of the stages of the pipeline
+
+    :param array: the numpy array
+    :return: hexadecimal string
+    """
+    data = np.ascontiguousarray(array)
+    digest = hashlib.sha1(usedforsecurity=False)
+    digest.update(f"{data.shape}{data.dtype.str}".encode())
+    digest.update(memoryview(data).cast("B"))
+    return digest.hexdigest()
+
+
+def result_nbytes(value):
+    """
+    Estimate the memory used by a result stored in the cache
+
+    numpy arrays, astropy tables (by their columns), objects with a nbytes attribute
+    and containers of them are counted, all other objects are considered as free
+
+    :param value: the result to measure
+    :return: the size in bytes
+    """
+    if value is None:
+        return 0
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(value, dict):
+        return sum(result_nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(result_nbytes(v) for v in value)
+    # astropy Table : sum of its columns
+    columns = getattr(value, "columns", None)
+    if columns is not None and hasattr(columns, "values"):
+        return sum(np.asarray(col).nbytes for col in columns.values())
+    return 0
+
+
+class StageCache:
+    """
+    Cache of the intermediate results of the pipeline (LRU with a memory budget)
+
+    each stage of the pipeline store its result with a key built with
+    the file key and the parameters of the stage and all the previous stages.
+    When the budget is exceeded, the least recently used results are removed.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, max_entries=None):
+        """Initialize the cache
+        :param max_bytes: the memory budget in bytes
+        :param max_entries: maximum number of results (None = no limit)"""
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.nbytes = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the result stored for the key and mark it as recently used
+        :param key: the stage key
+        :param default: value returned if the key is not in the cache"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        """Store the result of a stage, then remove the oldest results if needed
+        :param key: the stage key
+        :param value: the result of the stage"""
+        size = result_nbytes(value)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old[1]
+
+            # a result bigger than the whole budget is not stored
+            if size > self.max_bytes:
+                return value
+
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes or (
+                self.max_entries is not None and len(self._entries) > self.max_entries
+            ):
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self.nbytes -= old_size
+        return value
+
+    def clear(self):
+        """Remove all the results"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
@@ -0,0 +1,150 @@
+import time
+
+import numpy as np
+
+import main_p2_origin as p2
+import tiling
+from background import background_stats
+
+# minimum of the threshold slider : the catalog is built at this threshold
+THRESHOLD_MIN = 1
+
+
+class DetectionCatalog:
+    """
+    Stars found once at the lowest threshold, filtered for the higher thresholds
+
+    DAOStarFinder keep the local maxima of the convolved image which are above
+    threshold * std * relerr of its kernel, the other filters (sharpness, roundness)
+    don't depend on the threshold. So the stars of a higher threshold are the stars
+    of the lowest threshold with a bigger convolved peak : the catalog is sorted by
+    this peak and a threshold only cut the sorted list.
+    The convolved peak is read from daofind_mag = -2.5 log10(peak / threshold_eff),
+    calculated in float32 by photutils : only a star at less than 1e-7 (relative)
+    of a threshold could be classified differently.
+    A catalog answer all the thresholds above min_threshold, only a change of fwhm
+    (or of image) or a lower threshold need a new catalog.
+    """
+
+    def __init__(
+        self, image_gray, fwhm, min_threshold=THRESHOLD_MIN, sigma=3.0, workers=1
+    ):
+        """
+        Detect the stars at the lowest threshold and index them
+
+        :param image_gray: the grey image
+        :param fwhm: Full Width at Half Maximum = size of star in pixel
+        :param min_threshold: lowest threshold which will be asked
+        :param sigma: std for delete outliers values
+        :param workers: number of processes of the detection (see tiling.find_stars_parallel)
+        """
+        self.fwhm = fwhm
+        self.min_threshold = min_threshold
+        mean, median, std = background_stats(image_gray, sigma)
+        self.sources = tiling.find_stars_parallel(
+            image_gray, fwhm, min_threshold, median, std, workers
+        )
+
+        if self.sources is None:
+            self._order = np.empty(0, dtype=np.intp)
+            self._ratio = np.empty(0)
+            return
+        # convolved peak / threshold_eff of min_threshold, a star is found at
+        # the threshold t if this ratio is above t / min_threshold
+        ratio = 10 ** (-0.4 * np.asarray(self.sources["daofind_mag"], dtype=np.float64))
+        self._order = np.argsort(ratio, kind="stable")
+        self._ratio = ratio[self._order]
+
+    @property
+    def nbytes(self):
+        """Memory used by the catalog (for the cache)"""
+        columns = 0
+        if self.sources is not None:
+            columns = sum(
+                np.asarray(col).nbytes for col in self.sources.columns.values()
+            )
+        return columns + self._order.nbytes + self._ratio.nbytes
+
+    def _first(self, threshold):
+        """index in the sorted list of the first star found at this threshold"""
+        if threshold < self.min_threshold:
+            raise ValueError(
+                f"threshold {threshold} is lower than the threshold of the catalog {self.min_threshold}"
+            )
+        return np.searchsorted(
+            self._ratio, threshold / self.min_threshold, side="right"
+        )
+
+    def count(self, threshold):
+        """
+        Return the number of stars found at a threshold (without building the table)
+
+        :param threshold: the detection threshold
+        """
+        return len(self._ratio) - self._first(threshold)
+
+    def select(self, threshold):
+        """
+        Return the stars found at a threshold, like DAOStarFinder with this threshold
+
+        :param threshold: the detection threshold
+        :return: table of stars positions (same order and ids as DAOStarFinder) or None
+        """
+        rows = np.sort(self._order[self._first(threshold) :])
+        if len(rows) == 0:
+            return None
+        sources = self.sources[rows]
+        sources["id"] = np.arange(1, len(rows) + 1)
+        # daofind_mag is relative to the threshold
+        sources["daofind_mag"] += 2.5 * np.log10(threshold / self.min_threshold)
+        return sources
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import sys
+    import warnings
+
+    from photutils.utils.exceptions import NoDetectionsWarning
+
+    warnings.simplefilter("ignore", NoDetectionsWarning)
+    path = sys.argv[1] if len(sys.argv) > 1 else "./examples/HorseHead.fits"
+    fwhm = 4.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, header = p2.load_fits(path)
+        image_gray = p2.convert_in_grey(p2.handler_color_image(data, save=False))
+
+    start = time.perf_counter()
+    catalog = DetectionCatalog(image_gray, fwhm)
+    print(f"{path} : catalog built in {time.perf_counter() - start:.3f} s")
+    print(
+        f"{'threshold':>9} {'stars':>7} {'detect (s)':>11} {'select (s)':>11} "
+        f"{'count (us)':>11} same"
+    )
+    for threshold in range(THRESHOLD_MIN, 21):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            reference = p2.detect_stars(image_gray, fwhm, threshold)
+        detect_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sources = catalog.select(threshold)
+        select_time = time.perf_counter() - start
+        start = time.perf_counter()
+        count = catalog.count(threshold)
+        count_time = time.perf_counter() - start
+
+        if reference is None or sources is None:
+            same = reference is None and sources is None
+        else:
+            same = len(reference) == len(sources) and all(
+                np.allclose(
+                    reference[name], sources[name], rtol=1e-6, atol=1e-6, equal_nan=True
+                )
+                for name in reference.colnames
+            )
+        print(
+            f"{threshold:>9} {count:>7} {detect_time:>11.3f} {select_time:>11.4f} "
+            f"{count_time * 1e6:>11.1f} {same}"
+        )
@@ -0,0 +1,237 @@
+import time
+
+import cv2 as cv
+import numpy as np
+from astropy.stats import gaussian_fwhm_to_sigma
+from astropy.table import Table
+from photutils.detection import DAOStarFinder
+
+# smallest number of pixels above the threshold for a star of the segmentation
+MIN_PIXELS = 3
+
+
+def _kernel_radius(fwhm):
+    """radius of the kernel of DAOStarFinder : 1.5 sigma, minimum 2 pixels"""
+    return int(max(2, 1.5 * fwhm * gaussian_fwhm_to_sigma))
+
+
+def _table(x, y, peak, flux=None):
+    """build the table of stars with the columns used by star_mask"""
+    if len(x) == 0:
+        return None
+    sources = Table()
+    sources["id"] = np.arange(1, len(x) + 1)
+    sources["xcentroid"] = np.asarray(x, dtype=np.float64)
+    sources["ycentroid"] = np.asarray(y, dtype=np.float64)
+    sources["peak"] = np.asarray(peak, dtype=np.float64)
+    if flux is not None:
+        sources["flux"] = np.asarray(flux, dtype=np.float64)
+    return sources
+
+
+def detect_daofind(image_gray, fwhm, threshold, median, std):
+    """
+    DAOStarFinder of photutils : convolution, local maxima, then a fit of the
+    shape of each star (sharpness, roundness). Precise but long on crowded fields.
+
+    :param image_gray: the grey image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold (in number of std)
+    :param median: background level
+    :param std: background noise
+    :return: table of stars positions or None
+    """
+    daofind = DAOStarFinder(fwhm=fwhm, threshold=threshold * std)
+    return daofind(image_gray - median)
+
+
+def detect_components(image_gray, fwhm, threshold, median, std):
+    """
+    Segmentation : the pixels above threshold * std are grouped with
+    cv.connectedComponentsWithStats, a star is a group of MIN_PIXELS pixels or more
+    and its position is the centroid weighted by the pixel values.
+    Very fast, but close stars are merged and faint stars are lost.
+
+    :param image_gray: the grey image
+    :param fwhm: not used (the size of the stars is the size of the groups)
+    :param threshold: the detection threshold (in number of std)
+    :param median: background level
+    :param std: background noise
+    :return: table of stars positions or None
+    """
+    data = np.asarray(image_gray, dtype=np.float32) - np.float32(median)
+    binary = (data > threshold * std).astype(np.uint8)
+    count, labels, stats, centroids = cv.connectedComponentsWithStats(
+        binary, connectivity=8
+    )
+
+    # sums by group of the pixels values, without loop (label 0 is the background)
+    inside = labels > 0
+    label = labels[inside]
+    weight = data[inside].astype(np.float64)
+    rows, cols = np.nonzero(inside)
+    flux = np.bincount(label, weight, minlength=count)
+    x = np.bincount(label, weight * cols, minlength=count) / np.maximum(flux, 1e-30)
+    y = np.bincount(label, weight * rows, minlength=count) / np.maximum(flux, 1e-30)
+    peak = np.zeros(count)
+    np.maximum.at(peak, label, weight)
+
+    keep = stats[:, cv.CC_STAT_AREA] >= MIN_PIXELS
+    keep[0] = False
+    return _table(x[keep], y[keep], peak[keep], flux[keep])
+
+
+def detect_matched(image_gray, fwhm, threshold, median, std):
+    """
+    Matched filter : the image is convolved with a gaussian of the size of the stars,
+    the stars are the local maxima where the amplitude estimated by the filter is
+    above threshold * std (like DAOStarFinder). The position is refined with a
+    parabola on the 3 pixels around the maximum in each direction.
+    Fast, and it separates close stars better than the segmentation.
+
+    :param image_gray: the grey image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold (in number of std)
+    :param median: background level
+    :param std: background noise
+    :return: table of stars positions or None
+    """
+    sigma = fwhm * gaussian_fwhm_to_sigma
+    radius = _kernel_radius(fwhm)
+    size = 2 * radius + 1
+    data = np.asarray(image_gray, dtype=np.float32) - np.float32(median)
+    conv = cv.GaussianBlur(data, (size, size), sigma, borderType=cv.BORDER_REPLICATE)
+
+    # amplitude of a gaussian of height 1 which fit the data : conv * max(g) / sum(g^2)
+    g = cv.getGaussianKernel(size, sigma)
+    g = g @ g.T
+    amplitude = conv * np.float32(g.max() / np.sum(g * g))
+
+    local_max = cv.dilate(conv, np.ones((size, size), np.uint8))
+    rows, cols = np.nonzero((conv == local_max) & (amplitude > threshold * std))
+    if len(rows) == 0:
+        return None
+
+    # sub-pixel position with a parabola through the 3 values of each direction
+    padded = np.pad(conv, 1, mode="edge")
+    center = padded[rows + 1, cols + 1]
+    left, right = padded[rows + 1, cols], padded[rows + 1, cols + 2]
+    up, down = padded[rows, cols + 1], padded[rows + 2, cols + 1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx = 0.5 * (left - right) / (left - 2 * center + right)
+        dy = 0.5 * (up - down) / (up - 2 * center + down)
+    dx = np.clip(np.nan_to_num(dx), -0.5, 0.5)
+    dy = np.clip(np.nan_to_num(dy), -0.5, 0.5)
+    return _table(cols + dx, rows + dy, amplitude[rows, cols])
+
+
+# the detectors by name, all with the same parameters and the same table
+DETECTORS = {
+    "daofind": detect_daofind,
+    "components": detect_components,
+    "matched": detect_matched,
+}
+
+
+def get_detector(name):
+    """
+    Return the detection function of a name of DETECTORS
+
+    :param name: name of the detector
+    """
+    if name not in DETECTORS:
+        raise ValueError(
+            f"unknown detector : {name} (choose in {', '.join(DETECTORS)})"
+        )
+    return DETECTORS[name]
+
+
+def synthetic_field(shape, nb_stars, fwhm, noise=0.01, seed=0):
+    """
+    Create an image with gaussian stars on a noisy background
+
+    :param shape: shape of the image (height, width)
+    :param nb_stars: number of stars
+    :param fwhm: Full Width at Half Maximum of the stars
+    :param noise: std of the background noise
+    :param seed: seed of the random generator
+    :return: the image and the true positions (x, y) and amplitudes of the stars
+    """
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    x = rng.uniform(5, w - 5, nb_stars)
+    y = rng.uniform(5, h - 5, nb_stars)
+    # amplitudes from 3 to 300 times the noise, more faint stars than bright ones
+    amplitude = noise * 10 ** rng.uniform(np.log10(3), np.log10(300), nb_stars)
+
+    image = np.zeros(shape, dtype=np.float64)
+    sigma = fwhm * gaussian_fwhm_to_sigma
+    reach = int(np.ceil(4 * sigma))
+    offsets = np.arange(-reach, reach + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+    xx = np.rint(x)[:, None] + dx.ravel()[None, :]
+    yy = np.rint(y)[:, None] + dy.ravel()[None, :]
+    values = amplitude[:, None] * np.exp(
+        -((xx - x[:, None]) ** 2 + (yy - y[:, None]) ** 2) / (2 * sigma**2)
+    )
+    inside = (xx >= 0) & (xx < w) & (yy >= 0) & (yy < h)
+    np.add.at(image, (yy[inside].astype(int), xx[inside].astype(int)), values[inside])
+    image += 0.1 + rng.normal(0, noise, shape)
+    return image.astype(np.float32), x, y, amplitude
+
+
+def match_stars(true_x, true_y, found_x, found_y, max_distance=1.5):
+    """
+    Associate each true star with the nearest detected star
+
+    :param max_distance: maximum distance in pixels to say a star is found
+    :return: (recall, precision, rms error of the positions of the stars found)
+    """
+    from scipy.spatial import cKDTree
+
+    if len(found_x) == 0:
+        return 0.0, 0.0, float("nan")
+    distance, index = cKDTree(np.column_stack((found_x, found_y))).query(
+        np.column_stack((true_x, true_y))
+    )
+    found = distance <= max_distance
+    recall = found.mean()
+    # a detection is good if it's the nearest of a true star
+    precision = len(np.unique(index[found])) / len(found_x)
+    error = np.sqrt(np.mean(distance[found] ** 2)) if found.any() else float("nan")
+    return recall, precision, error
+
+
+if __name__ == "__main__":
+    import warnings
+
+    from astropy.stats import sigma_clipped_stats
+    from photutils.utils.exceptions import NoDetectionsWarning
+
+    warnings.simplefilter("ignore", NoDetectionsWarning)
+    shape = (2048, 2048)
+    fwhm = 4.0
+    threshold = 5.0
+    megapixels = shape[0] * shape[1] / 1e6
+    print(f"synthetic fields {shape[1]}x{shape[0]}, fwhm {fwhm}, threshold {threshold}")
+    print(
+        f"{'stars':>7} {'detector':>11} {'time (s)':>9} {'Mpx/s':>7} "
+        f"{'found':>7} {'recall':>7} {'precision':>9} {'error (px)':>10}"
+    )
+    for nb_stars in (1000, 10000, 40000):
+        image, true_x, true_y, amplitude = synthetic_field(shape, nb_stars, fwhm)
+        mean, median, std = sigma_clipped_stats(image, sigma=3.0)
+        for name, detector in DETECTORS.items():
+            start = time.perf_counter()
+            sources = detector(image, fwhm, threshold, median, std)
+            seconds = time.perf_counter() - start
+            if sources is None:
+                found_x = found_y = np.empty(0)
+            else:
+                found_x = np.asarray(sources["xcentroid"])
+                found_y = np.asarray(sources["ycentroid"])
+            recall, precision, error = match_stars(true_x, true_y, found_x, found_y)
+            print(
+                f"{nb_stars:>7} {name:>11} {seconds:>9.3f} {megapixels / seconds:>7.1f} "
+                f"{len(found_x):>7} {recall:>7.1%} {precision:>9.1%} {error:>10.3f}"
+            )
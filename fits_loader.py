@@ -0,0 +1,277 @@
+import numpy as np
+from astropy.io import fits
+
+# keywords of the scaling of the integers : value = BZERO + BSCALE * stored value
+SCALE_KEYWORDS = ("BZERO", "BSCALE")
+
+
+def native_pixels(hdu, keep_uint16=False):
+    """
+    Return the pixels of a HDU opened with do_not_scale_image_data=True, converted once
+
+    FITS store big-endian data : the arrays of astropy are >f4, >i2... and each
+    calculation on them convert the bytes again. Here the pixels are converted in
+    one pass to a contiguous native-endian float32 array, then BSCALE and BZERO are
+    applied in place (astropy would give a float32 or float64 copy, then normalize_img
+    a float64 copy). The unsigned 16 bits images (BITPIX 16, BZERO 32768, BSCALE 1)
+    can be kept in native uint16 (2 bytes by pixel), the value is exact.
+
+    :param hdu: the HDU, opened with do_not_scale_image_data=True
+    :param keep_uint16: if True, the unsigned 16 bits images stay in uint16
+    :return: data: native float32 (or uint16) array and header: the header without
+        BZERO and BSCALE (the pixels are already scaled)
+    """
+    raw = hdu.data
+    header = hdu.header.copy()
+    bzero = header.get("BZERO", 0)
+    bscale = header.get("BSCALE", 1)
+    for keyword in SCALE_KEYWORDS:
+        header.remove(keyword, ignore_missing=True)
+    if raw is None:
+        return None, header
+
+    if keep_uint16 and raw.dtype.kind == "i" and raw.dtype.itemsize == 2:
+        if bscale == 1 and bzero == 32768:
+            # + 32768 on 16 bits is the inversion of the sign bit
+            data = np.bitwise_xor(
+                raw.view(raw.dtype.byteorder + "u2"), np.uint16(0x8000)
+            )
+            return data.astype(np.uint16, copy=False), header
+
+    return scaled_pixels(raw, bscale, bzero), header
+
+
+def scaled_pixels(raw, bscale=1, bzero=0):
+    """
+    Convert stored pixels to native float32 and apply BSCALE and BZERO in place
+
+    :param raw: pixels as stored in the file (any byte order)
+    :param bscale: BSCALE of the header
+    :param bzero: BZERO of the header
+    :return: native float32 array
+    """
+    # one pass : byte swap and conversion together
+    data = np.array(raw, dtype=np.float32, order="C")
+    if bscale != 1:
+        np.multiply(data, np.float32(bscale), out=data)
+    if bzero != 0:
+        np.add(data, np.float32(bzero), out=data)
+    return data
+
+
+def read_fits(path: str, keep_uint16=False, info=False):
+    """
+    Read the primary HDU of a FITS file as native-endian float32 pixels (see native_pixels)
+
+    :param path: the file's path
+    :param keep_uint16: if True, the unsigned 16 bits images stay in uint16
+    :param info: if True, display the description of the HDUs of the file
+    :return: data: the image and header: file's informations
+    """
+    with fits.open(path, memmap=True, do_not_scale_image_data=True) as hdul:
+        if info:
+            hdul.info()
+        return native_pixels(hdul[0], keep_uint16)
+
+
+class LazyFits:
+    """
+    Lazy access to the primary HDU of a FITS file
+
+    nothing is read when the object is created :
+    - header : only the header is read (no pixels), for the list of files
+    - data : the file is opened with memmap, the pixels are read by the system
+      only when they are used
+    - section : read only a window of the image (tiles, previews)
+
+    astropy can't scale a memory-mapped image : the file is opened without the
+    scaling and the integers with BZERO/BSCALE (uint16 of the cameras) are scaled
+    by section, to float32 like read_fits.
+    """
+
+    def __init__(self, path: str):
+        """Initialize the accessor (the file isn't opened)
+        :param path: the file's path"""
+        self.path = path
+        self._header = None
+        self._hdul = None
+
+    @property
+    def header(self):
+        """Header of the primary HDU, read without the pixels
+        OSError if it isn't a FITS file or if its header is invalid (NAXISn missing...)"""
+        if self._header is None:
+            try:
+                self._header = fits.getheader(self.path)
+            except (KeyError, ValueError) as error:
+                raise OSError(f"invalid FITS header : {error}") from error
+        return self._header
+
+    @property
+    def shape(self):
+        """Shape of the data like numpy (NAXISn in reverse order), from the header"""
+        naxis = self.header.get("NAXIS", 0)
+        return tuple(self.header[f"NAXIS{i}"] for i in range(naxis, 0, -1))
+
+    @property
+    def layout(self):
+        """Position of the color channels, same rules as handler_color_image :
+        "first" for (3, height, width), "last" for (height, width, channels), "mono" else"""
+        shape = self.shape
+        if len(shape) == 3 and shape[0] == 3:
+            return "first"
+        if len(shape) == 3:
+            return "last"
+        return "mono"
+
+    @property
+    def image_shape(self):
+        """(height, width) of the image, OSError if the primary HDU has no image"""
+        shape = self.shape
+        if len(shape) < 2:
+            raise OSError(f"no image in the primary HDU (NAXIS = {len(shape)})")
+        return shape[1:] if self.layout == "first" else shape[:2]
+
+    @property
+    def hdu(self):
+        """Primary HDU, the file is opened with memmap (and without scaling) the first time"""
+        if self._hdul is None:
+            self._hdul = fits.open(self.path, memmap=True, do_not_scale_image_data=True)
+        return self._hdul[0]
+
+    @property
+    def scaled(self):
+        """True if the pixels are stored with BZERO/BSCALE"""
+        return any(keyword in self.header for keyword in SCALE_KEYWORDS)
+
+    def _scale(self, raw):
+        """apply BSCALE and BZERO of the header to stored pixels (nothing if not scaled)"""
+        if not self.scaled:
+            return raw
+        return scaled_pixels(
+            raw, self.header.get("BSCALE", 1), self.header.get("BZERO", 0)
+        )
+
+    @property
+    def data(self):
+        """
+        Data of the primary HDU mapped in memory (read only when used)
+
+        a scaled file is read and converted in float32 at once
+        """
+        return self._scale(self.hdu.data)
+
+    def section(self, y0=None, y1=None, x0=None, x1=None, step=1):
+        """
+        Read a window of the image, as (height, width) or (height, width, channels)
+
+        only the pixels of the window are read in the file
+
+        :param y0, y1, x0, x1: limits of the window (None = border of the image)
+        :param step: take one pixel out of step in each direction (for previews)
+        """
+        rows = slice(y0, y1, step)
+        cols = slice(x0, x1, step)
+        section = self.hdu.section
+        if self.layout == "first":
+            return np.transpose(self._scale(section[:, rows, cols]), (1, 2, 0))
+        if self.layout == "last":
+            return self._scale(section[rows, cols, :])
+        return self._scale(section[rows, cols])
+
+    def thumbnail(self, max_side=512):
+        """
+        Read a reduced image (one pixel out of n) with the longest side near max_side
+
+        :param max_side: longest side wanted in pixels
+        """
+        step = max(1, int(np.ceil(max(self.image_shape) / max_side)))
+        return self.section(step=step)
+
+    def close(self):
+        """Close the file if it was opened"""
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+    import tracemalloc
+
+    import main_p2_origin as p2
+
+    def _old_load(path):
+        """load_fits, normalize_img and convert_in_grey before the native float32 reading
+        (astropy can't scale a memory-mapped image : the scaled files are read without memmap)
+        """
+        scaled = any(keyword in fits.getheader(path) for keyword in SCALE_KEYWORDS)
+        with fits.open(path, memmap=not scaled) as hdul:
+            data = hdul[0].data
+            image = (data - data.min()) / (data.max() - data.min())
+            image = image.astype(np.float32)
+        return image.astype(np.float32)
+
+    def _new_load(path):
+        data, header = read_fits(path)
+        return p2.convert_in_grey(p2.normalize_img(data))
+
+    def _measure(function, path):
+        """time and peak memory of a call"""
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = function(path)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return result, seconds, peak
+
+    side = int(sys.argv[1]) if len(sys.argv) > 1 else 4000
+    rng = np.random.default_rng(0)
+    pixels = rng.gamma(2.0, 1000.0, (side, side))
+    mb = 1024 * 1024
+    print(f"{side}x{side} images ({side * side * 4 / mb:.0f} MB in float32)")
+    print(
+        f"{'storage':>22} {'before (s)':>11} {'peak (MB)':>10} "
+        f"{'after (s)':>10} {'peak (MB)':>10} {'max diff':>9}"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        files = {
+            "float32 (BITPIX -32)": fits.PrimaryHDU(pixels.astype(np.float32)),
+            "uint16 (BZERO 32768)": fits.PrimaryHDU(
+                np.clip(pixels, 0, 65535).astype(np.uint16)
+            ),
+            "int16 BSCALE 0.5": fits.PrimaryHDU(
+                np.clip(pixels - 20000, -32768, 32767).astype(np.int16)
+            ),
+        }
+        files["int16 BSCALE 0.5"].header["BSCALE"] = 0.5
+        for name, hdu in files.items():
+            path = os.path.join(tmp, "image.fits")
+            hdu.writeto(path, overwrite=True)
+            # the file is read once before, to measure the same system cache
+            fits.getdata(path)
+            old, old_time, old_peak = _measure(_old_load, path)
+            new, new_time, new_peak = _measure(_new_load, path)
+            print(
+                f"{name:>22} {old_time:>11.3f} {old_peak / mb:>10.0f} "
+                f"{new_time:>10.3f} {new_peak / mb:>10.0f} "
+                f"{np.abs(old - new).max():>9.1e}"
+            )
+
+        hdu = files["uint16 (BZERO 32768)"]
+        hdu.writeto(path, overwrite=True)
+        data, header = read_fits(path, keep_uint16=True)
+        print(
+            f"\nuint16 kept : {data.dtype}, {data.nbytes / mb:.0f} MB, "
+            f"same values {np.array_equal(data, fits.getdata(path))}"
+        )
@@ -1,51 +1,53 @@
-from astropy.io import fits 
 import matplotlib.pyplot as plt
 import cv2 as cv 
 import numpy as np 
-from photutils.detection import DAOStarFinder
-from astropy.stats import sigma_clipped_stats
 import os
+from run_context import RunContext, resolve_context
+from fits_loader import read_fits
+from normalize import normalize
+from morphology import dilate, erode
+from rasterize import rasterize_stars, source_positions
+from blend import blend
+from detectors import get_detector
+from background import estimate_background
 
 
-DIR_RESULTS_ORIGINAL = './results/original/'
-DIR_RESULTS_MASK = './results/masks/'
-DIR_RESULTS_FINAL = './results/final_image/'
+# default directory of the outputs (subdirectories original, masks, final_image)
+# when no RunContext is given to the functions
+DIR_RESULTS = './results/'
 
 def load_fits(path: str):
     '''
     open and read the FITS file
     take information and close file
+    the pixels are converted once in contiguous native-endian float32, with
+    BZERO and BSCALE applied (see fits_loader.read_fits)
     
     :param path: the image's path
     :type path: str
     :return: data: the image and header: file's informations
     '''
-    hdul = fits.open(path) # Header Data Unit
-    # Display information about the file
+    # Display information about the file, then read the primary HDU
     print()
-    hdul.info()
-    
-    # Access the data from the primary HDU
-    data = hdul[0].data
-    # Access header information
-    header = hdul[0].header
-
-    # Close the file
-    hdul.close()
+    data, header = read_fits(path, info=True)
     
     return data, header
 
-def normalize_img(data):
+def normalize_img(data, bounds=None, out=None, stretch='minmax', memo=False):
     '''
     Normalize the entire image to [0, 1] for matplotlib
     
+    min and max are read in one pass (see normalize.py)
+    
     :param data: the image previously loaded
+    :param bounds: couple (min, max) of the whole image, for normalize a part of it (tile)
+    :param out: float32 array which receive the image (data itself for in place), None for a new array
+    :param stretch: 'minmax' or 'percentile' (the hot pixels don't compress the image), when bounds is None
+    :param memo: if True, the bounds are memorized for data and the result (arrays never modified in place)
     '''
-    image = (data - data.min()) / (data.max() - data.min())
-    image = image.astype(np.float32)
-    return image
+    return normalize(data, bounds, out, stretch, memo=memo)
 
-def handler_color_image(data):
+def handler_color_image(data, save=True, ctx=None, memo=False):
     '''
     Handle both monochrome and color images
     
@@ -54,22 +56,28 @@ def handler_color_image(data):
     In all case, the image is normalized and saved as original in defaults' directory
     
     :param data: Image
+    :param save: if False, the original png isn't written (the GUI display the array directly)
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param memo: if True, the bounds are memorized (see normalize_img)
     return: normalized image
     '''
+    ctx = resolve_context(ctx, DIR_RESULTS)
     if data.ndim == 3:
         # Color image - need to transpose to (height, width, channels)
         if data.shape[0] == 3:  # If channels are first: (3, height, width)
             data = np.transpose(data, (1, 2, 0))
         # If already (height, width, 3), no change needed
         
-        image = normalize_img(data)
+        image = normalize_img(data, memo=memo)
         # Save the data as a png image (no cmap for color images)
-        save_image(DIR_RESULTS_ORIGINAL + 'original.png', image)
+        if save:
+            ctx.save_image('original', 'original.png', image)
         
     else:
         # Monochrome image - no need to transpose anything
-        image = normalize_img(data)
-        save_image(DIR_RESULTS_ORIGINAL + '/original.png', data, cmap='gray')
+        image = normalize_img(data, memo=memo)
+        if save:
+            ctx.save_image('original', 'original.png', data, cmap='gray')
     return image
 
 def save_image(path, data, cmap=None):
@@ -96,16 +104,17 @@ def convert_in_grey(image):
     '''
     if image.ndim == 3:
         # Mean of 3 channels
-        image_gray = np.mean(image, axis=2).astype(np.float32)
+        image_gray = np.mean(image, axis=2).astype(np.float32, copy=False)
     else:
-        image_gray = image.astype(np.float32)
+        image_gray = image.astype(np.float32, copy=False)
     return image_gray
 
-def detect_stars(image_gray, fwhm, threshold, sigma=3.0):
+def detect_stars(image_gray, fwhm, threshold, sigma=3.0, detector="daofind", background="global"):
     '''
-    use DAOStarFinder of library photutils for detect star in the image
+    use DAOStarFinder of library photutils (or another detector) for detect star in the image
     
     calculate with an astronomy's function mean, median and standard deviation
+    (on a sample of the pixels, memorized for the same image, see background.py)
     Then search star and repertory them in an array with mainly columns above:
     xcentroid, ycentroid (source's position)
     
@@ -113,17 +122,14 @@ def detect_stars(image_gray, fwhm, threshold, sigma=3.0):
     :param fwhm: Full Width at Half Maximum = size of star in pixel
     :param threshold: the detection threshold
     :param sigma: std for delete outliers values
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :param background: "global" (one background level) or "mesh" (level by cell, for gradients)
     :return: an array of stars positions
     '''
-    # calculate mean, median (= background level), std (=background noise)
-    mean, median, std = sigma_clipped_stats(image_gray, sigma=sigma)
-
-    daofind = DAOStarFinder(
-        fwhm = fwhm,
-        threshold = threshold * std
-    )
+    # calculate median (= background level), std (=background noise)
+    median, std = estimate_background(image_gray, sigma, background)
 
-    sources = daofind(image_gray - median)
+    sources = find_stars(image_gray, fwhm, threshold, median, std, detector)
     
     print(
     "\n========================== Affichage des paramètres DAOStarFinder : =========================="
@@ -131,11 +137,28 @@ def detect_stars(image_gray, fwhm, threshold, sigma=3.0):
     print("sigma = ", sigma)
     print("fhwm = ", fwhm)
     print("threshold = ", threshold)
+    print("detector = ", detector)
+    print("background = ", background)
     print("nb stars = ", 0 if sources is None else len(sources))
     
     return sources
 
-def star_mask(image_gray, sources):
+def find_stars(image_gray, fwhm, threshold, median, std, detector="daofind"):
+    '''
+    use DAOStarFinder (or another detector) with a background level and noise already calculated
+    
+    :param image_gray: the image converted in grey (or a part of it)
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param median: background level
+    :param std: background noise
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :return: an array of stars positions
+    '''
+    sources = get_detector(detector)(image_gray, fwhm, threshold, median, std)
+    return sources
+
+def star_mask(image_gray, sources, save=True, ctx=None, memo=False):
     '''
     create a matrix for receive values of stars position from sources
     
@@ -145,38 +168,46 @@ def star_mask(image_gray, sources):
     
     :param image_gray: image
     :param sources: the array of stars positions from DAOStarFinder
+    :param save: if False, the overlay isn't created and written
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param memo: if True, the bounds of image_gray are memorized (see normalize_img)
     return: the mask
     '''
+    ctx = resolve_context(ctx, DIR_RESULTS)
     print(
     "\n======================= Affichage des colonnes de sources ====================================="
     )
     print(sources.colnames if sources is not None else print("No sources found")) 
     
-    mask = np.zeros(image_gray.shape, dtype=np.float32)
+    # one pixel by star, the points out of borders are ignored
+    x, y = source_positions(sources)
+    mask = rasterize_stars(image_gray.shape, x, y)
     
-    h, w = image_gray.shape[:2]
+    # the overlay is only calculated if the policy of the run keep it
+    if save and ctx.wants("masks"):
+        overlay = overlay_stars(image_gray, mask, memo)
+        ctx.save_bgr("masks", "overlay_stars.png", overlay)
     
-    for star in sources:
-        x = int(star['xcentroid'])
-        y = int(star['ycentroid'])
-        
-        # ignore if a point is out of borders
-        if 0 <= x < w and 0 <= y < h:
-            mask[y, x] = 1.0
+    return mask
+
+def overlay_stars(image_gray, mask, memo=False):
+    '''
+    create an overlay to visualize stars wich will have a traitment
     
-    # overlay for visualize stars wich will have a traitment
+    :param image_gray: image
+    :param mask: the mask of stars positions
+    :param memo: if True, the bounds of image_gray are memorized (see normalize_img)
+    return: the overlay in BGR uint8 (stars in red)
+    '''
     kernel_for_overlay = np.ones((3,3), np.float32)
     mask_dilate_for_overlay = cv.dilate(mask, kernel_for_overlay)
     # normalize with uint8 for use cvtColor
-    image_gray_uint8 = ((image_gray - image_gray.min()) / (image_gray.max() - image_gray.min()) * 255.0 ).astype(np.uint8)
+    image_gray_uint8 = (normalize_img(image_gray, memo=memo) * 255.0).astype(np.uint8)
     overlay = cv.cvtColor(image_gray_uint8, cv.COLOR_GRAY2BGR)
     overlay[mask_dilate_for_overlay > 0] = [0, 0, 255]  # red color
-    os.makedirs(os.path.dirname(DIR_RESULTS_MASK + "overlay_stars.png"), exist_ok=True)
-    cv.imwrite(DIR_RESULTS_MASK + "overlay_stars.png", overlay)
-    
-    return mask
+    return overlay
 
-def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
+def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3), save=True, ctx=None):
     '''
     Apply a dilation on stars of the mask and apply a gaussian blur
     
@@ -185,11 +216,14 @@ def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
     :param mask: the star mask
     :param kernelDilate: couple of integers who determinate the size of kernel for the dilation of stars before gaussian blur
     :param kernelGaussian: couple of integers who determinate the size of kernel for the gaussian blur
+    :param save: if False, the masks aren't written
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
     '''
+    ctx = resolve_context(ctx, DIR_RESULTS)
     # thickening of the star mask
-    kernel = np.ones(kernelDilate, np.float32)
-    mask_dilate = cv.dilate(mask, kernel)
-    save_image(DIR_RESULTS_MASK + 'mask_stars_dilate.png', mask_dilate, cmap='gray')
+    mask_dilate = dilate(mask, kernelDilate)
+    if save:
+        ctx.save_image('masks', 'mask_stars_dilate.png', mask_dilate, cmap='gray')
 
     # Gaussian blur of the mask
     maskFlouGaussien = cv.GaussianBlur(
@@ -198,7 +232,8 @@ def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
         sigmaX = 0
     )
     maskFlouGaussien = np.clip(maskFlouGaussien, 0.0, 1.0)
-    save_image(DIR_RESULTS_MASK + 'maskFlouGaussien.png', maskFlouGaussien, cmap='gray')
+    if save:
+        ctx.save_image('masks', 'maskFlouGaussien.png', maskFlouGaussien, cmap='gray')
     
     return maskFlouGaussien
 
@@ -210,20 +245,28 @@ def erode_image(image_gray, kernelErode=(2,2), nbIteration=1):
     :param kernelErode: couple of integer who determinate the size of stars to erode
     :param nbIteration: integer number of eroded waves
     '''
-    kernel_erode = np.ones(kernelErode, np.float32)
-    Ierode = cv.erode(image_gray, kernel_erode, iterations=nbIteration)
+    # the iterations are done in one pass (see morphology.erode), same result as cv.erode
+    Ierode = erode(image_gray, kernelErode, nbIteration)
     return Ierode
 
-def combinate_mask_image(mask, imgEroded, image_origin):
+def combinate_mask_image(mask, imgEroded, image_origin, save=True, ctx=None, out=None):
     '''
     Combinate the mask with the erodedImage and the origin image
     
+    final = (mask * imgEroded) + ((1 - mask) * image_origin), calculated by blend
+    in one pass without temporary images
+    
     :param mask: the mask
     :param imgEroded: the eroded image
     :param image_origin: the origin image convert in grey
+    :param save: if False, the final image isn't written (export it later with save_image)
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param out: array which receive the final image, None to allocate it
     '''
-    final_image = (mask * imgEroded) + ((1 - mask) * image_origin)
-    save_image(DIR_RESULTS_FINAL + 'image_finale.png', final_image, cmap='gray')
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    final_image = blend(image_origin, mask, imgEroded, out=out)
+    if save:
+        ctx.save_image('final_image', 'image_finale.png', final_image, cmap='gray')
     return final_image
 
 def display_datatype_check(image_gray, Ierode, final_image):
@@ -242,29 +285,32 @@ def display_datatype_check(image_gray, Ierode, final_image):
 
 if __name__ == "__main__":
     
+    # outputs of this run
+    ctx = RunContext(DIR_RESULTS)
+
     # Load file
     fits_file = './examples/test_M31_linear.fits'
     data, header = load_fits(fits_file)
     
     # Process image
-    image = handler_color_image(data)
+    image = handler_color_image(data, ctx=ctx)
     image_gray = convert_in_grey(image)
-    save_image(DIR_RESULTS_ORIGINAL + 'imageGrey.png', image_gray, cmap='gray')
+    ctx.save_image('original', 'imageGrey.png', image_gray, cmap='gray')
     
     # data stars recovery and creation of mask
     sources = detect_stars(image_gray, fwhm=4.0, threshold=5.0)
-    mask = star_mask(image_gray, sources)
-    save_image(DIR_RESULTS_MASK + 'mask_stars_points.png', mask, cmap='gray')
+    mask = star_mask(image_gray, sources, ctx=ctx)
+    ctx.save_image('masks', 'mask_stars_points.png', mask, cmap='gray')
     
     # Apply Gaussian Blur
-    maskFlouGaussien = mask_effects(mask, (3,3), (3,3))
+    maskFlouGaussien = mask_effects(mask, (3,3), (3,3), ctx=ctx)
     
     # Erode Image
     Ierode = erode_image(image_gray, (2,2), 3)
-    save_image(DIR_RESULTS_FINAL + 'image_erode.png', Ierode, cmap='gray')
+    ctx.save_image('final_image', 'image_erode.png', Ierode, cmap='gray')
     
     # creation final Image
-    final_image = combinate_mask_image(maskFlouGaussien, Ierode, image_gray)
+    final_image = combinate_mask_image(maskFlouGaussien, Ierode, image_gray, ctx=ctx)
 
     display_datatype_check(image_gray, Ierode, final_image)
     
@@ -5,48 +5,57 @@ import numpy as np
 from photutils.detection import DAOStarFinder
 from astropy.stats import sigma_clipped_stats
 import os
-from astroquery.astrometry_net import AstrometryNet
+import tempfile
+from astroquery.astrometry_net import AstrometryNetClass
+from run_context import RunContext, resolve_context
+from fits_loader import read_fits
+from normalize import normalize
+from morphology import dilate, erode
+from rasterize import rasterize_stars, source_positions
+from blend import blend
+from cache import content_hash
+from astrometry_cache import SolveCache, read_corr_sources
 
 
 
-DIR_RESULTS_ORIGINAL = './resultsAPI/original/'
-DIR_RESULTS_MASK = './resultsAPI/masks/'
-DIR_RESULTS_FINAL = './resultsAPI/final_image/'
+# default directory of the outputs (subdirectories original, masks, final_image, sources)
+# when no RunContext is given to the functions
+DIR_RESULTS = './resultsAPI/'
+# address of the Astrometry.net server, can be changed by the environment (local server for tests)
+NOVA_URL = os.environ.get('ASTROMETRY_URL', 'https://nova.astrometry.net')
+# 'image' : upload the whole image, 'sources' : upload only the stars found locally
+API_MODES = ('image', 'sources')
+# number of stars sent in mode 'sources' (the brightest, enough for the solve)
+MAX_UPLOAD_SOURCES = 1000
 
 def load_fits(path: str):
     '''
     open and read the FITS file
     take information and close file
+    the pixels are converted once in contiguous native-endian float32, with
+    BZERO and BSCALE applied (see fits_loader.read_fits)
     
     :param path: the image's path
     :type path: str
     :return: data: the image and header: file's informations
     '''
-    hdul = fits.open(path) # Header Data Unit
-    # Display information about the file
-    hdul.info()
-    
-    # Access the data from the primary HDU
-    data = hdul[0].data
-    # Access header information
-    header = hdul[0].header
-
-    # Close the file
-    hdul.close()
+    # Display information about the file, then read the primary HDU
+    data, header = read_fits(path, info=True)
     
     return data, header
 
-def normalize_img(data):
+def normalize_img(data, out=None):
     '''
     Normalize the entire image to [0, 1] for matplotlib
     
+    min and max are read in one pass (see normalize.py)
+    
     :param data: the image previously loaded
+    :param out: float32 array which receive the image (data itself for in place), None for a new array
     '''
-    image = (data - data.min()) / (data.max() - data.min())
-    image = image.astype(np.float32)
-    return image
+    return normalize(data, out=out)
 
-def handler_color_image(data):
+def handler_color_image(data, ctx=None):
     '''
     Handle both monochrome and color images
     
@@ -55,8 +64,10 @@ def handler_color_image(data):
     In all case, the image is normalized and saved as original in defaults' directory
     
     :param data: Image
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
     return: normalized image
     '''
+    ctx = resolve_context(ctx, DIR_RESULTS)
     if data.ndim == 3:
         # Color image - need to transpose to (height, width, channels)
         if data.shape[0] == 3:  # If channels are first: (3, height, width)
@@ -65,12 +76,12 @@ def handler_color_image(data):
         
         image = normalize_img(data)
         # Save the data as a png image (no cmap for color images)
-        save_image(DIR_RESULTS_ORIGINAL + 'original.png', image)
+        ctx.save_image('original', 'original.png', image)
         
     else:
         # Monochrome image - no need to transpose anything
         image = normalize_img(data)
-        save_image(DIR_RESULTS_ORIGINAL + '/original.png', data, cmap='gray')
+        ctx.save_image('original', 'original.png', data, cmap='gray')
     return image
 
 def save_image(path, data, cmap=None):
@@ -97,67 +108,175 @@ def convert_in_grey(image):
     '''
     if image.ndim == 3:
         # Mean of 3 channels
-        image_gray = np.mean(image, axis=2).astype(np.float32)
+        image_gray = np.mean(image, axis=2).astype(np.float32, copy=False)
     else:
-        image_gray = image.astype(np.float32)
+        image_gray = image.astype(np.float32, copy=False)
     return image_gray
 
-def detect_stars_api(image_gray, header, api_key):
+def nova_client(api_key, base_url=NOVA_URL):
     '''
-    upload image to Astrometry.net for detect stars with plate-solving
-    get back the object catalog (corr.fits) with real stars positions
+    return a client of Astrometry.net on the server asked
     
-    :param image_gray: monochrome image
-    :param header: FITS header with metadata
     :param api_key: Astrometry.net API key
-    :return: sources: table of star positions (xcentroid, ycentroid)
+    :param base_url: address of the Astrometry.net server (a local MockNova for tests)
     '''
-    # Initialization correct
-    ast = AstrometryNet()
+    ast = AstrometryNetClass()
+    ast.URL = base_url
+    ast.API_URL = f'{base_url}/api'
     ast.api_key = api_key
-    
-    temp_fits = "temp_for_api.fits"
-    # Keep the header for the API have hints (RA/DEC if there is)
-    fits.PrimaryHDU(data=image_gray, header=header).writeto(temp_fits, overwrite=True)
-
-    print("Sending image to Astrometry.net")
-    # solve_from_image do everything : upload + wait for job
-    # Get the submission_id for ask detailed results
-    wcs_header, sub_id = ast.solve_from_image(temp_fits,force_image_upload=True,return_submission_id=True,solve_timeout=300) # 5 min max
+    return ast
 
+def download_solution(ast, wcs_header, sub_id):
+    '''
+    download the corr file of a submission solved
+    
+    :param ast: client of Astrometry.net (see nova_client)
+    :param wcs_header: WCS header returned by the solve
+    :param sub_id: id of the submission
+    :return: dict with corr (content of corr.fits), wcs (header), submission_id and job_id
+    '''
     print(f"\nImage ID : {sub_id}")
 
     # Wait for jobs be ready
-    sub_info = ast._request('GET', f'https://nova.astrometry.net/api/submissions/{sub_id}')
+    sub_info = ast._request('GET', f'{ast.API_URL}/submissions/{sub_id}', cache=False)
     jobs = sub_info.json().get('jobs', [])
         
     job_id = jobs[0]
 
     # Download extracted sources (corr.fits file contains X,Y positions)
     # Use direct URL from astrometry.net results
-    source_url = f'https://nova.astrometry.net/corr_file/{job_id}'
-    with ast._request('GET', source_url) as r:
-        with open('detected_sources.fits', 'wb') as f:
-            f.write(r.content)
-        
-        # Read the sources file
-        with fits.open('detected_sources.fits') as hdul:
-            sources_data = hdul[1].data
-            # Transform to Astropy Table for be compatible and hide stars
-            from astropy.table import Table
-            sources = Table(sources_data)
-            
-            # Astrometry.net use field_x and field_y for positions
-            sources.rename_column('field_x', 'xcentroid')
-            sources.rename_column('field_y', 'ycentroid')
-            
-            print(f"{len(sources)} stars extracted with the API")
-        
+    with ast._request('GET', f'{ast.URL}/corr_file/{job_id}', cache=False) as r:
+        corr = r.content
+
+    return {'corr': corr, 'wcs': wcs_header, 'submission_id': sub_id, 'job_id': job_id}
+
+def solve_image(image_gray, header, api_key, base_url=NOVA_URL, solve_timeout=300):
+    '''
+    upload image to Astrometry.net for plate-solving and download the results
+    
+    :param image_gray: monochrome image
+    :param header: FITS header with metadata
+    :param api_key: Astrometry.net API key
+    :param base_url: address of the Astrometry.net server (a local MockNova for tests)
+    :param solve_timeout: maximum time in seconds to wait the solve
+    :return: dict with corr (content of corr.fits), wcs (header), submission_id and job_id
+    '''
+    ast = nova_client(api_key, base_url)
+    
+    # temporary file with an unique name : several runs can upload at the same time
+    fd, temp_fits = tempfile.mkstemp(suffix='.fits', prefix='temp_for_api_')
+    os.close(fd)
+    try:
+        # Keep the header for the API have hints (RA/DEC if there is)
+        fits.PrimaryHDU(data=image_gray, header=header).writeto(temp_fits, overwrite=True)
+
+        print("Sending image to Astrometry.net")
+        # solve_from_image do everything : upload + wait for job
+        # Get the submission_id for ask detailed results
+        wcs_header, sub_id = ast.solve_from_image(temp_fits,force_image_upload=True,return_submission_id=True,solve_timeout=solve_timeout)
+    finally:
         # Clean temporary files
-        if os.path.exists(temp_fits): 
-            os.remove(temp_fits)
+        os.remove(temp_fits)
+
+    return download_solution(ast, wcs_header, sub_id)
+
+def brightest_positions(sources, max_sources=MAX_UPLOAD_SOURCES):
+    '''
+    return the positions of the brightest stars for a solve from a source list
+    
+    :param sources: table of stars positions (xcentroid, ycentroid, flux) from detect_stars
+    :param max_sources: number of stars kept
+    :return: x, y sorted from the brightest star, 1-indexed (FITS convention of Astrometry.net)
+    '''
+    order = np.argsort(-np.asarray(sources['flux']), kind='stable')[:max_sources]
+    x = np.asarray(sources['xcentroid'])[order] + 1
+    y = np.asarray(sources['ycentroid'])[order] + 1
+    return x, y
+
+def solve_source_list(sources, width, height, api_key, base_url=NOVA_URL, solve_timeout=300, max_sources=MAX_UPLOAD_SOURCES):
+    '''
+    send only the positions of the stars found locally to Astrometry.net for plate-solving
+    
+    Astrometry.net read the list from the brightest star, so the stars are sorted
+    by flux and only the max_sources brightest are sent : a few KB instead of the
+    whole image. The positions are sent 1-indexed like the FITS convention.
+    
+    :param sources: table of stars positions (xcentroid, ycentroid, flux) from detect_stars
+    :param width: width of the image
+    :param height: height of the image
+    :param api_key: Astrometry.net API key
+    :param base_url: address of the Astrometry.net server (a local MockNova for tests)
+    :param solve_timeout: maximum time in seconds to wait the solve
+    :param max_sources: number of stars sent
+    :return: dict with corr (content of corr.fits), wcs (header), submission_id and job_id
+    '''
+    ast = nova_client(api_key, base_url)
+    x, y = brightest_positions(sources, max_sources)
+
+    print(f"Sending {len(x)} stars positions to Astrometry.net")
+    wcs_header, sub_id = ast.solve_from_source_list(x, y, width, height, return_submission_id=True, solve_timeout=solve_timeout)
+    return download_solution(ast, wcs_header, sub_id)
+
+def detect_stars_api(image_gray, header, api_key, ctx=None, cache=None, base_url=NOVA_URL, mode='image', fwhm=4.0, threshold=5.0, reference=None):
+    '''
+    get the object catalog (corr.fits) with real stars positions from Astrometry.net
+    
+    the solutions are kept on disk by hash of the pixels (see astrometry_cache.py) :
+    an image already solved is not uploaded again, the sources are read from the cache
+    
+    2 modes for solve an image :
+    - 'image' : upload of the whole image, the stars are found by Astrometry.net
+    - 'sources' : stars found locally with detect_stars, only their positions are sent
+    In both cases the stars of the corr file are returned.
+    With a reference (WcsReference of a frame of the same target already solved),
+    the stars of the reference are projected on the image with the shift measured
+    by a correlation : no upload and no detection. The image is solved only if it
+    doesn't match the reference.
+    
+    :param image_gray: monochrome image
+    :param header: FITS header with metadata
+    :param api_key: Astrometry.net API key
+    :param ctx: RunContext of the run, the catalog is saved in sources/detected_sources.fits
+    :param cache: SolveCache of the solutions (in DIR_SOLVE_CACHE by default)
+    :param base_url: address of the Astrometry.net server (a local MockNova for tests)
+    :param mode: 'image' or 'sources' (see API_MODES)
+    :param fwhm: size of star in pixel for the local detection (mode 'sources')
+    :param threshold: detection threshold of the local detection (mode 'sources')
+    :param reference: WcsReference of the target (see wcs_reuse.py), None to always solve
+    :return: sources: table of star positions (xcentroid, ycentroid)
+    '''
+    if mode not in API_MODES:
+        raise ValueError(f"unknown mode : {mode} (choose in {', '.join(API_MODES)})")
+    if reference is not None:
+        sources = reference.project(image_gray)
+        if sources is not None:
+            print(f"{len(sources)} stars projected with the WCS of the reference")
+            return sources
+        print("The image doesn't match the reference, it is solved")
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    if cache is None:
+        cache = SolveCache()
 
-        return sources
+    key = content_hash(image_gray)
+    solution = cache.get(key)
+    if solution is not None:
+        print(f"Image already solved (submission {solution['submission_id']}), no upload")
+    elif mode == 'sources':
+        local_sources = detect_stars(image_gray, fwhm, threshold)
+        if local_sources is None:
+            raise RuntimeError("No stars found locally, the image can't be solved from a source list")
+        height, width = image_gray.shape[:2]
+        solution = solve_source_list(local_sources, width, height, api_key, base_url)
+        cache.put(key, **solution)
+    else:
+        solution = solve_image(image_gray, header, api_key, base_url)
+        cache.put(key, **solution)
+
+    ctx.save_bytes('sources', 'detected_sources.fits', solution['corr'])
+    # Transform to Astropy Table for be compatible and hide stars
+    sources = read_corr_sources(solution['corr'])
+    print(f"{len(sources)} stars extracted with the API")
+    return sources
     
 def detect_stars(image_gray, fwhm, threshold, sigma=3.0):
     '''
@@ -193,17 +312,14 @@ def star_mask(image_gray, sources, radius=6):
     
     :param image_gray: image
     :param sources: the array of stars positions from DAOStarFinder
+    :param radius: radius of the disc drawn on each star
     return: the mask
     '''
-    mask = np.zeros(image_gray.shape, dtype=np.float32)
+    # a filled disc by star, same pixels as cv.circle
+    x, y = source_positions(sources)
+    return rasterize_stars(image_gray.shape, x, y, radius)
 
-    for star in sources:
-        x = int(star['xcentroid'])
-        y = int(star['ycentroid'])
-        cv.circle(mask, (x, y), radius, 1.0, -1)
-    return mask
-
-def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
+def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3), ctx=None):
     '''
     Apply a dilation on stars of the mask and apply a gaussian blur
     
@@ -212,11 +328,12 @@ def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
     :param mask: the star mask
     :param kernelDilate: couple of integers who determinate the size of kernel for the dilation of stars before gaussian blur
     :param kernelGaussian: couple of integers who determinate the size of kernel for the gaussian blur
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
     '''
+    ctx = resolve_context(ctx, DIR_RESULTS)
     # thickening of the star mask
-    kernel = np.ones(kernelDilate, np.float32)
-    mask_dilate = cv.dilate(mask, kernel)
-    save_image(DIR_RESULTS_MASK + 'mask_stars_dilate.png', mask_dilate, cmap='gray')
+    mask_dilate = dilate(mask, kernelDilate)
+    ctx.save_image('masks', 'mask_stars_dilate.png', mask_dilate, cmap='gray')
 
     # Gaussian blur of the mask
     maskFlouGaussien = cv.GaussianBlur(
@@ -225,7 +342,7 @@ def mask_effects(mask, kernelDilate=(3,3), kernelGaussian=(3,3)):
         sigmaX = 0
     )
     maskFlouGaussien = np.clip(maskFlouGaussien, 0.0, 1.0)
-    save_image(DIR_RESULTS_MASK + 'maskFlouGaussien.png', maskFlouGaussien, cmap='gray')
+    ctx.save_image('masks', 'maskFlouGaussien.png', maskFlouGaussien, cmap='gray')
     
     return maskFlouGaussien
 
@@ -237,32 +354,37 @@ def erode_image(image_gray, kernelErode=(2,2), nbIteration=1):
     :param kernelErode: couple of integer who determinate the size of stars to erode
     :param nbIteration: integer number of eroded waves
     '''
-    kernel_erode = np.ones(kernelErode, np.float32)
-    Ierode = cv.erode(image_gray, kernel_erode, iterations=nbIteration)
+    # the iterations are done in one pass (see morphology.erode), same result as cv.erode
+    Ierode = erode(image_gray, kernelErode, nbIteration)
     return Ierode
 
-def combinate_mask_image(mask, imgEroded, image_origin):
+def combinate_mask_image(mask, imgEroded, image_origin, ctx=None, out=None):
     '''
     Combinate the mask with the erodedImage and the origin image
     
     :param mask: the mask
     :param imgEroded: the eroded image
     :param image_origin: the origin image convert in grey
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param out: array which receive the final image, None to allocate it
     '''
-    final_image = (mask * imgEroded) + ((1 - mask) * image_origin)
-    save_image(DIR_RESULTS_FINAL + 'image_finale.png', final_image, cmap='gray')
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    final_image = blend(image_origin, mask, imgEroded, out=out)
+    ctx.save_image('final_image', 'image_finale.png', final_image, cmap='gray')
     return final_image
 
-def combinate_mask_color(mask, imgEroded, image_color_origin):
+def combinate_mask_color(mask, imgEroded, image_color_origin, ctx=None, out=None):
     '''
     Combinate the mask with the color image to recover colors
+    
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param out: array which receive the final image, None to allocate it
     '''
-    final_color = np.zeros_like(image_color_origin)
-    # Apply to each channel R, G, B
-    for i in range(3):
-        final_color[:,:,i] = (mask * imgEroded) + ((1 - mask) * image_color_origin[:,:,i])
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    # the grey mask and eroded image are applied to each channel R, G, B in one pass
+    final_color = blend(image_color_origin, mask, imgEroded, out=out)
     
-    save_image(DIR_RESULTS_FINAL + 'image_finale_couleur.png', final_color)
+    ctx.save_image('final_image', 'image_finale_couleur.png', final_color)
     return final_color
 
 if __name__ == "__main__":
@@ -275,29 +397,32 @@ if __name__ == "__main__":
     fits_file = './examples/test_M31_linear.fits'
     data, header = load_fits(fits_file)
     
+    # outputs of this run
+    ctx = RunContext(DIR_RESULTS)
+
     # Process image
-    image = handler_color_image(data)
+    image = handler_color_image(data, ctx=ctx)
     image_gray = convert_in_grey(image)
-    save_image(DIR_RESULTS_ORIGINAL + 'imageGrey.png', image_gray, cmap='gray')
+    ctx.save_image('original', 'imageGrey.png', image_gray, cmap='gray')
     
     # data stars recovery with API
     # Use now the API function who handle 3D -> 2D
-    sources = detect_stars_api(image_gray, header, MY_API_KEY)
+    sources = detect_stars_api(image_gray, header, MY_API_KEY, ctx=ctx)
     
     # mask creation based on real catalog data
     mask = star_mask(image_gray, sources, radius=5)
-    save_image(DIR_RESULTS_MASK + 'mask_stars_points.png', mask, cmap='gray')
+    ctx.save_image('masks', 'mask_stars_points.png', mask, cmap='gray')
         
     # Apply Gaussian Blur
-    maskFlouGaussien = mask_effects(mask, (3,3), (3,3))
+    maskFlouGaussien = mask_effects(mask, (3,3), (3,3), ctx=ctx)
         
     # Erode Image
     Ierode = erode_image(image_gray, (2,2), 3)
-    save_image(DIR_RESULTS_FINAL + 'image_erode.png', Ierode, cmap='gray')
+    ctx.save_image('final_image', 'image_erode.png', Ierode, cmap='gray')
         
     # final Image creation
-    final_image = combinate_mask_image(maskFlouGaussien, Ierode, image_gray)
+    final_image = combinate_mask_image(maskFlouGaussien, Ierode, image_gray, ctx=ctx)
 
     if image.ndim == 3:
         # If color image, we use the color combination
-        final_image = combinate_mask_color(maskFlouGaussien, Ierode, image)
\ No newline at end of file
+        final_image = combinate_mask_color(maskFlouGaussien, Ierode, image, ctx=ctx)
\ No newline at end of file
@@ -1,4 +1,3 @@
-from astropy.io import fits
 import matplotlib.pyplot as plt
 import time
 import cv2 as cv
@@ -6,50 +5,51 @@ import numpy as np
 from photutils.detection import DAOStarFinder
 from astropy.stats import sigma_clipped_stats
 import os
+from blend import blend
+from run_context import RunContext, resolve_context
+from fits_loader import read_fits
+from normalize import normalize
+from morphology import dilate
 
 
-DIR_RESULTS_ORIGINAL = "./results/original/"
-DIR_RESULTS_MASK = "./results/masks/"
-DIR_RESULTS_FINAL = "./results/final_image/"
-DIR_RESULTS_COMPARE = "./results/compare/"
+# default directory of the outputs (subdirectories original, masks, final_image, compare)
+# when no RunContext is given to the functions
+DIR_RESULTS = "./results/"
 
 
 def load_fits(path: str):
     """
     open and read the FITS file
     take information and close file
+    the pixels are converted once in contiguous native-endian float32, with
+    BZERO and BSCALE applied (see fits_loader.read_fits)
 
     :param path: the image's path
     :type path: str
     :return: data: the image and header: file's informations
     """
-    hdul = fits.open(path)  # Header Data Unit
-    # Display information about the file
-    hdul.info()
-
-    # Access the data from the primary HDU
-    data = hdul[0].data
-    # Access header information
-    header = hdul[0].header
-
-    # Close the file
-    hdul.close()
+    # Display information about the file, then read the primary HDU
+    data, header = read_fits(path, info=True)
 
     return data, header
 
 
-def normalize_img(data):
+def normalize_img(data, bounds=None, out=None, stretch="minmax", memo=False):
     """
     Normalize the entire image to [0, 1] for matplotlib
 
+    min and max are read in one pass (see normalize.py)
+
     :param data: the image previously loaded
+    :param bounds: couple (min, max) of the whole image, for normalize a tile
+    :param out: float32 array which receive the image (data itself for in place), None for a new array
+    :param stretch: "minmax" or "percentile" (the hot pixels don't compress the image), when bounds is None
+    :param memo: if True, the bounds are memorized for data and the result (arrays never modified in place)
     """
-    image = (data - data.min()) / (data.max() - data.min())
-    image = image.astype(np.float32)
-    return image
+    return normalize(data, bounds, out, stretch, memo=memo)
 
 
-def handler_color_image(data):
+def handler_color_image(data, memo=False):
     """
     Handle both monochrome and color images
 
@@ -58,6 +58,7 @@ def handler_color_image(data):
     In all case, the image is normalized and saved as original in defaults' directory
 
     :param data: Image
+    :param memo: if True, the bounds are memorized (see normalize_img)
     return: normalized image
     """
     if data.ndim == 3:
@@ -66,14 +67,14 @@ def handler_color_image(data):
             data = np.transpose(data, (1, 2, 0))
         # If already (height, width, 3), no change needed
 
-        image = normalize_img(data)
+        image = normalize_img(data, memo=memo)
         # Save the data as a png image (no cmap for color images)
-        # save_image(DIR_RESULTS_ORIGINAL + "original.png", image)
+        # ctx.save_image("original", "original.png", image)
 
     else:
         # Monochrome image - no need to transpose anything
-        image = normalize_img(data)
-        # save_image(DIR_RESULTS_ORIGINAL + "/original.png", image, cmap="gray")
+        image = normalize_img(data, memo=memo)
+        # ctx.save_image("original", "original.png", image, cmap="gray")
     return image
 
 
@@ -89,22 +90,40 @@ def save_image(path, data, cmap=None):
     plt.imsave(path, data, cmap=cmap)
 
 
-def compare_before_after(starless_gray_img, staronly_gray_img, star_reduced_img):
-    """build Before and after images for comparison after
+def reduction_terms(starless_gray_img, staronly_gray_img, mask):
+    """build the two terms of the final image which don't depend on alpha
+
+    final = starless + staronly * (1 - alpha * mask) = before - alpha * stars_masked
+    so with these terms, a change of alpha cost only one multiply-add (see apply_alpha)
 
     params:
         starless_gray_img : image without stars
         staronly_gray_img : image with only stars
-        star_reduced_img : image with reduced stars
+        mask : the star mask (after dilation and blur)
 
     Returns:
-        before : image before reduction
-        after : image after reduction
+        before : image before reduction (starless + staronly)
+        stars_masked : part of the stars removed with alpha = 1 (staronly * mask)
     """
-    before = starless_gray_img + staronly_gray_img
-    after = starless_gray_img + star_reduced_img
+    before = cv.add(starless_gray_img, staronly_gray_img, dtype=cv.CV_32F)
+    stars_masked = cv.multiply(staronly_gray_img, mask, dtype=cv.CV_32F)
+    return before, stars_masked
+
 
-    return before.astype(np.float32), after.astype(np.float32)
+def apply_alpha(before, stars_masked, alpha, out=None):
+    """final image of a reduction factor from the terms of reduction_terms
+
+    params:
+        before : image before reduction
+        stars_masked : part of the stars removed with alpha = 1
+        alpha : reduction factor (0 = no reduction, 1 = full removal)
+        out : array which receive the final image, None to allocate it
+
+    Returns:
+        after : before - alpha * stars_masked (= final image), in one pass
+    """
+    alpha = float(np.clip(alpha, 0.0, 1.0))
+    return cv.scaleAdd(stars_masked, -alpha, before, dst=out)
 
 
 def compare_diff(before_img, after_img):
@@ -123,42 +142,47 @@ def compare_diff(before_img, after_img):
 
 
 def save_diff_img(
-    starless_gray_img,
-    staronly_gray_img,
-    star_reduced_gray_img,
-    out_dir=DIR_RESULTS_COMPARE,
+    before,
+    stars_masked,
+    alpha,
+    ctx=None,
+    stretch="minmax",
+    after=None,
 ):
     """
     Save the comparison images : before, after and difference
 
+    the images come from the terms of reduction_terms (the terms kept by the
+    pipeline for the threshold), after is the final image of apply_alpha
+
     params:
-        starless_gray_img : image without stars
-        staronly_gray_img : image with only stars
-        star_reduced_gray_img : image with reduced stars
-        out_dir : output directory to save images
+        before : image before reduction (starless + staronly)
+        stars_masked : part of the stars removed with alpha = 1 (staronly * mask)
+        alpha : reduction factor (0 = no reduction, 1 = full removal)
+        ctx : RunContext of the run (images in DIR_RESULTS/compare by default)
+        stretch : "minmax" or "percentile" for the display of the images (see normalize.py)
+        after : the final image if it's already calculated
     """
-
-    os.makedirs(out_dir, exist_ok=True)
-    before, after = compare_before_after(
-        starless_gray_img, staronly_gray_img, star_reduced_gray_img
-    )
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    if after is None:
+        after = apply_alpha(before, stars_masked, alpha)
     diff = compare_diff(before, after)
     diff_abs = np.abs(diff).astype(np.float32)
 
+    # the images for display are only calculated if the policy of the run keep them
+    if not ctx.wants("compare"):
+        return before, after, diff_abs
+
     # save images comparison
 
-    before_visu_png = normalize_img(before)
-    after_visu_png = normalize_img(after)
-    diff_abs_visu_png = normalize_img(diff_abs)
+    before_visu_png = normalize_img(before, stretch=stretch)
+    after_visu_png = normalize_img(after, stretch=stretch)
+    diff_abs_visu_png = normalize_img(diff_abs, stretch=stretch)
 
-    save_image(
-        os.path.join(out_dir, "before_reduced.png"), before_visu_png, cmap="gray"
-    )
-    save_image(os.path.join(out_dir, "after_reduced.png"), after_visu_png, cmap="gray")
+    ctx.save_image("compare", "before_reduced.png", before_visu_png, cmap="gray")
+    ctx.save_image("compare", "after_reduced.png", after_visu_png, cmap="gray")
     # absolute because diff can have negative values
-    save_image(
-        os.path.join(out_dir, "diff_abs_between.png"), diff_abs_visu_png, cmap="gray"
-    )
+    ctx.save_image("compare", "diff_abs_between.png", diff_abs_visu_png, cmap="gray")
 
     return before, after, diff_abs
 
@@ -176,26 +200,38 @@ def convert_in_grey(image):
     """
     if image.ndim == 3:
         # Mean of 3 channels
-        image_gray = np.mean(image, axis=2).astype(np.float32)
+        image_gray = np.mean(image, axis=2).astype(np.float32, copy=False)
     else:
-        image_gray = image.astype(np.float32)
+        image_gray = image.astype(np.float32, copy=False)
     return image_gray
 
 
-def mask_from_stars_starnet(stars_img, thresh=0.02):
+def mask_from_stars_starnet(
+    stars_img, thresh=0.02, save=True, bounds=None, ctx=None, index=None
+):
     """
     stars_img : image stars-only (already normalized)
     thresh : threshold to say "here is a star"
+    save : if False, the mask isn't written
+    bounds : (min, max) of the whole grey stars image, when stars_img is a tile
+    ctx : RunContext of the run (outputs in DIR_RESULTS by default)
+    index : StarMaskIndex of stars_img (see starnet_index.py), the image is
+        already normalized in it and only compared to the threshold
     """
-    if stars_img.ndim == 3:
-        stars_gray = np.mean(stars_img, axis=2).astype(np.float32)
+    ctx = resolve_context(ctx, DIR_RESULTS)
+    if index is not None:
+        mask = index.mask(thresh)
     else:
-        stars_gray = stars_img.astype(np.float32)
+        if stars_img.ndim == 3:
+            stars_gray = np.mean(stars_img, axis=2).astype(np.float32, copy=False)
+        else:
+            stars_gray = stars_img.astype(np.float32, copy=False)
 
-    normalize = normalize_img(stars_gray)
-    mask = (normalize > thresh).astype(np.float32)
+        normalize = normalize_img(stars_gray, bounds)
+        mask = (normalize > thresh).astype(np.float32)
 
-    save_image(DIR_RESULTS_MASK + "mask_stars_thresh.png", mask, cmap="gray")
+    if save:
+        ctx.save_image("masks", "mask_stars_thresh.png", mask, cmap="gray")
 
     return mask
 
@@ -240,7 +276,14 @@ def blink_image(before, after, delay=1, n=5):
             break
 
 
-def mask_effects(mask, kernelDilate=(3, 3), kernelGaussian=(3, 3), iterations=1):
+def mask_effects(
+    mask,
+    kernelDilate=(3, 3),
+    kernelGaussian=(3, 3),
+    iterations=1,
+    save=True,
+    ctx=None,
+):
     """
     apply a dilation on stars of the mask and apply a gaussian blur
 
@@ -250,51 +293,64 @@ def mask_effects(mask, kernelDilate=(3, 3), kernelGaussian=(3, 3), iterations=1)
     :param kernelDilate: couple of integers who determinate the size of kernel for the dilation of stars before gaussian blur
     :param kernelGaussian: couple of integers who determinate the size of kernel for the gaussian blur
     :param iterations: number of iterations for dilation
+    :param save: if False, the masks aren't written
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
     """
+    ctx = resolve_context(ctx, DIR_RESULTS)
     # thickening of the star mask
-    kernel = np.ones(kernelDilate, np.float32)
-    mask_dilate = cv.dilate(mask, kernel, iterations=iterations)
-    save_image(DIR_RESULTS_MASK + "mask_stars_dilate.png", mask_dilate, cmap="gray")
+    mask_dilate = dilate(mask, kernelDilate, iterations)
+    if save:
+        ctx.save_image("masks", "mask_stars_dilate.png", mask_dilate, cmap="gray")
 
     # Gaussian blur of the mask
     maskFlouGaussien = cv.GaussianBlur(mask_dilate, ksize=kernelGaussian, sigmaX=0)
     maskFlouGaussien = np.clip(maskFlouGaussien, 0.0, 1.0)
-    save_image(DIR_RESULTS_MASK + "star_blurred.png", maskFlouGaussien, cmap="gray")
+    if save:
+        ctx.save_image("masks", "star_blurred.png", maskFlouGaussien, cmap="gray")
 
     return maskFlouGaussien
 
 
-def reduce_stars(stars_img, mask, alpha=0.8):
+def reduce_stars(stars_img, mask, alpha=0.8, save=True, ctx=None, out=None):
     """
     Reduce stars in the star image using the mask
 
     :param stars_img: the star-only image
     :param mask: the mask
     :param alpha: reduction factor (0 = no reduction, 1 = full removal)
+    :param save: if False, the reduced stars image isn't written
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
+    :param out: array which receive the reduced image, None to allocate it
     """
+    ctx = resolve_context(ctx, DIR_RESULTS)
 
     # alpha in 0 and 1
     alpha = float(np.clip(alpha, 0.0, 1.0))
-    # apply reduction
-    star_reduced = stars_img * (1 - alpha * mask)
-    save_image(DIR_RESULTS_MASK + "star_reduced.png", star_reduced, cmap="gray")
+    # apply reduction : stars_img * (1 - alpha * mask) in one pass
+    star_reduced = blend(stars_img, mask, None, alpha, out=out)
+    if save:
+        ctx.save_image("masks", "star_reduced.png", star_reduced, cmap="gray")
     return star_reduced
 
 
-def combinate_mask_image(image_starless, image_starreduced):
+def combinate_mask_image(image_starless, image_starreduced, save=True, ctx=None):
     """
     Combinate the mask with the erodedImage and the origin image
 
     :param mask: the mask
     :param imgEroded: the eroded image
     :param image_origin: the origin image convert in grey
+    :param save: if False, the final image isn't written (export it later with save_image)
+    :param ctx: RunContext of the run (outputs in DIR_RESULTS by default)
     """
+    ctx = resolve_context(ctx, DIR_RESULTS)
     final_image = image_starless + image_starreduced
-    save_image(
-        DIR_RESULTS_FINAL + "final_combined_phase3.png", final_image, cmap="gray"
-    )
+    if save:
+        ctx.save_image(
+            "final_image", "final_combined_phase3.png", final_image, cmap="gray"
+        )
     # final_fit = fits.writeto(
-    #     DIR_RESULTS_FINAL + "final_combined_phase3.fits",
+    #     ctx.path("final_image", "final_combined_phase3.fits"),
     #     final_image,
     #     header_starless,
     #     overwrite=True,
@@ -312,6 +368,9 @@ if __name__ == "__main__":
     We reduce the staronly picture with the mask
     Wee combine the starless picture and the reduced staronly picture to obtain a final
     """
+    # outputs of this run
+    ctx = RunContext(DIR_RESULTS)
+
     # Load starless file and starfile
     starless_file = "star_reduction/starless_test_M31_linear.fit"
     staronly_file = "star_reduction/starmask_test_M31_linear.fit"
@@ -325,30 +384,32 @@ if __name__ == "__main__":
     staronly = handler_color_image(data_staronly)
 
     # Save original images loaded
-    save_image(DIR_RESULTS_ORIGINAL + "starless.png", starless)
-    save_image(DIR_RESULTS_ORIGINAL + "staronly.png", staronly)
+    ctx.save_image("original", "starless.png", starless)
+    ctx.save_image("original", "staronly.png", staronly)
 
     # Convert in grey
     staronly_gray = convert_in_grey(staronly)
     starless_file_gray = convert_in_grey(starless)
 
     # Create mask from staronly image
-    mask = mask_from_stars_starnet(staronly_gray, thresh=0.05)
+    mask = mask_from_stars_starnet(staronly_gray, thresh=0.05, ctx=ctx)
 
     # Apply Gaussian Blur
-    maskFlouGaussien = mask_effects(mask, (3, 3), (3, 3), iterations=1)
+    maskFlouGaussien = mask_effects(mask, (3, 3), (3, 3), iterations=1, ctx=ctx)
 
     # Reduce staronly image with the mask and alpha factor
-    star_reduced = reduce_stars(staronly_gray, maskFlouGaussien, alpha=0.8)
+    star_reduced = reduce_stars(staronly_gray, maskFlouGaussien, alpha=0.8, ctx=ctx)
 
-    before, after, diff_abs = save_diff_img(
-        starless_file_gray, staronly_gray, star_reduced
+    # before / after / difference from the terms which don't depend on alpha
+    before, stars_masked = reduction_terms(
+        starless_file_gray, staronly_gray, maskFlouGaussien
     )
+    before, after, diff_abs = save_diff_img(before, stars_masked, 0.8, ctx=ctx)
 
     blink = blink_image(before, after, delay=0.5, n=10)
 
     # Combine starless image and reduced staronly image
-    final, final_fit = combinate_mask_image(starless_file_gray, star_reduced)
+    final, final_fit = combinate_mask_image(starless_file_gray, star_reduced, ctx=ctx)
 
     # Debug datatype
     print("============= check of datatype ===================")
@@ -0,0 +1,273 @@
+import io
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from astropy.io import fits
+from astropy.wcs import WCS
+
+
+def corr_bytes(x, y, header=None):
+    """
+    Build a corr.fits file like the one of Astrometry.net
+
+    :param x: x positions of the stars
+    :param y: y positions of the stars
+    :param header: WCS header, to add the world coordinates (index_ra, index_dec)
+    :return: content of the file (bytes)
+    """
+    x = np.asarray(x, float)
+    y = np.asarray(y, float)
+    columns = [
+        fits.Column(name="field_x", format="D", array=x),
+        fits.Column(name="field_y", format="D", array=y),
+        fits.Column(name="index_x", format="D", array=x),
+        fits.Column(name="index_y", format="D", array=y),
+    ]
+    if header is not None:
+        ra, dec = WCS(header).all_pix2world(x, y, 1)
+        columns.append(fits.Column(name="index_ra", format="D", array=ra))
+        columns.append(fits.Column(name="index_dec", format="D", array=dec))
+    table = fits.BinTableHDU.from_columns(columns)
+    buffer = io.BytesIO()
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(buffer)
+    return buffer.getvalue()
+
+
+def wcs_header(width=1000, height=1000):
+    """A simple TAN solution centered on the image (for the wcs_file endpoint)"""
+    header = fits.Header()
+    header["WCSAXES"] = 2
+    header["CTYPE1"] = "RA---TAN"
+    header["CTYPE2"] = "DEC--TAN"
+    header["CRPIX1"] = width / 2
+    header["CRPIX2"] = height / 2
+    header["CRVAL1"] = 10.68
+    header["CRVAL2"] = 41.27
+    header["CD1_1"] = -0.0003
+    header["CD1_2"] = 0.0
+    header["CD2_1"] = 0.0
+    header["CD2_2"] = 0.0003
+    header["IMAGEW"] = width
+    header["IMAGEH"] = height
+    return header
+
+
+class MockNova:
+    """
+    Local stand-in for the endpoints of nova.astrometry.net used by the project
+
+    a HTTP server on 127.0.0.1 (random port) in a thread, which answer like
+    Astrometry.net : login, upload (image or source list), state of the submission
+    and of the job, WCS file and corr file. Every solve succeeds with the stars
+    given to the constructor, solve_delay seconds after the upload (before, the
+    submission has no job, then the job is "solving"). The paths of the requests
+    are kept in requests, to check that a run used the network or not, and the
+    number of TCP connections in connections (keep-alive of HTTP/1.1 is supported).
+    Use url as the base URL of the API functions (base_url parameter).
+    """
+
+    def __init__(self, x=(), y=(), width=1000, height=1000, solve_delay=0.0):
+        """Start the server
+        :param x: x positions of the stars of the corr file
+        :param y: y positions of the stars of the corr file
+        :param width: width of the image for the WCS header
+        :param height: height of the image for the WCS header
+        :param solve_delay: time in seconds of a solve"""
+        header = wcs_header(width, height)
+        self.corr = corr_bytes(x, y, header)
+        self.wcs = header.tostring()
+        self.solve_delay = solve_delay
+        self.requests = []
+        self.uploads = []
+        self.connections = 0
+        self._submissions = 0
+        self._start_times = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _new_submission(self, path, body):
+        with self._lock:
+            self._submissions += 1
+            self.uploads.append((path, body))
+            self._start_times[self._submissions] = time.monotonic()
+            return self._submissions
+
+    def _elapsed(self, submission_id):
+        """time since the upload of a submission (None if unknown)"""
+        start = self._start_times.get(submission_id)
+        return None if start is None else time.monotonic() - start
+
+    def _handler(self):
+        nova = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with nova._lock:
+                    nova.connections += 1
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, body, content_type="application/json"):
+                if isinstance(body, dict):
+                    body = json.dumps(body)
+                if isinstance(body, str):
+                    body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                nova.requests.append(("POST", self.path))
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.path == "/api/login":
+                    self._send({"status": "success", "session": "mock-session"})
+                elif self.path in ("/api/upload", "/api/url_upload"):
+                    subid = nova._new_submission(self.path, body)
+                    self._send({"status": "success", "subid": subid})
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                nova.requests.append(("GET", self.path))
+                submission = re.fullmatch(r"/api/submissions/(\d+)", self.path)
+                job = re.fullmatch(r"/api/jobs/(\d+)/info", self.path)
+                if submission:
+                    # one job by submission, with the same number,
+                    # created at the half of the solve
+                    subid = int(submission.group(1))
+                    elapsed = nova._elapsed(subid)
+                    if elapsed is None:
+                        self.send_error(404)
+                        return
+                    started = elapsed >= nova.solve_delay / 2
+                    self._send(
+                        {
+                            "jobs": [subid] if started else [],
+                            "processing_finished": elapsed >= nova.solve_delay,
+                        }
+                    )
+                elif job:
+                    elapsed = nova._elapsed(int(job.group(1)))
+                    if elapsed is None:
+                        self.send_error(404)
+                        return
+                    done = elapsed >= nova.solve_delay
+                    self._send({"status": "success" if done else "solving"})
+                elif re.fullmatch(r"/wcs_file/\d+", self.path):
+                    self._send(nova.wcs, "application/octet-stream")
+                elif re.fullmatch(r"/corr_file/\d+", self.path):
+                    self._send(nova.corr, "application/octet-stream")
+                else:
+                    self.send_error(404)
+
+        return Handler
+
+    def close(self):
+        """Stop the server"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    import asyncio
+    import contextlib
+    import io
+    import os
+    import tempfile
+
+    import main_p3_API as api
+    import solve_batch
+    from astrometry_cache import SolveCache
+    from detectors import synthetic_field
+    from run_context import RunContext
+
+    # solves of a synthetic image against the local server : upload of the image,
+    # upload of the source list, then a second run read from the cache of the solutions
+    shape = (2048, 2048)
+    image_gray, x, y, amplitude = synthetic_field(shape, 2000, 4.0)
+    print(f"synthetic image {shape[1]}x{shape[0]} float32, 2000 stars")
+    print(
+        f"{'run':>14} {'time (s)':>9} {'uploaded (KB)':>14} {'requests':>9} {'stars':>6}"
+    )
+    with tempfile.TemporaryDirectory() as tmp, MockNova(x, y, *shape[::-1]) as nova:
+        ctx = RunContext(os.path.join(tmp, "results"), artifacts="none")
+        runs = [
+            ("image", "image", "cache_image"),
+            ("sources", "sources", "cache_sources"),
+            ("sources again", "sources", "cache_sources"),
+        ]
+        for name, mode, cache_dir in runs:
+            cache = SolveCache(os.path.join(tmp, cache_dir))
+            requests, uploads = len(nova.requests), len(nova.uploads)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                sources = api.detect_stars_api(
+                    image_gray, fits.Header(), "mock-key", ctx, cache, nova.url, mode
+                )
+            seconds = time.perf_counter() - start
+            uploaded = sum(len(body) for _, body in nova.uploads[uploads:])
+            print(
+                f"{name:>14} {seconds:>9.3f} {uploaded / 1024:>14.1f} "
+                f"{len(nova.requests) - requests:>9} {len(sources):>6}"
+            )
+
+    # a night of frames : one after the other with detect_stars_api (astroquery),
+    # then with the async solver (4 frames in flight, one pool of connections)
+    nb_frames, delay = 8, 3.0
+    print(f"\n{nb_frames} frames 512x512, solve of {delay} s on the server")
+    with tempfile.TemporaryDirectory() as tmp, MockNova(x, y, 512, 512, delay) as nova:
+        paths = []
+        for i in range(nb_frames):
+            frame, *_ = synthetic_field((512, 512), 100, 4.0, seed=i + 1)
+            paths.append(os.path.join(tmp, f"frame_{i}.fits"))
+            fits.PrimaryHDU(frame).writeto(paths[-1])
+
+        ctx = RunContext(artifacts="none")
+        cache = SolveCache(os.path.join(tmp, "cache_sync"))
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for path in paths:
+                image_gray, header = solve_batch.load_frame(path)
+                api.detect_stars_api(
+                    image_gray, header, "mock-key", ctx, cache, nova.url
+                )
+        sync_time = time.perf_counter() - start
+        sync_connections = nova.connections
+        print(f"{'sequential':>10} : {sync_time:.1f} s, {sync_connections} connections")
+
+        async def solve_all():
+            cache = SolveCache(os.path.join(tmp, "cache_async"))
+            async for result in solve_batch.solve_frames(
+                paths, "mock-key", nova.url, cache, max_in_flight=4
+            ):
+                assert "error" not in result, result["error"]
+
+        start = time.perf_counter()
+        asyncio.run(solve_all())
+        print(
+            f"{'async':>10} : {time.perf_counter() - start:.1f} s, "
+            f"{nova.connections - sync_connections} connections"
+        )
@@ -0,0 +1,325 @@
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+from background import SAMPLE_STRIDE
+from blend import BLOCK_BYTES
+
+# minmax : the whole range of the image, percentile : the range between two
+# percentiles, a few hot pixels (or a saturated star) don't compress the rest
+STRETCHES = ("minmax", "percentile")
+# percentiles of the percentile stretch
+LOW_PERCENTILE = 0.1
+HIGH_PERCENTILE = 99.9
+# bins of the histogram of the sample (for the percentiles)
+HISTOGRAM_BINS = 65536
+# bounds kept for the last arrays
+MEMO_ENTRIES = 64
+
+# types read by cv.minMaxLoc
+_CV_TYPES = {np.uint8, np.int8, np.uint16, np.int16, np.int32, np.float32, np.float64}
+
+
+class _BoundsMemo:
+    """
+    Bounds already calculated, by array (not by content : an array is identified
+    by its object, its buffer and its layout, without reading the pixels)
+
+    an entry is removed when its array is deleted. A change of the pixels in place
+    isn't seen : the memo is only used when the caller ask it (memo=True), for
+    arrays which are never modified, like the arrays kept by the pipeline.
+    An array used as out is forgotten by normalize.
+    """
+
+    def __init__(self, max_entries=MEMO_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # id -> (weak reference, layout, {kind: bounds})
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _layout(array):
+        return (
+            array.__array_interface__["data"][0],
+            array.shape,
+            array.strides,
+            array.dtype.str,
+        )
+
+    def get(self, array, kind):
+        with self._lock:
+            entry = self._entries.get(id(array))
+            if entry is None or entry[0]() is not array:
+                return None
+            if entry[1] != self._layout(array):
+                return None
+            self._entries.move_to_end(id(array))
+            return entry[2].get(kind)
+
+    def put(self, array, kind, bounds):
+        key = id(array)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0]() is not array:
+                ref = weakref.ref(array, lambda _, key=key: self._drop(key))
+                entry = (ref, self._layout(array), {})
+                self._entries[key] = entry
+            entry[2][kind] = bounds
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return bounds
+
+    def _drop(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is None:
+                del self._entries[key]
+
+    def forget(self, array):
+        with self._lock:
+            self._entries.pop(id(array), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_memo = _BoundsMemo()
+
+
+def min_max(data, memo=False):
+    """
+    Return (min, max) of an array in one pass
+
+    cv.minMaxLoc read the pixels once (numpy min() then max() read them twice),
+    for the contiguous native arrays of the types of OpenCV, the others use numpy.
+
+    :param data: the image (any shape)
+    :param memo: if True, the bounds are memorized for the array (an array never
+        modified in place, see _BoundsMemo)
+    :return: (min, max) with the type of the pixels of data
+    """
+    if memo:
+        bounds = _memo.get(data, "minmax")
+        if bounds is not None:
+            return bounds
+    if (
+        data.size > 0
+        and data.dtype.type in _CV_TYPES
+        and data.dtype.isnative
+        and data.flags.c_contiguous
+    ):
+        # a single channel 2D view of the pixels, without copy
+        lo, hi, _, _ = cv.minMaxLoc(data.reshape(data.shape[0], -1))
+        bounds = (data.dtype.type(lo), data.dtype.type(hi))
+    else:
+        bounds = (data.min(), data.max())
+    return _memo.put(data, "minmax", bounds) if memo else bounds
+
+
+def _rank_value(sample, rank, lo, hi, bins, upper):
+    """
+    value of rank in the sample from a histogram in [lo, hi], refined once by a
+    second histogram in the bin of the rank (a hot pixel make the first bins wide)
+
+    :param upper: if True the right edge of the bin is returned, else the left edge
+    """
+    below = 0  # values of the sample under lo
+    for _ in range(2):
+        counts, edges = np.histogram(sample, bins=bins, range=(lo, hi))
+        cumulative = below + np.cumsum(counts)
+        b = min(np.searchsorted(cumulative, rank, side="right"), bins - 1)
+        if b > 0:
+            below = cumulative[b - 1]
+        lo, hi = float(edges[b]), float(edges[b + 1])
+        # the values of the bin of the rank (the last bin contains its right edge)
+        inside = sample < hi if b < bins - 1 else sample <= hi
+        sample = sample[(sample >= lo) & inside]
+        # a bin narrower than the precision of float32 can't be divided again
+        if sample.size == 0 or hi - lo <= bins * np.spacing(
+            np.float32(max(abs(lo), abs(hi)))
+        ):
+            break
+    return np.float32(hi if upper else lo)
+
+
+def percentile_bounds(
+    data,
+    low=LOW_PERCENTILE,
+    high=HIGH_PERCENTILE,
+    stride=SAMPLE_STRIDE,
+    bins=HISTOGRAM_BINS,
+    memo=False,
+):
+    """
+    Return the values of two percentiles of an image, from the histogram of a sample
+
+    one pixel out of stride in each direction is read (see background.sample_pixels).
+    Each percentile is read in the cumulative histogram of the sample, then in a
+    second histogram of the bin found : a hot pixel which widen the first bins
+    don't change the precision. The low bound is the left edge of its bin and the
+    high bound the right edge, so the range is never smaller than the percentiles
+    of the sample. Memorized for the array with memo, like min_max.
+
+    :param data: the image (2D, or 3D with the channels at the end)
+    :param low: low percentile (0 = min)
+    :param high: high percentile (100 = max)
+    :param stride: step between two pixels of the sample
+    :param bins: number of bins of the histograms
+    :param memo: if True, the bounds are memorized for the array (see min_max)
+    :return: (low value, high value)
+    """
+    kind = ("percentile", low, high, stride, bins)
+    if memo:
+        bounds = _memo.get(data, kind)
+        if bounds is not None:
+            return bounds
+    sample = np.ascontiguousarray(data[::stride, ::stride], dtype=np.float32).ravel()
+    lo, hi = min_max(sample)
+    if lo == hi:
+        bounds = (lo, hi)
+    else:
+        lo, hi = float(lo), float(hi)
+        bounds = (
+            _rank_value(sample, low / 100.0 * sample.size, lo, hi, bins, upper=False),
+            _rank_value(sample, high / 100.0 * sample.size, lo, hi, bins, upper=True),
+        )
+    return _memo.put(data, kind, bounds) if memo else bounds
+
+
+def image_bounds(data, stretch="minmax", memo=False):
+    """
+    Return the bounds used to normalize an image
+
+    :param data: the image
+    :param stretch: "minmax" (whole range) or "percentile" (see percentile_bounds)
+    :param memo: if True, the bounds are memorized for the array (see min_max)
+    :return: (min, max)
+    """
+    if stretch == "minmax":
+        return min_max(data, memo)
+    if stretch == "percentile":
+        return percentile_bounds(data, memo=memo)
+    raise ValueError(f"unknown stretch : {stretch} (choose in {', '.join(STRETCHES)})")
+
+
+def normalize(
+    data,
+    bounds=None,
+    out=None,
+    stretch="minmax",
+    block_bytes=BLOCK_BYTES,
+    memo=False,
+):
+    """
+    Normalize an image to [0, 1] in float32 : (data - min) / (max - min)
+
+    the same values as the formula (calculated in float32), by blocks of rows :
+    each block is subtracted and divided while it's in the cache of the CPU,
+    and the result is written directly in out. With out=data (float32), the
+    image is normalized in place without any new array.
+    With a percentile stretch, the values out of the bounds are clipped to 0 and 1.
+
+    :param data: the image (any shape)
+    :param bounds: couple (min, max) to use (the bounds of the whole image for a tile),
+        None to calculate them
+    :param out: float32 array which receive the result (can be data), None to allocate it
+    :param stretch: "minmax" or "percentile", when bounds is None
+    :param block_bytes: size of a block of rows in bytes
+    :param memo: if True, the bounds of data are memorized (see min_max) and the
+        result is recorded with the bounds (0, 1) : data and the result must not
+        be modified in place after the call
+    :return: the normalized image
+    """
+    exact = memo and bounds is None and stretch == "minmax"
+    if bounds is None:
+        bounds = image_bounds(data, stretch, memo)
+    data_min, data_max = bounds
+    # like the pixels : converted to float32, then subtracted (no overflow of the integers)
+    span = np.float32(data_max) - np.float32(data_min)
+    if span == 0:
+        # constant image : everything at 0 instead of NaN
+        span = np.float32(1)
+        exact = False
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    else:
+        _memo.forget(out)
+
+    clip = stretch == "percentile"
+    rows = max(1, block_bytes // max(1, data[:1].size * 4))
+    for start in range(0, data.shape[0], rows):
+        part = out[start : start + rows]
+        np.subtract(data[start : start + rows], data_min, out=part, dtype=np.float32)
+        np.divide(part, span, out=part)
+        if clip:
+            np.clip(part, 0.0, 1.0, out=part)
+    if exact:
+        # min and max of the result are exactly 0 and (max - min) / span = 1 :
+        # normalizing it again (grey image of a mono image) read nothing
+        _memo.put(out, "minmax", (np.float32(0), np.float32(1)))
+    return out
+
+
+def clear_memo():
+    """Forget the bounds already calculated"""
+    _memo.clear()
+
+
+if __name__ == "__main__":
+    import sys
+
+    def _formula(data):
+        """normalize_img before the engine"""
+        image = (data - data.min()) / (data.max() - data.min())
+        return image.astype(np.float32)
+
+    def _timed(function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    shape = tuple(int(v) for v in sys.argv[1:3]) or (6000, 8400)
+    rng = np.random.default_rng(0)
+    image = rng.gamma(2.0, 0.01, shape).astype(np.float32)
+    print(f"{shape[1]}x{shape[0]} float32 ({image.nbytes / 1024**2:.0f} MB)")
+
+    reference, formula_time = _timed(_formula, image)
+    clear_memo()
+    _, minmax_time = _timed(min_max, image)
+    _, numpy_time = _timed(lambda d: (d.min(), d.max()), image)
+    clear_memo()
+    result, first_time = _timed(normalize, image, memo=True)
+    _, memo_time = _timed(normalize, image, memo=True)
+    out = np.empty_like(image)
+    _, out_time = _timed(normalize, image, out=out, memo=True)
+    _, again_time = _timed(normalize, result, out=out, memo=True)
+    copy = image.copy()
+    _, inplace_time = _timed(normalize, copy, out=copy)
+    print(f"{'formula (min, max, 2 arrays, astype)':>38} : {formula_time:.3f} s")
+    print(f"{'min/max numpy (2 passes)':>38} : {numpy_time:.3f} s")
+    print(f"{'min/max cv.minMaxLoc (1 pass)':>38} : {minmax_time:.3f} s")
+    print(f"{'normalize, first call':>38} : {first_time:.3f} s")
+    print(f"{'normalize, bounds memorized':>38} : {memo_time:.3f} s")
+    print(f"{'normalize, memorized + out':>38} : {out_time:.3f} s")
+    print(f"{'normalize of the normalized image':>38} : {again_time:.3f} s")
+    print(f"{'normalize in place':>38} : {inplace_time:.3f} s")
+    print(f"{'same values as the formula':>38} : {np.array_equal(reference, result)}")
+
+    # a hot pixel : the min/max stretch compress all the image in a few levels
+    hot = image.copy()
+    hot[shape[0] // 2, shape[1] // 2] = 1000.0
+    bounds, percentile_time = _timed(percentile_bounds, hot)
+    exact = np.percentile(hot, [LOW_PERCENTILE, HIGH_PERCENTILE])
+    print(f"\nwith a hot pixel at 1000 (median {np.median(image[::16, ::16]):.4f})")
+    print(
+        f"  percentile bounds from the sample : {bounds[0]:.5f} {bounds[1]:.5f} "
+        f"in {percentile_time:.3f} s (exact percentiles {exact[0]:.5f} {exact[1]:.5f})"
+    )
+    for stretch in STRETCHES:
+        levels = np.unique((normalize(hot, stretch=stretch) * 255).astype(np.uint8))
+        print(f"  {stretch:>10} : {len(levels)} grey levels used out of 256")
@@ -1,10 +1,10 @@
-from astropy.io import fits 
 import matplotlib.pyplot as plt
 import cv2 as cv 
 import numpy as np 
 from photutils.detection import DAOStarFinder
 from astropy.stats import sigma_clipped_stats
 import os
+from fits_loader import read_fits
 
 
 DIR_RESULTS_ORIGINAL = './results/original/'
@@ -15,23 +15,16 @@ def load_fits(path: str):
     '''
     open and read the FITS file
     take information and close file
+    the pixels are converted once in contiguous native-endian float32, with
+    BZERO and BSCALE applied (see fits_loader.read_fits)
     
     :param path: the image's path
     :type path: str
     :return: data: the image and header: file's informations
     '''
-    hdul = fits.open(path) # Header Data Unit
-    # Display information about the file
+    # Display information about the file, then read the primary HDU
     print()
-    hdul.info()
-    
-    # Access the data from the primary HDU
-    data = hdul[0].data
-    # Access header information
-    header = hdul[0].header
-
-    # Close the file
-    hdul.close()
+    data, header = read_fits(path, info=True)
     
     return data, header
 
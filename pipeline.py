@@ -0,0 +1,350 @@
+import cv2 as cv
+
+import main_p2_origin as p2
+import main_p3_starnet as p3
+import sparse
+from cache import StageCache, file_key
+from catalog import THRESHOLD_MIN, DetectionCatalog
+from starnet_index import StarMaskIndex
+
+
+# longest side of the pyramid level used for the quick preview
+PREVIEW_MAX_SIDE = 512
+
+
+def load_standard(cache: StageCache, path: str):
+    """
+    Load the FITS file, normalize it and convert it in grey, only if it's not in cache
+
+    :param cache: the cache of the stages
+    :param path: the FITS file's path
+    :return: key of the stage, the normalized image and the grey image
+    """
+    key = ("load",) + file_key(path)
+    loaded = cache.get(key)
+    if loaded is None:
+        data, header = p2.load_fits(path)
+        image = p2.handler_color_image(data, save=False, memo=True)
+        image_gray = p2.convert_in_grey(image)
+        loaded = cache.put(key, (image, image_gray))
+    image, image_gray = loaded
+    return key, image, image_gray
+
+
+def preview_level(shape, max_side=PREVIEW_MAX_SIDE):
+    """
+    Return the first level of the pyramid where the image is smaller than max_side
+
+    :param shape: shape of the full resolution image
+    :param max_side: longest side wanted in pixels
+    :return: the level (0 = full resolution, each level divide the size by 2)
+    """
+    h, w = shape[:2]
+    level = 0
+    while max(h, w) > max_side:
+        h = (h + 1) // 2
+        w = (w + 1) // 2
+        level += 1
+    return level
+
+
+def load_level(cache: StageCache, path: str, level: int):
+    """
+    Return the grey image at a level of the pyramid (reduced with cv.pyrDown)
+
+    :param cache: the cache of the stages
+    :param path: the FITS file's path
+    :param level: level of the pyramid (0 = full resolution)
+    :return: key of the stage and the grey image at this level
+    """
+    key, image, image_gray = load_standard(cache, path)
+    if level == 0:
+        return key, image_gray
+
+    key_level = key + ("pyramid", level)
+    image_level = cache.get(key_level)
+    if image_level is None:
+        _, image_up = load_level(cache, path, level - 1)
+        image_level = cache.put(key_level, cv.pyrDown(image_up))
+    return key_level, image_level
+
+
+def load_catalog(cache: StageCache, key_load, image_gray, fwhm, threshold, workers=1):
+    """
+    Return the catalog of the stars of an image for a fwhm which contains a threshold
+
+    a new catalog is built at the threshold asked (a detection at the lowest
+    threshold cost several times more), it answers all the higher thresholds.
+    A lower threshold build it again, until extend_catalog lower it to the
+    minimum of the slider in the background.
+
+    :param cache: the cache of the stages
+    :param key_load: key of the stage which load the image
+    :param image_gray: the grey image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param workers: number of processes of the detection, 1 = in the thread of the
+        caller (the GUI worker don't start a pool of processes at each image)
+    """
+    key = key_load + ("catalog", fwhm)
+    catalog = cache.get(key)
+    if catalog is None or threshold < catalog.min_threshold:
+        catalog = cache.put(
+            key, DetectionCatalog(image_gray, fwhm, threshold, workers=workers)
+        )
+    return catalog
+
+
+def extend_catalog(cache: StageCache, path: str, fwhm, min_threshold=THRESHOLD_MIN):
+    """
+    Lower the catalog of the full resolution image to the minimum of the slider
+
+    called by the GUI after a result, in a thread of its own : the next moves of
+    the threshold slider only filter the catalog. Nothing is done if the catalog
+    already contains min_threshold.
+
+    :param cache: the cache of the stages
+    :param path: the FITS file's path
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param min_threshold: lowest threshold of the catalog
+    """
+    key_load, _, image_gray = load_standard(cache, path)
+    load_catalog(cache, key_load, image_gray, fwhm, min_threshold)
+
+
+def cached_star_count(cache: StageCache, path: str, fwhm, threshold):
+    """
+    Return the number of stars of a threshold at once, if the catalog of the
+    full resolution image is already in cache and contains the threshold (None else)
+
+    :param cache: the cache of the stages
+    :param path: the FITS file's path
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    """
+    catalog = cache.get(("load",) + file_key(path) + ("catalog", fwhm))
+    if catalog is None or threshold < catalog.min_threshold:
+        return None
+    return catalog.count(threshold)
+
+
+def process_standard(
+    cache: StageCache,
+    path: str,
+    fwhm,
+    threshold,
+    erode_kernel,
+    nb_iter,
+    preview=False,
+):
+    """
+    Calculate the final image of the standard model (phase 2) with a cache by stage
+
+    - load : depends only on the file
+    - catalog : stars detection, depends on fwhm (see catalog.DetectionCatalog and
+      load_catalog), each threshold above the one of the catalog only filter it
+    - detect : stars of the threshold, mask and blur of the mask
+    the erosion and the combination are always calculated, only around the stars
+    (see sparse.reduce_stars_sparse). So moving the erosion sliders don't reload
+    the file and don't detect stars again.
+
+    With preview, all the stages are done on a reduced level of the pyramid
+    (see preview_level) with fwhm and erosion kernel divided by the same factor,
+    for a quick result while the sliders are moved.
+
+    :param cache: the cache of the stages
+    :param path: the FITS file's path
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param erode_kernel: size of the erosion kernel
+    :param nb_iter: number of erosion iterations
+    :param preview: if True, calculate on a reduced image
+    :return: dict with the results or None if no stars are found
+    """
+    key_load, image, image_gray = load_standard(cache, path)
+
+    level = preview_level(image_gray.shape) if preview else 0
+    if level > 0:
+        key_load, image_gray = load_level(cache, path, level)
+        image = None
+        # sizes in pixels follow the reduction of the image
+        factor = 2**level
+        fwhm = fwhm / factor
+        erode_kernel = max(1, round(erode_kernel / factor))
+
+    key_detect = key_load + ("detect", fwhm, threshold)
+    detected = cache.get(key_detect)
+    if detected is None:
+        catalog = load_catalog(cache, key_load, image_gray, fwhm, threshold)
+        sources = catalog.select(threshold)
+        if sources is None:
+            mask, mask_blur = None, None
+        else:
+            mask = p2.star_mask(image_gray, sources, save=False)
+            mask_blur = p2.mask_effects(mask, (3, 3), (3, 3), save=False)
+        detected = cache.put(key_detect, (sources, mask, mask_blur))
+    sources, mask, mask_blur = detected
+
+    # avoid errors if source is None
+    if sources is None:
+        return None
+
+    final_image = sparse.reduce_stars_sparse(
+        image_gray, sources, erode_kernel, nb_iter, mask_blur=mask_blur
+    )
+
+    # nothing is written on disk : the GUI display the arrays and export on demand
+    return {
+        "image": image,
+        "image_gray": image_gray,
+        "sources": sources,
+        "nb_stars": len(sources),
+        "mask_points": mask,
+        "mask": mask_blur,
+        "final": final_image,
+        "level": level,
+    }
+
+
+def thumbnail(image, max_side=PREVIEW_MAX_SIDE):
+    """
+    Reduce an image (grey or color) so that its longest side is at most max_side
+
+    :param image: the image
+    :param max_side: longest side wanted in pixels
+    :return: the reduced image (the image itself if it's already smaller)
+    """
+    h, w = image.shape[:2]
+    scale = max_side / max(h, w)
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(w * scale)), max(1, round(h * scale)))
+    return cv.resize(image, size, interpolation=cv.INTER_AREA)
+
+
+def load_starnet(cache: StageCache, starless_path: str, staronly_path: str):
+    """
+    Load the starless and staronly files, normalize them and convert them in grey,
+    then index the staronly image for the thresholds, only if it's not in cache
+
+    the color images are only kept as thumbnails (for the GUI)
+
+    :param cache: the cache of the stages
+    :param starless_path: the starless FITS file's path
+    :param staronly_path: the staronly FITS file's path
+    :return: key of the stage, the grey starless and staronly images, the
+        StarMaskIndex of the staronly image and the thumbnails (starless, staronly)
+    """
+    key = ("starnet",) + file_key(starless_path) + file_key(staronly_path)
+    loaded = cache.get(key)
+    if loaded is None:
+        # Load starless and apply handler_color_image for normalization
+        data_starless, header_starless = p3.load_fits(starless_path)
+        starless = p3.handler_color_image(data_starless, memo=True)
+
+        # Load staronly and apply handler_color_image for normalization
+        data_staronly, header_staronly = p3.load_fits(staronly_path)
+        staronly = p3.handler_color_image(data_staronly, memo=True)
+
+        # Convert in grey
+        staronly_gray = p3.convert_in_grey(staronly)
+        starless_gray = p3.convert_in_grey(starless)
+        index = StarMaskIndex(staronly_gray, memo=True)
+        thumbnails = (thumbnail(starless), thumbnail(staronly))
+        loaded = cache.put(key, (starless_gray, staronly_gray, index, thumbnails))
+    starless_gray, staronly_gray, index, thumbnails = loaded
+    return key, starless_gray, staronly_gray, index, thumbnails
+
+
+def cached_starnet_count(
+    cache: StageCache, starless_path: str, staronly_path: str, thresh
+):
+    """
+    Return the number of masked pixels of a threshold at once,
+    if the staronly image is already indexed (None else)
+
+    :param cache: the cache of the stages
+    :param starless_path: the starless FITS file's path
+    :param staronly_path: the staronly FITS file's path
+    :param thresh: threshold to say "here is a star" in the staronly image
+    """
+    loaded = cache.get(("starnet",) + file_key(starless_path) + file_key(staronly_path))
+    if loaded is None:
+        return None
+    return loaded[2].count(thresh)
+
+
+def process_starnet(
+    starless_path: str, staronly_path: str, thresh, alpha, ctx=None, cache=None
+):
+    """
+    Calculate the final image of the starnet model (phase 3)
+
+    with a cache, the files are loaded and the staronly image is normalized and
+    indexed once (see starnet_index.StarMaskIndex) : moving the threshold slider
+    only compare the indexed image to the threshold.
+    The final image is linear in alpha : before (starless + staronly) and
+    stars_masked (staronly * mask) are kept by threshold, and moving the alpha
+    slider only calculate before - alpha * stars_masked.
+
+    :param starless_path: the starless FITS file's path
+    :param staronly_path: the staronly FITS file's path
+    :param thresh: threshold to say "here is a star" in the staronly image
+    :param alpha: reduction factor (0 = no reduction, 1 = full removal)
+    :param ctx: RunContext which receive the intermediate images (none are written if None)
+    :param cache: the cache of the stages (None : the files are loaded for this call only)
+    :return: dict with the results
+    """
+    # the GUI display the arrays, the images are only written for a context
+    save = ctx is not None
+    coeff_dilate = (3, 3)
+    coeff_gauss = (3, 3)
+
+    if cache is None:
+        cache = StageCache()
+    key_load, starless_file_gray, staronly_gray, index, _ = load_starnet(
+        cache, starless_path, staronly_path
+    )
+
+    # the mask and the terms of the final image depend on the threshold, not on alpha
+    key_terms = key_load + ("terms", thresh, coeff_dilate, coeff_gauss)
+    terms = cache.get(key_terms)
+    if terms is None or (save and ctx.wants("masks")):
+        # the masks are calculated again when they are written, the terms aren't
+        # Create mask from staronly image
+        mask = p3.mask_from_stars_starnet(
+            staronly_gray, thresh, save=save, ctx=ctx, index=index
+        )
+
+        # Apply Gaussian Blur
+        maskFlouGaussien = p3.mask_effects(
+            mask, coeff_dilate, coeff_gauss, iterations=1, save=save, ctx=ctx
+        )
+    if terms is None:
+        before, stars_masked = p3.reduction_terms(
+            starless_file_gray, staronly_gray, maskFlouGaussien
+        )
+        terms = cache.put(
+            key_terms,
+            (maskFlouGaussien, before, stars_masked, index.components(thresh, mask)),
+        )
+    maskFlouGaussien, before, stars_masked, nb_stars = terms
+
+    if save:
+        # the reduced stars image is only written for a context
+        p3.reduce_stars(staronly_gray, maskFlouGaussien, alpha, save=save, ctx=ctx)
+
+    # after = starless + reduced stars = before - alpha * stars_masked : one multiply-add
+    final = p3.apply_alpha(before, stars_masked, alpha)
+    if save:
+        # before / after / difference of the run, from the same terms
+        p3.save_diff_img(before, stars_masked, alpha, ctx=ctx, after=final)
+
+    return {
+        "mask": maskFlouGaussien,
+        "nb_pixels": index.count(thresh),
+        "nb_stars": nb_stars,
+        "before": before,
+        "after": final,
+        "final": final,
+    }
@@ -0,0 +1,235 @@
+import time
+
+import cv2 as cv
+import numpy as np
+
+# number of stars drawn together (limit the memory of the index arrays)
+CHUNK_STARS = 65536
+# the discs are drawn by dilation when stars x pixels of a disc x DILATE_RATIO > pixels of the mask
+DILATE_RATIO = 10
+
+
+def source_positions(sources):
+    """
+    Return the positions of the stars as two arrays (without loop on the rows of the table)
+
+    :param sources: table with the columns xcentroid and ycentroid (or None)
+    :return: (x, y) arrays of float64
+    """
+    if sources is None or len(sources) == 0:
+        return np.empty(0), np.empty(0)
+    x = np.asarray(sources["xcentroid"], dtype=np.float64)
+    y = np.asarray(sources["ycentroid"], dtype=np.float64)
+    return x, y
+
+
+def disc_stamp(radius):
+    """
+    Return the pixels of a filled disc drawn by cv.circle, as offsets from its center
+
+    the stamp is the same for every integer center, so drawing the offsets around
+    each star give exactly the same mask as cv.circle(mask, (x, y), radius, 1.0, -1)
+
+    :param radius: radius of the disc in pixels
+    :return: (dy, dx) arrays of offsets
+    """
+    size = 2 * radius + 1
+    stamp = np.zeros((size, size), dtype=np.uint8)
+    cv.circle(stamp, (radius, radius), radius, 1, -1)
+    dy, dx = np.nonzero(stamp)
+    return dy - radius, dx - radius
+
+
+def _scatter(mask, x, y, dy, dx, value=1.0):
+    """set value at (y + dy, x + dx) for all the stars and offsets inside the mask"""
+    h, w = mask.shape[:2]
+    for start in range(0, len(x), CHUNK_STARS):
+        yy = (y[start : start + CHUNK_STARS, None] + dy[None, :]).ravel()
+        xx = (x[start : start + CHUNK_STARS, None] + dx[None, :]).ravel()
+        inside = (xx >= 0) & (xx < w) & (yy >= 0) & (yy < h)
+        mask[yy[inside], xx[inside]] = value
+
+
+def _dilate_points(mask, x, y, radius):
+    """
+    draw the discs by a dilation of the centers with the stamp of cv.circle as kernel
+
+    the centers are put on a canvas with a border of radius pixels, so the discs
+    of the stars a little out of the image are drawn too. Faster than _scatter
+    when there are a lot of stars.
+    """
+    h, w = mask.shape[:2]
+    canvas = np.zeros((h + 2 * radius, w + 2 * radius), dtype=np.uint8)
+    _scatter(
+        canvas, x + radius, y + radius, np.zeros(1, np.intp), np.zeros(1, np.intp), 1
+    )
+    size = 2 * radius + 1
+    kernel = np.zeros((size, size), dtype=np.uint8)
+    cv.circle(kernel, (radius, radius), radius, 1, -1)
+    discs = cv.dilate(canvas, kernel)[radius : radius + h, radius : radius + w]
+    mask[discs > 0] = 1.0
+
+
+def _rasterize_antialias(mask, x, y, radius):
+    """
+    draw the stars with a coverage of the pixels at sub-pixel position
+
+    the center of the pixel (i, j) is at x = j, y = i (convention of DAOStarFinder).
+    A point (radius 0) is split on its 4 neighbour pixels (bilinear weights),
+    a disc cover a pixel with clip(radius + 0.5 - distance, 0, 1).
+    Overlapping stars keep the maximum value.
+    """
+    h, w = mask.shape[:2]
+    flat = mask.reshape(-1)
+    reach = int(np.ceil(radius.max())) + 1
+    offsets = np.arange(-reach, reach + 1)
+    dy, dx = np.meshgrid(offsets, offsets, indexing="ij")
+    dy, dx = dy.ravel(), dx.ravel()
+    for start in range(0, len(x), CHUNK_STARS):
+        xs = x[start : start + CHUNK_STARS, None]
+        ys = y[start : start + CHUNK_STARS, None]
+        rs = radius[start : start + CHUNK_STARS, None]
+        # pixel nearest to the center, then the window around it
+        xx = np.rint(xs).astype(np.intp) + dx[None, :]
+        yy = np.rint(ys).astype(np.intp) + dy[None, :]
+        ax = np.abs(xx - xs)
+        ay = np.abs(yy - ys)
+        point = np.clip(1.0 - ax, 0, 1) * np.clip(1.0 - ay, 0, 1)
+        disc = np.clip(rs + 0.5 - np.hypot(ax, ay), 0, 1)
+        value = np.where(rs > 0, disc, point).astype(np.float32).ravel()
+        xx, yy = xx.ravel(), yy.ravel()
+        keep = (value > 0) & (xx >= 0) & (xx < w) & (yy >= 0) & (yy < h)
+        np.maximum.at(flat, yy[keep] * w + xx[keep], value[keep])
+
+
+def rasterize_stars(shape, x, y, radius=0, antialias=False, out=None):
+    """
+    Draw the stars in a mask (1 on the stars, 0 elsewhere) with numpy operations
+
+    - radius 0 : one pixel by star, like the loop of star_mask in phase 2
+    - radius > 0 : filled disc, same pixels as cv.circle(mask, (x, y), radius, 1.0, -1)
+    - array of radius : one radius by star (mixed 0 and discs allowed)
+    Without antialias the positions are truncated with int() like the loops.
+
+    :param shape: shape of the mask (height, width)
+    :param x: array of x positions
+    :param y: array of y positions
+    :param radius: radius in pixels, a number or an array with one value by star
+    :param antialias: if True, the border of the stars get a sub-pixel coverage (0 to 1)
+    :param out: float32 array which receive the mask (filled with 0 before), None to allocate it
+    :return: the mask in float32
+    """
+    if out is None:
+        mask = np.zeros(shape[:2], dtype=np.float32)
+    else:
+        mask = out
+        mask[...] = 0
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    radius = np.broadcast_to(np.asarray(radius), x.shape)
+    valid = np.isfinite(x) & np.isfinite(y)
+    if not valid.all():
+        x, y, radius = x[valid], y[valid], radius[valid]
+    if len(x) == 0:
+        return mask
+
+    if antialias:
+        _rasterize_antialias(mask, x, y, radius.astype(np.float64))
+        return mask
+
+    # int() of the loops : truncation toward 0
+    xi = x.astype(np.intp)
+    yi = y.astype(np.intp)
+    radius = radius.astype(np.intp)
+    for r in np.unique(radius):
+        same = radius == r
+        dy, dx = disc_stamp(int(r))
+        # the writes of _scatter are about 10 times slower than the pixels of a dilation
+        if r > 0 and np.count_nonzero(same) * len(dy) * DILATE_RATIO > mask.size:
+            _dilate_points(mask, xi[same], yi[same], int(r))
+        else:
+            _scatter(mask, xi[same], yi[same], dy, dx)
+    return mask
+
+
+def _loop_points(shape, x, y):
+    """loop of star_mask in phase 2 (reference of the benchmark)"""
+    mask = np.zeros(shape, dtype=np.float32)
+    h, w = shape
+    for star_x, star_y in zip(x, y):
+        xi = int(star_x)
+        yi = int(star_y)
+        if 0 <= xi < w and 0 <= yi < h:
+            mask[yi, xi] = 1.0
+    return mask
+
+
+def _loop_discs(shape, x, y, radius):
+    """loop of star_mask in the API version (reference of the benchmark)"""
+    mask = np.zeros(shape, dtype=np.float32)
+    for star_x, star_y in zip(x, y):
+        cv.circle(mask, (int(star_x), int(star_y)), radius, 1.0, -1)
+    return mask
+
+
+if __name__ == "__main__":
+    from astropy.table import Table
+
+    shape = (4000, 4000)
+    rng = np.random.default_rng(0)
+    print(f"image {shape[1]}x{shape[0]}")
+    print(
+        f"{'stars':>8} {'mode':>8} {'loop (s)':>10} {'numpy (s)':>10} {'speedup':>8} equal"
+    )
+    for nb_stars in (1000, 10000, 50000):
+        # stars a little out of the borders too, like the centroids of DAOStarFinder
+        sources = Table()
+        sources["xcentroid"] = rng.uniform(-5, shape[1] + 5, nb_stars)
+        sources["ycentroid"] = rng.uniform(-5, shape[0] + 5, nb_stars)
+
+        # the loops read the table row by row, like star_mask
+        start = time.perf_counter()
+        rows = [(star["xcentroid"], star["ycentroid"]) for star in sources]
+        loop_x, loop_y = zip(*rows)
+        reference = _loop_points(shape, loop_x, loop_y)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        x, y = source_positions(sources)
+        mask = rasterize_stars(shape, x, y)
+        numpy_time = time.perf_counter() - start
+        print(
+            f"{nb_stars:>8} {'point':>8} {loop_time:>10.3f} {numpy_time:>10.3f} "
+            f"{loop_time / numpy_time:>7.1f}x {np.array_equal(mask, reference)}"
+        )
+
+        start = time.perf_counter()
+        rows = [(star["xcentroid"], star["ycentroid"]) for star in sources]
+        loop_x, loop_y = zip(*rows)
+        reference = _loop_discs(shape, loop_x, loop_y, 6)
+        loop_time = time.perf_counter() - start
+        start = time.perf_counter()
+        x, y = source_positions(sources)
+        mask = rasterize_stars(shape, x, y, radius=6)
+        numpy_time = time.perf_counter() - start
+        print(
+            f"{nb_stars:>8} {'disc 6':>8} {loop_time:>10.3f} {numpy_time:>10.3f} "
+            f"{loop_time / numpy_time:>7.1f}x {np.array_equal(mask, reference)}"
+        )
+
+    # one radius by star (from 0 to 10) and anti-aliasing
+    radius = rng.integers(0, 11, len(x))
+    start = time.perf_counter()
+    reference = np.zeros(shape, dtype=np.float32)
+    for star_x, star_y, r in zip(x, y, radius):
+        cv.circle(reference, (int(star_x), int(star_y)), int(r), 1.0, -1)
+    loop_time = time.perf_counter() - start
+    start = time.perf_counter()
+    mask = rasterize_stars(shape, x, y, radius)
+    numpy_time = time.perf_counter() - start
+    print(
+        f"{len(x):>8} {'radius':>8} {loop_time:>10.3f} {numpy_time:>10.3f} "
+        f"{loop_time / numpy_time:>7.1f}x {np.array_equal(mask, reference)}"
+    )
+    start = time.perf_counter()
+    rasterize_stars(shape, x, y, radius=6, antialias=True)
+    print(f"{len(x):>8} {'disc aa':>8} {'':>10} {time.perf_counter() - start:>10.3f}")
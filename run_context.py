@@ -0,0 +1,210 @@
+import os
+import queue
+import threading
+
+import cv2 as cv
+import matplotlib.pyplot as plt
+
+# policies of the intermediate images (artifacts) :
+# none = nothing is written, final = only the final images, all = every image,
+# sampled = every image for one run out of SAMPLE_EVERY, only the final images for the others
+ARTIFACT_POLICIES = ("none", "final", "all", "sampled")
+# subdirectory of the final images, kept by the policy "final"
+FINAL_SUBDIR = "final_image"
+SAMPLE_EVERY = 10
+
+
+def run_artifacts(policy, index, sample_every=SAMPLE_EVERY):
+    """
+    Return the policy of one run (the policy "sampled" become "all" or "final")
+
+    :param policy: one of ARTIFACT_POLICIES
+    :param index: number of the run (0, 1, 2...)
+    :param sample_every: one run out of sample_every keep all its images
+    """
+    if policy not in ARTIFACT_POLICIES:
+        raise ValueError(f"unknown artifact policy : {policy}")
+    if policy != "sampled":
+        return policy
+    return "all" if index % sample_every == 0 else "final"
+
+
+class ArtifactWriter:
+    """
+    Write the images in a background thread
+
+    the compression of the PNG is long, with a writer the stages only put the
+    image in a queue and continue their calculations. The arrays given to the
+    writer must not be modified after.
+    flush() wait for all the writes and raise the first error of the thread.
+    """
+
+    def __init__(self):
+        """Initialize the writer and start its thread"""
+        self._queue = queue.Queue()
+        self._errors = []
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        """loop of the thread : call the write functions of the queue"""
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            function, args = job
+            try:
+                function(*args)
+            except Exception as error:
+                self._errors.append(error)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, function, *args):
+        """Add a write in the queue
+        :param function: the function which write the file
+        :param args: arguments of the function"""
+        self._queue.put((function, args))
+
+    def flush(self):
+        """Wait for all the writes of the queue"""
+        self._queue.join()
+        if self._errors:
+            error = self._errors[0]
+            self._errors.clear()
+            raise error
+
+    def close(self):
+        """Write the last images and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RunContext:
+    """
+    Outputs of one run of the pipeline
+
+    each run has its own context, so several pipelines can run at the same time
+    (threads or processes) without writing in the same files :
+    - with out_dir, the images are written in out_dir/<subdir>/<name>
+      (subdirs of the scripts : original, masks, final_image, compare)
+    - without out_dir, the images are only kept in memory in outputs
+    artifacts choose the images kept (none, final or all, see run_artifacts for sampled)
+    and with a writer the files are written in the background.
+    """
+
+    def __init__(self, out_dir=None, artifacts="all", writer=None):
+        """Initialize the context
+        :param out_dir: directory of the outputs, None to keep them in memory
+        :param artifacts: "none", "final" or "all"
+        :param writer: ArtifactWriter for write in the background, None to write directly
+        """
+        if artifacts not in ("none", "final", "all"):
+            raise ValueError(
+                f"artifact policy of a run must be none, final or all : {artifacts}"
+            )
+        self.out_dir = out_dir
+        self.artifacts = artifacts
+        self.writer = writer
+        self.outputs = {}
+
+    def wants(self, subdir):
+        """Say if the images of a subdirectory are kept by the policy
+        :param subdir: subdirectory of the output"""
+        if self.artifacts == "all":
+            return True
+        return self.artifacts == "final" and subdir == FINAL_SUBDIR
+
+    def _write(self, subdir, name, data, function, *args):
+        """keep the output in memory or write it (in the background with a writer)"""
+        if not self.wants(subdir):
+            return None
+        path = self.path(subdir, name)
+        if path is None:
+            self.outputs[os.path.join(subdir, name)] = data
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.writer is None:
+            function(path, *args)
+        else:
+            self.writer.submit(function, path, *args)
+        return path
+
+    def path(self, subdir, name):
+        """Return the path of an output (None if the context is in memory)
+        :param subdir: subdirectory of the output (masks, final_image...)
+        :param name: file's name"""
+        if self.out_dir is None:
+            return None
+        return os.path.join(self.out_dir, subdir, name)
+
+    def get(self, subdir, name):
+        """Return an output kept in memory
+        :param subdir: subdirectory of the output
+        :param name: file's name"""
+        return self.outputs.get(os.path.join(subdir, name))
+
+    def save_image(self, subdir, name, data, cmap=None):
+        """
+        Save an image of the run with an option color
+
+        :param subdir: subdirectory of the output (masks, final_image...)
+        :param name: file's name
+        :param data: the image to save
+        :param cmap: the option color. for example : cmap='gray'
+        :return: the path of the file (None if the context is in memory or the image isn't kept)
+        """
+        return self._write(subdir, name, data, _imsave, data, cmap)
+
+    def save_bgr(self, subdir, name, image):
+        """
+        Save an image in BGR uint8 (OpenCV order) of the run
+
+        :param subdir: subdirectory of the output
+        :param name: file's name
+        :param image: the image to save
+        :return: the path of the file (None if the context is in memory or the image isn't kept)
+        """
+        return self._write(subdir, name, image, cv.imwrite, image)
+
+    def save_bytes(self, subdir, name, content):
+        """
+        Save a file received as bytes (catalog downloaded from an API for example)
+
+        :param subdir: subdirectory of the output
+        :param name: file's name
+        :param content: the bytes of the file
+        :return: the path of the file (None if the context is in memory or the file isn't kept)
+        """
+        return self._write(subdir, name, content, _write_bytes, content)
+
+
+def _imsave(path, data, cmap):
+    """write an image with matplotlib"""
+    plt.imsave(path, data, cmap=cmap)
+
+
+def _write_bytes(path, content):
+    """write bytes in a file"""
+    with open(path, "wb") as f:
+        f.write(content)
+
+
+def resolve_context(ctx, default_dir):
+    """
+    Return the context of the run, or a context on the default directory of a script
+
+    :param ctx: RunContext given by the caller or None
+    :param default_dir: directory of the outputs when no context is given
+    """
+    if ctx is None:
+        return RunContext(default_dir)
+    return ctx
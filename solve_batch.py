@@ -0,0 +1,368 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from astropy.io import fits
+from astroquery.astrometry_net import AstrometryNetClass
+from requests.adapters import HTTPAdapter
+
+import main_p3_API as api
+from astrometry_cache import DIR_SOLVE_CACHE, SolveCache, read_corr_sources
+from batch import find_inputs
+from cache import content_hash
+from fits_loader import read_fits
+from run_context import RunContext
+
+DIR_RESULTS_SOLVE = "./resultsAPI/solve_batch/"
+# submissions waiting for Astrometry.net at the same time
+MAX_IN_FLIGHT = 4
+# polling of the state of a submission : first wait, factor between two waits, longest wait
+POLL_START = 1.0
+POLL_FACTOR = 1.5
+POLL_MAX = 15.0
+# maximum time in seconds of the solve of a frame
+SOLVE_TIMEOUT = 300
+# maximum time in seconds of one HTTP request
+REQUEST_TIMEOUT = 120
+
+
+class NovaSession:
+    """
+    Client of the API of Astrometry.net with one pool of HTTP connections
+
+    all the frames share the same requests.Session (the connections are kept open
+    between the requests) and the same login. The methods are blocking, solve_frames
+    call them in threads.
+    """
+
+    def __init__(self, api_key, base_url=api.NOVA_URL, pool_size=2 * MAX_IN_FLIGHT):
+        """Open the pool of connections
+        :param api_key: Astrometry.net API key
+        :param base_url: address of the Astrometry.net server (a local MockNova for tests)
+        :param pool_size: maximum number of connections kept open"""
+        self.api_key = api_key
+        self.url = base_url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._session_id = None
+        self._lock = threading.Lock()
+
+    def _post(self, path, settings, files=None):
+        response = self.session.post(
+            f"{self.url}/api/{path}",
+            data={"request-json": json.dumps(settings)},
+            files=files,
+            timeout=REQUEST_TIMEOUT,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    def _get(self, path):
+        response = self.session.get(f"{self.url}/{path}", timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    def login(self):
+        """Return the session id of Astrometry.net, the login is done once"""
+        with self._lock:
+            if self._session_id is None:
+                result = self._post("login", {"apikey": self.api_key})
+                if result.get("status") != "success":
+                    raise RuntimeError("Unable to log in to astrometry.net")
+                self._session_id = result["session"]
+            return self._session_id
+
+    def _settings(self):
+        # default settings of astroquery (licence, visibility...)
+        settings = {
+            k: v
+            for k, v in AstrometryNetClass().empty_settings.items()
+            if v is not None
+        }
+        settings["session"] = self.login()
+        return settings
+
+    def upload_image(self, image_gray, header):
+        """
+        Upload an image, return the id of the submission
+
+        :param image_gray: monochrome image
+        :param header: FITS header with metadata (hints for the solve)
+        """
+        buffer = io.BytesIO()
+        fits.PrimaryHDU(data=image_gray, header=header).writeto(buffer)
+        files = {"file": ("image.fits", buffer.getvalue())}
+        return self._post("upload", self._settings(), files)["subid"]
+
+    def upload_sources(self, x, y, width, height):
+        """
+        Upload a list of stars positions (1-indexed, brightest first), return the id of the submission
+
+        :param x: x positions
+        :param y: y positions
+        :param width: width of the image
+        :param height: height of the image
+        """
+        settings = self._settings()
+        settings["x"] = [float(v) for v in x]
+        settings["y"] = [float(v) for v in y]
+        settings["image_width"] = width
+        settings["image_height"] = height
+        return self._post("url_upload", settings)["subid"]
+
+    def jobs(self, submission_id):
+        """Return the ids of the jobs of a submission (empty while waiting)"""
+        return self._get(f"api/submissions/{submission_id}").json().get("jobs", [])
+
+    def job_status(self, job_id):
+        """Return the state of a job : solving, success or failure"""
+        return self._get(f"api/jobs/{job_id}/info").json()["status"]
+
+    def download(self, kind, job_id):
+        """
+        Download a file of a job solved
+
+        :param kind: "wcs_file" or "corr_file"
+        :param job_id: id of the job
+        """
+        return self._get(f"{kind}/{job_id}").content
+
+    def close(self):
+        """Close the connections"""
+        self.session.close()
+
+
+def load_frame(path):
+    """read a FITS file and convert it in grey like main_p3_API (no image written)"""
+    data, header = read_fits(path)
+    image = api.handler_color_image(data, ctx=RunContext(artifacts="none"))
+    return api.convert_in_grey(image), header
+
+
+async def _poll(run, call, arg, done, deadline):
+    """call call(arg) with longer and longer waits until done(result) or the deadline"""
+    wait = POLL_START
+    while True:
+        await asyncio.sleep(wait)
+        result = await run(call, arg)
+        if done(result):
+            return result
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"solve not finished after {SOLVE_TIMEOUT} s")
+        wait = min(wait * POLL_FACTOR, POLL_MAX)
+
+
+async def solve_frame(nova, run, path, cache, mode="image", fwhm=4.0, threshold=5.0):
+    """
+    Solve one frame : cache, upload, polling of the submission and of the job,
+    then download of the WCS and of the corr file at the same time
+
+    :param nova: NovaSession shared by the frames
+    :param run: function which run a blocking call in a thread (see solve_frames)
+    :param path: the FITS file's path
+    :param cache: SolveCache of the solutions
+    :param mode: "image" or "sources" (see main_p3_API.API_MODES)
+    :param fwhm: size of star in pixel for the local detection (mode "sources")
+    :param threshold: detection threshold of the local detection (mode "sources")
+    :return: dict with path, sources, wcs, submission_id, job_id and cached
+    """
+    image_gray, header = await run(load_frame, path)
+    key = await run(content_hash, image_gray)
+    solution = cache.get(key)
+    if solution is not None:
+        sources = read_corr_sources(solution["corr"])
+        return {"path": path, "sources": sources, "cached": True, **solution}
+
+    if mode == "sources":
+        local_sources = await run(api.detect_stars, image_gray, fwhm, threshold)
+        if local_sources is None:
+            raise RuntimeError("no stars found locally, can't solve from a source list")
+        x, y = api.brightest_positions(local_sources)
+        height, width = image_gray.shape[:2]
+        submission_id = await run(nova.upload_sources, x, y, width, height)
+    else:
+        submission_id = await run(nova.upload_image, image_gray, header)
+    # the image isn't needed while Astrometry.net is solving
+    del image_gray
+
+    deadline = time.monotonic() + SOLVE_TIMEOUT
+    jobs = await _poll(run, nova.jobs, submission_id, bool, deadline)
+    job_id = jobs[0]
+    status = await _poll(
+        run, nova.job_status, job_id, lambda s: s in ("success", "failure"), deadline
+    )
+    if status == "failure":
+        raise RuntimeError(f"Astrometry.net failed to solve (job {job_id})")
+
+    wcs, corr = await asyncio.gather(
+        run(nova.download, "wcs_file", job_id), run(nova.download, "corr_file", job_id)
+    )
+    solution = {
+        "corr": corr,
+        "wcs": fits.Header.fromstring(wcs.decode()),
+        "submission_id": submission_id,
+        "job_id": job_id,
+    }
+    cache.put(key, **solution)
+    sources = read_corr_sources(corr)
+    return {"path": path, "sources": sources, "cached": False, **solution}
+
+
+async def solve_frames(
+    paths,
+    api_key,
+    base_url=api.NOVA_URL,
+    cache=None,
+    mode="image",
+    max_in_flight=MAX_IN_FLIGHT,
+    fwhm=4.0,
+    threshold=5.0,
+):
+    """
+    Solve a list of frames with max_in_flight submissions at the same time
+
+    the results are given as soon as each frame is finished (not in the order of paths) :
+        async for result in solve_frames(paths, api_key): ...
+    A frame which fails give a dict with path and error, the other frames continue.
+
+    :param paths: FITS files' paths
+    :param api_key: Astrometry.net API key
+    :param base_url: address of the Astrometry.net server (a local MockNova for tests)
+    :param cache: SolveCache of the solutions (in DIR_SOLVE_CACHE by default)
+    :param mode: "image" or "sources" (see main_p3_API.API_MODES)
+    :param max_in_flight: number of frames solved at the same time
+    :param fwhm: size of star in pixel for the local detection (mode "sources")
+    :param threshold: detection threshold of the local detection (mode "sources")
+    :return: async generator of dict (see solve_frame), with the time of each frame
+    """
+    if cache is None:
+        cache = SolveCache()
+    nova = NovaSession(api_key, base_url, pool_size=2 * max_in_flight)
+    # 2 threads by frame : the downloads of the WCS and of the corr file at the same time
+    executor = ThreadPoolExecutor(max_workers=2 * max_in_flight)
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(max_in_flight)
+
+    def run(function, *args):
+        return loop.run_in_executor(executor, function, *args)
+
+    async def one(path):
+        async with limit:
+            start = time.perf_counter()
+            try:
+                result = await solve_frame(
+                    nova, run, path, cache, mode, fwhm, threshold
+                )
+            except Exception as e:
+                result = {"path": path, "error": f"{type(e).__name__}: {e}"}
+            result["seconds"] = time.perf_counter() - start
+            return result
+
+    tasks = [asyncio.ensure_future(one(path)) for path in paths]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        executor.shutdown(wait=False)
+        nova.close()
+
+
+async def run_solve(paths, options):
+    """
+    Solve the files of the command line and write the corr files as they arrive
+
+    :param paths: FITS files' paths
+    :param options: the arguments of the command line
+    :return: list of results
+    """
+    os.makedirs(options.out_dir, exist_ok=True)
+    results = []
+    start = time.perf_counter()
+    async for result in solve_frames(
+        paths,
+        options.api_key,
+        options.url,
+        SolveCache(options.cache_dir),
+        options.mode,
+        options.in_flight,
+    ):
+        name = os.path.splitext(os.path.basename(result["path"]))[0]
+        if "error" in result:
+            print(f"failed : {result['path']} ({result['error']})")
+        else:
+            with open(os.path.join(options.out_dir, f"{name}_corr.fits"), "wb") as f:
+                f.write(result["corr"])
+            origin = "cache" if result["cached"] else f"job {result['job_id']}"
+            print(
+                f"{name} : {len(result['sources'])} stars in {result['seconds']:.1f} s ({origin})"
+            )
+        results.append(result)
+    total = time.perf_counter() - start
+    solved = sum("error" not in r for r in results)
+    print(f"\n{solved}/{len(results)} frames solved in {total:.1f} s")
+    return results
+
+
+def parse_args(argv=None):
+    """Read the arguments of the command line"""
+    parser = argparse.ArgumentParser(
+        description="Plate-solve many FITS files with Astrometry.net at the same time"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", help="directories, FITS files or glob patterns"
+    )
+    parser.add_argument(
+        "--api-key",
+        default=os.environ.get("ASTROMETRY_API_KEY"),
+        help="Astrometry.net API key (default : variable ASTROMETRY_API_KEY)",
+    )
+    parser.add_argument(
+        "--url", default=api.NOVA_URL, help="address of the Astrometry.net server"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=api.API_MODES,
+        default="image",
+        help="image = upload the frames, sources = upload the stars found locally",
+    )
+    parser.add_argument(
+        "--in-flight",
+        type=int,
+        default=MAX_IN_FLIGHT,
+        help="number of frames solved at the same time",
+    )
+    parser.add_argument(
+        "--out-dir", default=DIR_RESULTS_SOLVE, help="directory of the corr files"
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=DIR_SOLVE_CACHE,
+        help="directory of the solutions already received",
+    )
+    options = parser.parse_args(argv)
+    if not options.api_key:
+        parser.error("an API key is needed (--api-key or ASTROMETRY_API_KEY)")
+    return options
+
+
+if __name__ == "__main__":
+    options = parse_args()
+    paths = find_inputs(options.inputs)
+    if not paths:
+        print("No FITS file found")
+        sys.exit(1)
+
+    results = asyncio.run(run_solve(paths, options))
+    sys.exit(0 if all("error" not in r for r in results) else 1)
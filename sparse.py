@@ -0,0 +1,303 @@
+import time
+
+import cv2 as cv
+import numpy as np
+
+import main_p2_origin as p2
+from blend import blend
+from morphology import DOUBLING_MIN_SIZE, collapse, dilate, erode
+from rasterize import rasterize_stars, source_positions
+from tiling import crop_core, gaussian_reach, morph_reach
+
+# size in pixels of the cells of the grid used to merge the boxes of the stars
+SPARSE_CELL = 8
+# cost of the boxes compared to the process of the whole image (measured on 4000x4000,
+# 100 to 8000 stars, erosions 3x2 to 9x4 : 14 ns by pixel of the whole image, 21 ns by
+# pixel of the boxes, 32 us by box, 22 ms to copy the image and find the boxes) :
+# a pixel of a box cost BOX_PIXEL_COST pixel of the whole image, and the copies and
+# calls of each box cost BOX_COST pixels. Above DENSE_FRACTION of the whole image
+# (what's left after the fixed cost, with a margin) the whole image is processed.
+BOX_PIXEL_COST = 1.5
+BOX_COST = 2300
+DENSE_FRACTION = 0.8
+# width in pixels of the atlas where the boxes are processed together
+ATLAS_WIDTH = 2048
+
+
+def star_boxes(shape, x, y, reach, cell=SPARSE_CELL):
+    """
+    Return the boxes which contain all the pixels at less than reach of a star
+
+    each star mark the cells of a grid touched by its square of side 2 * reach + 1,
+    then the groups of touching cells (connected components) are merged in one box :
+    a lonely star has a box of a few cells, the boxes of close stars are merged.
+    The boxes of two groups can overlap, their common pixels get the same values.
+
+    :param shape: shape of the image (height, width)
+    :param x: int array of x positions
+    :param y: int array of y positions
+    :param reach: distance in pixels around the stars
+    :param cell: size of the cells of the grid
+    :return: array of boxes, one row (y0, y1, x0, x1) by box
+    """
+    h, w = shape[:2]
+    grid = np.zeros(((h + cell - 1) // cell, (w + cell - 1) // cell), dtype=np.uint8)
+    # one point every cell along the square, so every cell touched is marked
+    offsets = np.unique(np.clip(np.arange(-reach, reach + cell, cell), -reach, reach))
+    for dy in offsets:
+        for dx in offsets:
+            gx = np.clip(x + dx, 0, w - 1) // cell
+            gy = np.clip(y + dy, 0, h - 1) // cell
+            grid[gy, gx] = 1
+
+    _, _, stats, _ = cv.connectedComponentsWithStats(grid, connectivity=8)
+    # the component 0 is the background
+    gx, gy, gw, gh = stats[1:, :4].T.astype(np.intp)
+    return np.stack(
+        [
+            gy * cell,
+            np.minimum((gy + gh) * cell, h),
+            gx * cell,
+            np.minimum((gx + gw) * cell, w),
+        ],
+        axis=1,
+    )
+
+
+def _pack(boxes, width):
+    """
+    Place the boxes side by side in rows (the highest first) in an atlas
+
+    :param boxes: list of boxes (y0, y1, x0, x1)
+    :param width: width of the atlas, widened to the widest box
+    :return: list of positions (y, x) of the boxes in the atlas, shape of the atlas
+    """
+    width = max([width] + [x1 - x0 for _, _, x0, x1 in boxes])
+    order = sorted(range(len(boxes)), key=lambda i: boxes[i][0] - boxes[i][1])
+    positions = [None] * len(boxes)
+    row_y, row_x, row_height = 0, 0, 0
+    for i in order:
+        y0, y1, x0, x1 = boxes[i]
+        if row_x + x1 - x0 > width:
+            row_y, row_x, row_height = row_y + row_height, 0, 0
+        positions[i] = (row_y, row_x)
+        row_x += x1 - x0
+        row_height = max(row_height, y1 - y0)
+    return positions, (row_y + row_height, width)
+
+
+def _box_morph(cv_function, morph_function, ksize, iterations, dtype):
+    """
+    erosion (or dilation) of the small boxes : the kernel of OpenCV is made once
+
+    the same single pass as morphology for the small kernels, the big ones
+    (doubling) go through morph_function
+    """
+    (rows, anchor_y), (cols, anchor_x) = [collapse(k, iterations) for k in ksize]
+    if (
+        iterations < 1
+        or min(ksize) < 1
+        or max(rows, cols) >= DOUBLING_MIN_SIZE
+        or dtype not in (np.float32, np.float64)
+    ):
+        return lambda image: morph_function(image, ksize, iterations)
+    if rows == 1 and cols == 1:
+        return np.copy
+    kernel = np.ones((rows, cols), np.uint8)
+    anchor = (anchor_x, anchor_y)
+    return lambda image: cv_function(image, kernel, anchor=anchor)
+
+
+def reduce_stars_sparse(
+    image_gray,
+    sources,
+    erode_kernel,
+    nb_iter,
+    kernelDilate=(3, 3),
+    kernelGaussian=(3, 3),
+    mask_blur=None,
+    cell=SPARSE_CELL,
+    out=None,
+):
+    """
+    Calculate the final image of the standard model only around the stars
+
+    the blurred mask is 0 far from the stars, so there the final image is the original.
+    The mask, the erosion and the combination are only calculated in the boxes of
+    star_boxes, each box is read with a halo which cover the dilation, the gaussian blur
+    and the erosion. The boxes are copied in an atlas, so OpenCV and blend are called
+    once for all of them (the boxes at the borders of the image are processed one by
+    one). The final image is exactly the same as
+    combinate_mask_image(mask_effects(star_mask(...)), erode_image(...), image_gray).
+    When the boxes cost more than DENSE_FRACTION of the whole image (dense fields,
+    a lot of boxes or big erosions with a big halo), the whole image is processed.
+
+    :param image_gray: the grey image
+    :param sources: table of stars positions (xcentroid, ycentroid)
+    :param erode_kernel: size of the erosion kernel
+    :param nb_iter: number of erosion iterations
+    :param kernelDilate: kernel of the dilation of the mask
+    :param kernelGaussian: kernel of the gaussian blur of the mask
+    :param mask_blur: blurred mask of the whole image if already calculated
+    :param cell: size of the cells used to merge the boxes
+    :param out: array which receive the final image, None to allocate it
+    :return: the final image
+    """
+    h, w = image_gray.shape[:2]
+    x, y = source_positions(sources)
+    # int() of star_mask
+    xi = x.astype(np.intp)
+    yi = y.astype(np.intp)
+
+    mask_reach = morph_reach(max(kernelDilate)) + gaussian_reach(max(kernelGaussian))
+    halo = max(mask_reach, morph_reach(erode_kernel, nb_iter))
+    boxes = star_boxes((h, w), xi, yi, mask_reach, cell)
+    padded_boxes = np.clip(boxes + [-halo, halo, -halo, halo], 0, [h, h, w, w])
+    covered = np.sum(
+        (padded_boxes[:, 1] - padded_boxes[:, 0])
+        * (padded_boxes[:, 3] - padded_boxes[:, 2])
+    )
+    cost = BOX_PIXEL_COST * covered + BOX_COST * len(boxes)
+
+    if cost > DENSE_FRACTION * h * w:
+        if mask_blur is None:
+            mask = rasterize_stars((h, w), xi, yi)
+            mask_blur = p2.mask_effects(mask, kernelDilate, kernelGaussian, save=False)
+        Ierode = p2.erode_image(image_gray, (erode_kernel, erode_kernel), nb_iter)
+        return p2.combinate_mask_image(
+            mask_blur, Ierode, image_gray, save=False, out=out
+        )
+
+    final = out if out is not None else np.empty_like(image_gray)
+    final[...] = image_gray
+    if len(boxes) == 0:
+        return final
+
+    if mask_blur is None:
+        dilate_box = _box_morph(cv.dilate, dilate, kernelDilate, 1, np.float32)
+        # stars sorted by row : the points of a box are drawn from the stars of its rows
+        order = np.argsort(yi, kind="stable")
+        ys, xs = yi[order], xi[order]
+    else:
+        dilate_box = None
+    erode_box = _box_morph(
+        cv.erode, erode, (erode_kernel, erode_kernel), nb_iter, image_gray.dtype
+    )
+
+    def box_mask(padded, out):
+        """the points of the stars (like star_mask) or the blurred mask of a padded box"""
+        py0, py1, px0, px1 = padded
+        if mask_blur is not None:
+            out[...] = mask_blur[py0:py1, px0:px1]
+            return out
+        lo, hi = np.searchsorted(ys, (py0, py1))
+        by, bx = ys[lo:hi], xs[lo:hi]
+        inside = (bx >= px0) & (bx < px1)
+        out[by[inside] - py0, bx[inside] - px0] = 1.0
+        return out
+
+    mask_dtype = np.float32 if mask_blur is None else mask_blur.dtype
+
+    def reduce_area(image, mask, scratch=None):
+        """final image of a padded box or of the atlas"""
+        if dilate_box is not None:
+            mask = cv.GaussianBlur(dilate_box(mask), ksize=kernelGaussian, sigmaX=0)
+            # np.clip of mask_effects, without its checks of the arguments
+            np.maximum(mask, 0.0, out=mask)
+            np.minimum(mask, 1.0, out=mask)
+        return blend(image, mask, erode_box(image), scratch=scratch)
+
+    # the boxes far from the borders of the image are copied side by side in an
+    # atlas processed at once : the halo of each box covers the reach of the
+    # operations, so its core doesn't see its neighbours
+    far = (
+        (boxes[:, 0] >= halo)
+        & (boxes[:, 2] >= halo)
+        & (boxes[:, 1] + halo <= h)
+        & (boxes[:, 3] + halo <= w)
+    )
+    inner = np.flatnonzero(far).tolist()
+    edges = np.flatnonzero(~far).tolist()
+    boxes, padded_boxes = boxes.tolist(), padded_boxes.tolist()
+    if inner:
+        positions, shape = _pack([padded_boxes[i] for i in inner], ATLAS_WIDTH)
+        atlas = np.zeros(shape, dtype=image_gray.dtype)
+        atlas_mask = np.zeros(shape, dtype=mask_dtype)
+        for i, (ay, ax) in zip(inner, positions):
+            py0, py1, px0, px1 = padded_boxes[i]
+            slot = np.s_[ay : ay + py1 - py0, ax : ax + px1 - px0]
+            atlas[slot] = image_gray[py0:py1, px0:px1]
+            box_mask(padded_boxes[i], atlas_mask[slot])
+        atlas = reduce_area(atlas, atlas_mask)
+        for i, (ay, ax) in zip(inner, positions):
+            y0, y1, x0, x1 = boxes[i]
+            ay, ax = ay + halo, ax + halo
+            final[y0:y1, x0:x1] = atlas[ay : ay + y1 - y0, ax : ax + x1 - x0]
+
+    # the boxes near the borders need the border of the image of OpenCV : one by one
+    if edges:
+        # the temporary buffer of blend, shared by these boxes
+        scratch = np.empty(
+            max(
+                (py1 - py0) * (px1 - px0)
+                for py0, py1, px0, px1 in (padded_boxes[i] for i in edges)
+            ),
+            dtype=np.result_type(image_gray, mask_dtype),
+        )
+    for i in edges:
+        core, padded = boxes[i], padded_boxes[i]
+        py0, py1, px0, px1 = padded
+        mask = box_mask(padded, np.zeros((py1 - py0, px1 - px0), dtype=mask_dtype))
+        result = reduce_area(image_gray[py0:py1, px0:px1], mask, scratch)
+        y0, y1, x0, x1 = core
+        final[y0:y1, x0:x1] = crop_core(result, core, padded)
+    return final
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+
+    from astropy.table import Table
+
+    # synthetic fields : a noisy background with random star positions
+    shape = (4000, 4000)
+    rng = np.random.default_rng(0)
+    print(f"image {shape[1]}x{shape[0]}, erosion kernel 3, 2 iterations")
+    print(
+        f"{'stars':>8} {'boxes':>8} {'full (s)':>9} {'sparse (s)':>11} {'speedup':>8} equal"
+    )
+    for nb_stars in (100, 500, 2000, 10000, 50000):
+        image = rng.normal(0.1, 0.01, shape).astype(np.float32)
+        sources = Table()
+        sources["xcentroid"] = rng.uniform(0, shape[1], nb_stars)
+        sources["ycentroid"] = rng.uniform(0, shape[0], nb_stars)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            mask = p2.star_mask(image, sources, save=False)
+            mask_blur = p2.mask_effects(mask, save=False)
+            Ierode = p2.erode_image(image, (3, 3), 2)
+            reference = p2.combinate_mask_image(mask_blur, Ierode, image, save=False)
+            full_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            final = reduce_stars_sparse(image, sources, 3, 2)
+            sparse_time = time.perf_counter() - start
+
+        # the part of the image read by the boxes (with their halo of 2 pixels)
+        boxes = star_boxes(
+            shape,
+            np.asarray(sources["xcentroid"]).astype(int),
+            np.asarray(sources["ycentroid"]).astype(int),
+            2,
+        )
+        padded = np.clip(
+            boxes + [-2, 2, -2, 2], 0, [shape[0], shape[0], shape[1], shape[1]]
+        )
+        covered = np.sum((padded[:, 1] - padded[:, 0]) * (padded[:, 3] - padded[:, 2]))
+        covered /= image.size
+        print(
+            f"{nb_stars:>8} {covered:>8.1%} {full_time:>9.3f} {sparse_time:>11.3f} "
+            f"{full_time / sparse_time:>7.1f}x {np.array_equal(final, reference)}"
+        )
@@ -0,0 +1,189 @@
+import sys
+import time
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+import main_p3_starnet as p3
+
+# resolution of the index : the counts are exact for the thresholds k / THRESHOLD_STEPS
+# (all the positions of the threshold slider, which go by 0.01)
+THRESHOLD_STEPS = 1000
+# pixels read at once by the histogram (4 MB of float32)
+CHUNK_PIXELS = 1 << 20
+# numbers of stars kept for the last thresholds
+COMPONENTS_ENTRIES = 64
+# memory of a number of stars kept : threshold (float) and count (int)
+_ENTRY_BYTES = sys.getsizeof(0.5) + sys.getsizeof(1 << 40)
+
+
+def _float32(thresh):
+    """threshold as compared by mask_from_stars_starnet (float32 image, python float)"""
+    return np.float32(thresh)
+
+
+class StarMaskIndex:
+    """
+    Stars-only image of StarNet normalized once, and its cumulative histogram
+
+    mask_from_stars_starnet average the channels, normalize the image and compare it
+    to the threshold at each move of the slider. The index keep the normalized grey
+    plane, so a threshold only cost the comparison (cv.threshold), and the number
+    of pixels above each threshold of the grid k / THRESHOLD_STEPS, so the number of
+    masked pixels of the slider is given without reading the image.
+    The masks are the same as mask_from_stars_starnet, bit for bit.
+    """
+
+    def __init__(self, stars_img, bounds=None, steps=THRESHOLD_STEPS, memo=False):
+        """
+        Normalize the stars-only image and count its pixels by threshold
+
+        :param stars_img: image stars-only (already normalized, grey or color)
+        :param bounds: (min, max) of the whole grey stars image, when stars_img is a tile
+        :param steps: number of thresholds of the grid between 0 and 1
+        :param memo: if True, the bounds of the image are memorized (see normalize.py)
+        """
+        stars_gray = p3.convert_in_grey(stars_img)
+        self.plane = p3.normalize_img(stars_gray, bounds, memo=memo)
+        self.shape = self.plane.shape
+        # thresholds as float32, like the comparison of mask_from_stars_starnet
+        self._edges = (np.arange(steps + 1) / steps).astype(np.float32)
+        counts = self._histogram(steps)
+        # _above[k] = number of pixels above the edge k
+        self._above = self.plane.size - np.cumsum(counts)[: steps + 1]
+        self._components = OrderedDict()  # threshold -> number of stars
+
+    def _histogram(self, steps):
+        """
+        number of pixels by code, the code of a pixel is the number of edges below it
+        (a pixel is above the edge k if its code is > k)
+
+        the code is first estimated by floor(value * steps), then corrected
+        by one comparison with the edges on each side : exact like a searchsorted
+        in the edges, 3 times faster. The plane is read by blocks of CHUNK_PIXELS.
+        """
+        counts = np.zeros(steps + 2, dtype=np.int64)
+        values = self.plane.ravel()
+        for start in range(0, values.size, CHUNK_PIXELS):
+            chunk = values[start : start + CHUNK_PIXELS]
+            codes = np.clip(chunk * np.float32(steps), 0, steps).astype(np.intp)
+            codes += chunk > self._edges[codes]
+            codes -= (codes > 0) & (chunk <= self._edges[np.maximum(codes - 1, 0)])
+            counts += np.bincount(codes, minlength=steps + 2)
+        return counts
+
+    @property
+    def nbytes(self):
+        """Memory used by the index (for the cache)
+
+        the numbers of stars are counted full : the cache reads nbytes when the
+        index is stored, before the memo is filled"""
+        memo = COMPONENTS_ENTRIES * _ENTRY_BYTES
+        return self.plane.nbytes + self._edges.nbytes + self._above.nbytes + memo
+
+    def count(self, thresh):
+        """
+        Return the number of masked pixels of a threshold
+
+        from the histogram for the thresholds of the grid (the slider),
+        by a comparison of the plane for the others
+
+        :param thresh: threshold to say "here is a star"
+        """
+        value = _float32(thresh)
+        k = np.searchsorted(self._edges, value)
+        if k < len(self._edges) and self._edges[k] == value:
+            return int(self._above[k])
+        return int(np.count_nonzero(self.plane > value))
+
+    def mask(self, thresh):
+        """
+        Return the mask of a threshold, like mask_from_stars_starnet
+
+        :param thresh: threshold to say "here is a star"
+        :return: float32 mask (1 on the stars, 0 elsewhere)
+        """
+        # the float32 threshold is exact in double, cv.threshold compare like numpy
+        _, mask = cv.threshold(
+            self.plane, float(_float32(thresh)), 1.0, cv.THRESH_BINARY
+        )
+        return mask
+
+    def components(self, thresh, mask=None):
+        """
+        Return the number of stars (connected groups of masked pixels) of a threshold
+
+        calculated once by threshold, then given at once
+        (for the last COMPONENTS_ENTRIES thresholds)
+
+        :param thresh: threshold to say "here is a star"
+        :param mask: the mask of the threshold if already calculated
+        """
+        value = float(_float32(thresh))
+        if value in self._components:
+            self._components.move_to_end(value)
+            return self._components[value]
+        if mask is None:
+            mask = self.mask(value)
+        nb_labels, _ = cv.connectedComponents(
+            mask.astype(np.uint8), connectivity=8, ltype=cv.CV_32S
+        )
+        # the label 0 is the background
+        self._components[value] = nb_labels - 1
+        while len(self._components) > COMPONENTS_ENTRIES:
+            self._components.popitem(last=False)
+        return nb_labels - 1
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import sys
+
+    from detectors import synthetic_field
+
+    # the StarNet output of the examples, then a synthetic 50 Mpx stars-only image
+    images = []
+    path = sys.argv[1] if len(sys.argv) > 1 else "star_reduction/starmask_HorseHead.fit"
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, header = p3.load_fits(path)
+    images.append((path, p3.handler_color_image(data)))
+    stars, *_ = synthetic_field((6000, 8400), 40000, 3.0, noise=0.002)
+    images.append(("synthetic 8400x6000", np.clip(stars, 0, None)))
+
+    thresholds = [v / 100.0 for v in range(1, 101)]
+    for name, image in images:
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thresh in thresholds[::10]:
+                reference = p3.mask_from_stars_starnet(image, thresh, save=False)
+        full_time = (time.perf_counter() - start) / len(thresholds[::10])
+
+        start = time.perf_counter()
+        index = StarMaskIndex(image)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        counts = [index.count(thresh) for thresh in thresholds]
+        count_time = (time.perf_counter() - start) / len(thresholds)
+
+        start = time.perf_counter()
+        masks = {thresh: index.mask(thresh) for thresh in thresholds[::10]}
+        mask_time = (time.perf_counter() - start) / len(masks)
+
+        same = True
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thresh, mask in masks.items():
+                reference = p3.mask_from_stars_starnet(image, thresh, save=False)
+                same &= np.array_equal(reference, mask)
+                same &= counts[thresholds.index(thresh)] == np.count_nonzero(reference)
+
+        print(
+            f"{name} ({index.plane.size / 1e6:.1f} Mpx) : index built in {build_time:.2f} s"
+        )
+        print(
+            f"  by threshold : mask_from_stars_starnet {full_time * 1000:.0f} ms, "
+            f"index.mask {mask_time * 1000:.0f} ms, index.count {count_time * 1e6:.1f} us, "
+            f"same {same}"
+        )
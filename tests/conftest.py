@@ -0,0 +1,27 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+# the modules of the project are at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from detectors import synthetic_field  # noqa: E402
+
+
+@pytest.fixture
+def uint16_fits(tmp_path):
+    """
+    FITS file of a synthetic field in unsigned 16 bits, like the cameras :
+    BITPIX 16 with BZERO 32768 (astropy can't memory-map the scaled pixels)
+    """
+    image, *_ = synthetic_field((300, 420), 150, 4.0)
+    pixels = np.clip(1000 + image * 20000, 0, 65535).astype(np.uint16)
+    path = tmp_path / "u16.fits"
+    fits.PrimaryHDU(pixels).writeto(path)
+    assert fits.getheader(path)["BZERO"] == 32768
+    return str(path)
@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import main_p3_API as api
+from astrometry_cache import SolveCache
+from cache import content_hash
+from detectors import synthetic_field
+from mock_nova import MockNova, corr_bytes, wcs_header
+from run_context import RunContext
+
+SHAPE = (256, 256)
+
+
+@pytest.fixture
+def field():
+    image_gray, x, y, _ = synthetic_field(SHAPE, 60, 4.0)
+    return image_gray, x, y
+
+
+def _solve(nova, image_gray, cache, mode="image"):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return api.detect_stars_api(
+            image_gray,
+            fits.Header(),
+            "mock-key",
+            RunContext(artifacts="none"),
+            cache,
+            nova.url,
+            mode,
+        )
+
+
+@pytest.mark.parametrize("mode", api.API_MODES)
+def test_miss_solves_and_stores(tmp_path, field, mode):
+    image_gray, x, y = field
+    cache = SolveCache(str(tmp_path / "cache"))
+    with MockNova(x, y, *SHAPE[::-1]) as nova:
+        sources = _solve(nova, image_gray, cache, mode)
+        assert len(nova.uploads) == 1
+
+    assert np.allclose(sources["xcentroid"], x)
+    assert np.allclose(sources["ycentroid"], y)
+    solution = cache.get(content_hash(image_gray))
+    assert solution is not None
+    assert solution["corr"] == nova.corr
+    assert solution["wcs"]["CRVAL1"] == 10.68
+
+
+def test_hit_sends_no_request(tmp_path, field):
+    image_gray, x, y = field
+    cache = SolveCache(str(tmp_path / "cache"))
+    with MockNova(x, y, *SHAPE[::-1]) as nova:
+        expected = _solve(nova, image_gray, cache)
+    # a second run, with a server which has never seen the image
+    with MockNova(x, y, *SHAPE[::-1]) as nova:
+        sources = _solve(nova, image_gray.copy(), SolveCache(cache.directory))
+        assert nova.requests == []
+        assert nova.connections == 0
+    assert np.array_equal(sources["xcentroid"], expected["xcentroid"])
+    assert np.array_equal(sources["ycentroid"], expected["ycentroid"])
+
+
+def test_eviction_removes_oldest(tmp_path):
+    cache = SolveCache(str(tmp_path / "cache"))
+    header = wcs_header()
+    corr = corr_bytes(np.arange(200.0), np.arange(200.0), header)
+    for i, key in enumerate(("a", "b", "c")):
+        cache.put(key, corr, header, i, i)
+        # last use one minute apart (the resolution of mtime can be coarse)
+        os.utime(cache._path(key), (1000 + 60 * i, 1000 + 60 * i))
+    # room for two solutions (the sizes differ by a few bytes of info.json)
+    budget = cache.nbytes * 5 // 6
+
+    # "a" is read again : it becomes the most recent
+    assert cache.get("a") is not None
+    cache.max_bytes = budget
+    cache.evict()
+    assert "b" not in cache
+    assert "a" in cache and "c" in cache
+
+    # a new solution over the budget removes the oldest one ("c")
+    cache.put("d", corr, header, 3, 3)
+    assert "c" not in cache
+    assert "a" in cache and "d" in cache
+    assert cache.nbytes <= cache.max_bytes
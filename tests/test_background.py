@@ -0,0 +1,61 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+from astropy.stats import sigma_clipped_stats
+
+import main_p2_origin as p2
+import tiling
+from background import (
+    MIN_SAMPLE_PIXELS,
+    SAMPLE_STRIDE,
+    background_stats,
+    estimate_background,
+    sample_error,
+    sample_pixels,
+)
+from detectors import synthetic_field
+
+
+def _grey(path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, header = p2.load_fits(path)
+        return p2.convert_in_grey(p2.handler_color_image(data, save=False))
+
+
+def test_default_is_exact():
+    image, *_ = synthetic_field((600, 700), 300, 4.0)
+    mean, median, std = sigma_clipped_stats(image, sigma=3.0)
+    assert background_stats(image) == (mean, median, std)
+    assert estimate_background(image) == (median, std)
+
+
+def test_sampled_within_sample_error():
+    image, *_ = synthetic_field((600, 700), 300, 4.0)
+    _, median, std = sigma_clipped_stats(image, sigma=3.0)
+    sample_median, sample_std = estimate_background(image, mode="sampled")
+    median_bound, std_bound = sample_error(
+        std, sample_pixels(image, SAMPLE_STRIDE).size
+    )
+    # the sample is one pixel out of 16, the difference stays within a few standard errors
+    assert (sample_median, sample_std) != (median, std)
+    assert abs(sample_median - median) < 4 * median_bound
+    assert abs(sample_std - std) < 4 * std_bound
+
+
+@pytest.mark.parametrize("shape", [(200, 300), (500, 700)])
+def test_tiled_stats_equal_sampled(tmp_path, shape):
+    image, *_ = synthetic_field(shape, 200, 4.0)
+    path = tmp_path / "field.fits"
+    fits.PrimaryHDU(image).writeto(path)
+    # the small image is sampled on all its pixels, like background_stats
+    assert (np.prod(shape) <= MIN_SAMPLE_PIXELS) == (shape == (200, 300))
+
+    expected = estimate_background(_grey(str(path)), mode="sampled")
+    with tiling.TiledFits(str(path)) as reader:
+        bounds = reader.bounds(128)
+        # 100 isn't a multiple of the stride : the grid goes across the tiles
+        for tile in (128, 100):
+            assert tiling.sampled_stats(reader, bounds, tile=tile) == expected
@@ -0,0 +1,56 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import batch
+import tiling
+
+
+def test_tile_rejects_mesh_background(tmp_path):
+    with pytest.raises(SystemExit), contextlib.redirect_stderr(io.StringIO()):
+        batch.parse_args(["x.fits", "--tile", "256", "--background", "mesh"])
+    for mode in ("global", "sampled"):
+        options = batch.parse_args(["x.fits", "--tile", "256", "--background", mode])
+        assert options.background == mode
+
+
+def test_tile_uses_detect_workers(uint16_fits, tmp_path):
+    with contextlib.redirect_stdout(io.StringIO()):
+        serial, serial_sources = tiling.process_standard_tiled(
+            uint16_fits, 4.0, 5.0, 3, 2, tile=128
+        )
+        pool, pool_sources = tiling.process_standard_tiled(
+            uint16_fits, 4.0, 5.0, 3, 2, tile=128, workers=2
+        )
+    assert np.array_equal(serial, pool)
+    assert np.array_equal(serial_sources["xcentroid"], pool_sources["xcentroid"])
+
+    options = batch.parse_args(
+        [uint16_fits, "--tile", "128", "--detect-workers", "2"]
+        + ["--erode-kernel", "3", "--iterations", "2"]
+        + ["--artifacts", "none", "--out-dir", str(tmp_path)]
+    )
+    report = batch.process_file(uint16_fits, options)
+    assert report["ok"], report["error"]
+    assert report["nb_stars"] == len(serial_sources)
+    assert np.array_equal(fits.getdata(tmp_path / "u16_final.fits"), serial)
+
+
+@pytest.mark.filterwarnings("ignore:No sources were found")
+def test_tile_without_stars_writes_grey_image(uint16_fits, tmp_path):
+    # a threshold far above the stars : no detection on both paths
+    outputs = {}
+    for name, tile in (("whole", []), ("tiled", ["--tile", "128"])):
+        out_dir = tmp_path / name
+        options = batch.parse_args(
+            [uint16_fits, "--threshold", "1e6", "--out-dir", str(out_dir)] + tile
+        )
+        report = batch.process_file(uint16_fits, options)
+        assert report["ok"], report["error"]
+        assert report["nb_stars"] == 0
+        assert (out_dir / "u16_final.png").exists()
+        outputs[name] = fits.getdata(out_dir / "u16_final.fits")
+    assert np.array_equal(outputs["whole"], outputs["tiled"])
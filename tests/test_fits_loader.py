@@ -0,0 +1,84 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+import batch
+import main_p2_origin as p2
+import phase2Function
+import tiling
+from background import estimate_background
+from fits_loader import LazyFits, read_fits
+
+
+def test_lazy_fits_reads_scaled_uint16(uint16_fits):
+    expected = fits.getdata(uint16_fits).astype(np.float32)
+    with LazyFits(uint16_fits) as lazy:
+        assert lazy.scaled
+        assert np.array_equal(lazy.data, expected)
+        assert np.array_equal(lazy.section(10, 60, 20, 90), expected[10:60, 20:90])
+        assert np.array_equal(lazy.thumbnail(100), expected[::5, ::5])
+        assert lazy.section(0, 5, 0, 5).dtype == np.float32
+
+
+def test_lazy_fits_without_image(tmp_path):
+    empty = tmp_path / "empty.fits"
+    fits.PrimaryHDU().writeto(empty)
+    # NAXIS = 2 without NAXIS2
+    header = fits.Header(
+        [("SIMPLE", True), ("BITPIX", 16), ("NAXIS", 2), ("NAXIS1", 4)]
+    )
+    broken = tmp_path / "broken.fits"
+    broken.write_bytes(header.tostring().encode())
+    for path in (empty, broken):
+        # OSError like a file which isn't a FITS file (tooltips of the list of files)
+        with pytest.raises(OSError):
+            LazyFits(str(path)).image_shape
+
+
+def test_load_fits_reads_scaled_uint16(uint16_fits):
+    expected = fits.getdata(uint16_fits).astype(np.float32)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for load_fits in (phase2Function.load_fits, p2.load_fits):
+            data, header = load_fits(uint16_fits)
+            assert np.array_equal(data, expected)
+            assert "BZERO" not in header
+    assert np.array_equal(read_fits(uint16_fits)[0], expected)
+
+
+def test_tiled_path_reads_scaled_uint16(uint16_fits):
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, _ = p2.load_fits(uint16_fits)
+        image_gray = p2.convert_in_grey(p2.handler_color_image(data, save=False))
+        stats = estimate_background(image_gray)
+        sources = p2.detect_stars(image_gray, 4.0, 5.0)
+        mask = p2.mask_effects(
+            p2.star_mask(image_gray, sources, save=False), save=False
+        )
+        Ierode = p2.erode_image(image_gray, (3, 3), 2)
+        expected = p2.combinate_mask_image(mask, Ierode, image_gray, save=False)
+
+        final, tiled_sources = tiling.process_standard_tiled(
+            uint16_fits, 4.0, 5.0, 3, 2, stats=stats, tile=128
+        )
+    assert len(tiled_sources) == len(sources)
+    assert np.array_equal(final, expected)
+
+
+def test_batch_tiles_scaled_uint16(uint16_fits, tmp_path):
+    options = batch.parse_args(
+        [
+            uint16_fits,
+            "--tile",
+            "128",
+            "--artifacts",
+            "none",
+            "--out-dir",
+            str(tmp_path),
+        ]
+    )
+    report = batch.process_file(uint16_fits, options)
+    assert report["ok"], report["error"]
+    assert report["nb_stars"] > 0
@@ -0,0 +1,52 @@
+from unittest import mock
+
+import numpy as np
+import pytest
+
+import normalize
+from detectors import synthetic_field
+
+
+@pytest.fixture
+def image():
+    normalize.clear_memo()
+    data, *_ = synthetic_field((200, 300), 100, 4.0)
+    yield data
+    normalize.clear_memo()
+
+
+def _formula(data):
+    return ((data - data.min()) / (data.max() - data.min())).astype(np.float32)
+
+
+def test_in_place_change_gets_fresh_bounds(image):
+    assert normalize.min_max(image) == (image.min(), image.max())
+    assert np.array_equal(normalize.normalize(image), _formula(image))
+    normalize.percentile_bounds(image)
+
+    # same object, same buffer and layout : only the pixels change
+    image *= 3
+    image[10, 20] = -5
+    assert normalize.min_max(image) == (image.min(), image.max())
+    assert np.array_equal(normalize.normalize(image), _formula(image))
+    assert normalize.percentile_bounds(image) == normalize.percentile_bounds(
+        image.copy()
+    )
+
+    # a normalized image changed in place is normalized again on its pixels
+    result = normalize.normalize(image)
+    result[0, 0] = 2.0
+    assert normalize.min_max(result)[1] == 2.0
+
+
+def test_memo_on_request(image):
+    bounds = normalize.min_max(image, memo=True)
+    result = normalize.normalize(image, memo=True)
+    with mock.patch.object(normalize.cv, "minMaxLoc", side_effect=AssertionError):
+        # the bounds of the image and of its result are read from the memo
+        assert normalize.min_max(image, memo=True) == bounds
+        assert normalize.min_max(result, memo=True) == (0, 1)
+        assert np.array_equal(normalize.normalize(result, memo=True), result)
+        # without memo the pixels are read
+        with pytest.raises(AssertionError):
+            normalize.min_max(image)
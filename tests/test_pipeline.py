@@ -0,0 +1,74 @@
+import contextlib
+import io
+from unittest import mock
+
+import numpy as np
+from astropy.io import fits
+
+import main_p3_starnet as p3
+import pipeline
+import tiling
+from cache import StageCache
+from catalog import THRESHOLD_MIN
+from detectors import synthetic_field
+from run_context import RunContext
+
+
+def test_catalog_at_requested_threshold_then_extended(tmp_path):
+    image, *_ = synthetic_field((256, 256), 200, 4.0)
+    path = str(tmp_path / "field.fits")
+    fits.PrimaryHDU(image).writeto(path)
+    cache = StageCache()
+    detect = mock.Mock(wraps=tiling.find_stars_parallel)
+    with mock.patch.object(tiling, "find_stars_parallel", detect):
+        with contextlib.redirect_stdout(io.StringIO()):
+            # the first result only detect at its threshold, in the thread of the caller
+            result = pipeline.process_standard(cache, path, 4.0, 5, 3, 2)
+            assert detect.call_count == 1
+            args, kwargs = detect.call_args
+            assert args[2] == 5 and args[5] == 1
+            assert pipeline.cached_star_count(cache, path, 4.0, 12) is not None
+            assert pipeline.cached_star_count(cache, path, 4.0, THRESHOLD_MIN) is None
+
+            # then the catalog is lowered to the minimum of the slider, once
+            pipeline.extend_catalog(cache, path, 4.0)
+            pipeline.extend_catalog(cache, path, 4.0)
+            counts = [
+                pipeline.cached_star_count(cache, path, 4.0, t)
+                for t in (5, 2, THRESHOLD_MIN, 12)
+            ]
+    assert detect.call_count == 2
+    assert detect.call_args[0][2] == THRESHOLD_MIN
+    assert counts[0] == result["nb_stars"]
+    assert counts[0] < counts[1] <= counts[2]
+    assert counts[3] <= counts[0]
+
+
+def test_starnet_compare_from_cached_terms(tmp_path):
+    stars, *_ = synthetic_field((200, 240), 80, 3.0, noise=0.0)
+    paths = []
+    for name, data in (("starless", np.full_like(stars, 0.2)), ("starmask", stars)):
+        paths.append(str(tmp_path / f"{name}.fit"))
+        fits.PrimaryHDU(data).writeto(paths[-1])
+    cache = StageCache()
+    with contextlib.redirect_stdout(io.StringIO()):
+        preview = pipeline.process_starnet(*paths, 0.05, 0.5, cache=cache)
+
+        # a run with outputs at the same threshold : the terms come from the cache
+        ctx = RunContext(artifacts="all")
+        terms = mock.Mock(wraps=p3.reduction_terms)
+        with mock.patch.object(p3, "reduction_terms", terms):
+            result = pipeline.process_starnet(*paths, 0.05, 0.8, ctx=ctx, cache=cache)
+    assert terms.call_count == 0
+    assert result["before"] is preview["before"]
+    assert "masks/star_blurred.png" in ctx.outputs
+
+    before, after = result["before"], result["final"]
+    assert ctx.outputs["compare/before_reduced.png"] is not None
+    assert np.array_equal(
+        ctx.outputs["compare/after_reduced.png"], p3.normalize_img(after)
+    )
+    assert np.array_equal(
+        ctx.outputs["compare/diff_abs_between.png"],
+        p3.normalize_img(np.abs(after - before)),
+    )
@@ -0,0 +1,132 @@
+import asyncio
+import time
+
+import pytest
+from astropy.io import fits
+
+import solve_batch
+from astrometry_cache import SolveCache
+from detectors import synthetic_field
+from mock_nova import MockNova
+
+SHAPE = (128, 128)
+
+
+@pytest.fixture
+def frames(tmp_path):
+    paths = []
+    for i in range(6):
+        frame, *_ = synthetic_field(SHAPE, 30, 4.0, seed=i + 1)
+        paths.append(str(tmp_path / f"frame_{i}.fits"))
+        fits.PrimaryHDU(frame).writeto(paths[-1])
+    return paths
+
+
+@pytest.fixture
+def fast_poll(monkeypatch):
+    """polling in tenths of second instead of seconds"""
+    monkeypatch.setattr(solve_batch, "POLL_START", 0.05)
+    monkeypatch.setattr(solve_batch, "POLL_FACTOR", 2.0)
+    monkeypatch.setattr(solve_batch, "POLL_MAX", 0.2)
+
+
+def _solve(paths, nova, cache, max_in_flight=solve_batch.MAX_IN_FLIGHT):
+    """results of solve_frames with the time of arrival of each one"""
+
+    async def collect():
+        start = time.monotonic()
+        results = []
+        async for result in solve_batch.solve_frames(
+            paths, "mock-key", nova.url, cache, max_in_flight=max_in_flight
+        ):
+            result["arrival"] = time.monotonic() - start
+            results.append(result)
+        return results
+
+    return asyncio.run(collect())
+
+
+def test_results_streamed(tmp_path, frames, fast_poll):
+    cache = SolveCache(str(tmp_path / "cache"))
+    with MockNova(solve_delay=1.0) as nova:
+        # the last frame is already solved
+        (first,) = _solve(frames[-1:], nova, cache)
+        results = _solve(frames, nova, cache, max_in_flight=len(frames))
+
+    assert "error" not in first, first["error"]
+    assert all("error" not in r for r in results)
+    assert sorted(r["path"] for r in results) == sorted(frames)
+    # the frame of the cache is given at once, before the end of the solves
+    assert results[0]["path"] == frames[-1] and results[0]["cached"]
+    assert results[0]["arrival"] < 0.5 < results[1]["arrival"]
+    assert not any(r["cached"] for r in results[1:])
+
+
+def test_in_flight_limit(tmp_path, frames, fast_poll, monkeypatch):
+    active, peak = 0, 0
+    solve_frame = solve_batch.solve_frame
+
+    async def counted(*args, **kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            return await solve_frame(*args, **kwargs)
+        finally:
+            active -= 1
+
+    monkeypatch.setattr(solve_batch, "solve_frame", counted)
+    with MockNova(solve_delay=0.3) as nova:
+        results = _solve(frames, nova, SolveCache(str(tmp_path / "cache")), 2)
+    assert all("error" not in r for r in results)
+    assert peak == 2
+
+
+def test_backoff_on_pending(monkeypatch):
+    waits = []
+
+    async def sleep(wait):
+        waits.append(wait)
+
+    async def run(function, arg):
+        return function(arg)
+
+    # pending 8 times, then finished
+    answers = iter([[]] * 8 + [[42]])
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    result = asyncio.run(
+        solve_batch._poll(run, lambda _: next(answers), 1, bool, time.monotonic() + 60)
+    )
+    assert result == [42]
+    assert waits[0] == solve_batch.POLL_START
+    assert waits == sorted(waits)
+    assert waits[1] == solve_batch.POLL_START * solve_batch.POLL_FACTOR
+    assert max(waits) == solve_batch.POLL_MAX
+
+    # still pending after the deadline
+    with pytest.raises(TimeoutError):
+        asyncio.run(solve_batch._poll(run, lambda _: [], 1, bool, time.monotonic()))
+
+
+def test_pending_jobs_are_polled(tmp_path, frames, fast_poll):
+    with MockNova(solve_delay=0.6) as nova:
+        (result,) = _solve(frames[:1], nova, SolveCache(str(tmp_path / "cache")))
+        polls = [path for method, path in nova.requests if method == "GET"]
+    assert "error" not in result, result["error"]
+    # no job at the first polls, then a job "solving", then the downloads
+    submission = polls.count(f"/api/submissions/{result['submission_id']}")
+    job = polls.count(f"/api/jobs/{result['job_id']}/info")
+    assert submission >= 2 and job >= 2
+    # the waits grow : far less polls than with the first wait all along
+    assert submission + job < 0.6 / solve_batch.POLL_START
+
+
+def test_connections_reused(tmp_path, frames, fast_poll):
+    with MockNova(solve_delay=0.3) as nova:
+        results = _solve(frames, nova, SolveCache(str(tmp_path / "cache")), 2)
+        requests, connections = len(nova.requests), nova.connections
+    assert all("error" not in r for r in results)
+    # one login for all the frames, then the connections of the pool
+    assert sum(path == "/api/login" for _, path in nova.requests) == 1
+    assert connections <= 2 * 2
+    assert requests >= 5 * len(frames)
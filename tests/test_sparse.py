@@ -0,0 +1,33 @@
+import contextlib
+import io
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+import main_p2_origin as p2
+import sparse
+
+
+@pytest.mark.parametrize("dense_fraction", [np.inf, -1.0])
+@pytest.mark.parametrize("nb_stars", [30, 3000])
+def test_same_as_whole_image(monkeypatch, dense_fraction, nb_stars):
+    # the boxes (atlas and borders) or the whole image, chosen by the cost
+    monkeypatch.setattr(sparse, "DENSE_FRACTION", dense_fraction)
+    rng = np.random.default_rng(3)
+    image = rng.normal(0.1, 0.01, (301, 257)).astype(np.float32)
+    sources = Table()
+    # some stars on the borders of the image, or just out of it
+    sources["xcentroid"] = rng.uniform(-3, 260, nb_stars)
+    sources["ycentroid"] = rng.uniform(-3, 304, nb_stars)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        mask = p2.star_mask(image, sources, save=False)
+        mask_blur = p2.mask_effects(mask, (5, 5), (7, 7), save=False)
+        Ierode = p2.erode_image(image, (4, 4), 3)
+        expected = p2.combinate_mask_image(mask_blur, Ierode, image, save=False)
+        for given in (None, mask_blur):
+            final = sparse.reduce_stars_sparse(
+                image, sources, 4, 3, (5, 5), (7, 7), mask_blur=given
+            )
+            assert np.array_equal(final, expected)
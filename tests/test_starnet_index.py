@@ -0,0 +1,22 @@
+import cv2 as cv
+import numpy as np
+
+import starnet_index
+from detectors import synthetic_field
+from starnet_index import StarMaskIndex
+
+
+def test_components_memo_bounded(monkeypatch):
+    monkeypatch.setattr(starnet_index, "COMPONENTS_ENTRIES", 3)
+    stars, *_ = synthetic_field((200, 300), 80, 4.0)
+    index = StarMaskIndex(stars)
+    planes = index.plane.nbytes + index._edges.nbytes + index._above.nbytes
+    assert index.nbytes == planes + 3 * starnet_index._ENTRY_BYTES
+
+    thresholds = (0.1, 0.2, 0.3, 0.4, 0.2)
+    for thresh in thresholds:
+        mask = (index.plane > np.float32(thresh)).astype(np.uint8)
+        expected = cv.connectedComponents(mask, connectivity=8)[0] - 1
+        assert index.components(thresh) == expected
+    # the last 3 thresholds, 0.2 used again is the most recent
+    assert list(index._components) == [float(np.float32(t)) for t in (0.3, 0.4, 0.2)]
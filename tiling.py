@@ -0,0 +1,604 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+from astropy.stats import gaussian_fwhm_to_sigma, sigma_clipped_stats
+from astropy.table import Table, vstack
+
+import main_p2_origin as p2
+import main_p3_starnet as p3
+from background import SAMPLE_STRIDE, estimate_background, sample_stride
+from fits_loader import LazyFits
+from normalize import min_max
+
+# size in pixels of the side of a tile (without the halo)
+DEFAULT_TILE = 1024
+# one pixel out of STATS_STRIDE (in each direction) is used for the background statistics,
+# the same sample as the mode "sampled" of background.estimate_background on the whole image
+STATS_STRIDE = SAMPLE_STRIDE
+# below this number of pixels, the start of the processes (about 2 s) cost more
+# than the parallel detection save : one call on the whole image
+PARALLEL_MIN_PIXELS = 32_000_000
+
+
+def morph_reach(ksize, iterations=1):
+    """
+    Number of pixels around a pixel used by a dilation/erosion with a rectangular kernel
+
+    :param ksize: size of the kernel
+    :param iterations: number of iterations
+    """
+    return iterations * (ksize - 1)
+
+
+def gaussian_reach(ksize):
+    """
+    Number of pixels around a pixel used by a gaussian blur
+
+    :param ksize: size of the kernel (odd)
+    """
+    return ksize // 2
+
+
+def detection_reach(fwhm):
+    """
+    Number of pixels around a star used by DAOStarFinder
+
+    the kernel of DAOStarFinder has a radius of 1.5 sigma (minimum 2 pixels),
+    it's used for the convolution, the search of local maxima and the cutouts
+    of the centroid, so the reach is 3 radius
+
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    """
+    radius = int(max(2, 1.5 * fwhm * gaussian_fwhm_to_sigma))
+    return 3 * radius + 2
+
+
+def iter_tiles(shape, tile=DEFAULT_TILE, halo=0):
+    """
+    Cut an image in tiles with a halo around each tile
+
+    :param shape: shape of the image (height, width)
+    :param tile: size of the side of a tile
+    :param halo: number of pixels added around each tile (cut at image borders)
+    :return: generator of (core, padded), two tuples (y0, y1, x0, x1) :
+        core is the part of the image owned by the tile and padded the part read
+    """
+    h, w = shape[:2]
+    for y0 in range(0, h, tile):
+        for x0 in range(0, w, tile):
+            y1 = min(y0 + tile, h)
+            x1 = min(x0 + tile, w)
+            padded = (
+                max(0, y0 - halo),
+                min(h, y1 + halo),
+                max(0, x0 - halo),
+                min(w, x1 + halo),
+            )
+            yield (y0, y1, x0, x1), padded
+
+
+def crop_core(tile_image, core, padded):
+    """
+    Keep only the core of a tile calculated on the padded part
+
+    :param tile_image: image calculated on the padded part
+    :param core: (y0, y1, x0, x1) in the image
+    :param padded: (y0, y1, x0, x1) in the image
+    """
+    y0, y1, x0, x1 = core
+    py0, _, px0, _ = padded
+    return tile_image[y0 - py0 : y1 - py0, x0 - px0 : x1 - px0]
+
+
+class TiledFits(LazyFits):
+    """
+    Read a FITS image by tiles without loading all the data (see LazyFits.section)
+    """
+
+    def bounds(self, tile=DEFAULT_TILE):
+        """Return (min, max) of all the data, read tile by tile"""
+        data_min, data_max = None, None
+        for core, _ in iter_tiles(self.image_shape, tile):
+            data = self.section(*core)
+            tile_min, tile_max = min_max(data)
+            if data_min is None:
+                data_min, data_max = tile_min, tile_max
+            else:
+                data_min = min(data_min, tile_min)
+                data_max = max(data_max, tile_max)
+        return data_min, data_max
+
+
+def _gray_tile(reader, bounds, region):
+    """normalize a part of the image with the bounds of the whole image and convert it in grey"""
+    return p2.convert_in_grey(p2.normalize_img(reader.section(*region), bounds))
+
+
+def sampled_stats(reader, bounds, sigma=3.0, tile=DEFAULT_TILE, stride=STATS_STRIDE):
+    """
+    Estimate the background level and noise on one pixel out of stride in each direction
+
+    the same sample as background.sample_pixels on the whole grey image (all the
+    pixels for the small images), put in the same order : the values are the same
+    as estimate_background(image_gray, sigma, "sampled").
+
+    :param reader: TiledFits of the image
+    :param bounds: (min, max) of the image
+    :param sigma: std for delete outliers values
+    :param tile: size of the tiles
+    :param stride: step between two pixels of the sample
+    :return: (median, std)
+    """
+    h, w = reader.image_shape
+    stride = sample_stride((h, w), stride)
+    # the grid image[::stride, ::stride], filled tile by tile
+    sample = np.empty((-(-h // stride), -(-w // stride)), dtype=np.float32)
+    for core, _ in iter_tiles((h, w), tile):
+        y0, y1, x0, x1 = core
+        # first pixels of the grid in the tile
+        gy, gx = -(-y0 // stride), -(-x0 // stride)
+        part = _gray_tile(reader, bounds, core)
+        part = part[gy * stride - y0 :: stride, gx * stride - x0 :: stride]
+        sample[gy : gy + part.shape[0], gx : gx + part.shape[1]] = part
+    mean, median, std = sigma_clipped_stats(sample.ravel(), sigma=sigma)
+    return median, std
+
+
+def detect_stars_tiled(
+    reader,
+    bounds,
+    fwhm,
+    threshold,
+    median,
+    std,
+    tile=DEFAULT_TILE,
+    detector="daofind",
+    workers=1,
+):
+    """
+    Use DAOStarFinder (or another detector) tile by tile with the background of the whole image
+
+    each tile is read with a halo of detection_reach pixels, so the stars found
+    are the same as on the whole image. A star is kept only by the tile
+    which own its centroid, there is no duplicate at the borders of the tiles.
+    With the "components" detector, a group of pixels bigger than the halo
+    can be cut at the border of a tile.
+    With several workers, the tiles are read here and detected in a pool
+    of processes (see find_stars_parallel), the stars are the same.
+
+    :param reader: TiledFits of the image
+    :param bounds: (min, max) of the image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param median: background level of the whole image
+    :param std: background noise of the whole image
+    :param tile: size of the tiles
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :param workers: number of processes for the detection (None = number of CPU)
+    :return: table of stars positions (xcentroid, ycentroid) or None
+    """
+    halo = detection_reach(fwhm)
+    tiles = (
+        (_gray_tile(reader, bounds, padded), core, padded)
+        for core, padded in iter_tiles(reader.image_shape, tile, halo)
+    )
+    return _detect_tiles(
+        tiles, reader.image_shape, fwhm, threshold, median, std, detector, workers
+    )
+
+
+def _owned_sources(sources, core, padded, shape):
+    """
+    Keep the stars of a tile whose centroid is in the core of the tile
+
+    the positions are moved in the whole image. A centroid a little out of the
+    image (star on the border) is owned by the tile of the nearest pixel, so the
+    cores share out all the stars : each star of the halo is kept by one tile only.
+    """
+    if sources is None:
+        return None
+    sources["xcentroid"] += padded[2]
+    sources["ycentroid"] += padded[0]
+    y0, y1, x0, x1 = core
+    x = np.clip(sources["xcentroid"].astype(int), 0, shape[1] - 1)
+    y = np.clip(sources["ycentroid"].astype(int), 0, shape[0] - 1)
+    owned = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+    if not owned.any():
+        return None
+    return sources[owned]
+
+
+def _merge_sources(tables):
+    """join the stars of the tiles, sorted by position with new ids"""
+    tables = [table for table in tables if table is not None]
+    if not tables:
+        return None
+    sources = vstack(tables, metadata_conflicts="silent")
+    sources.sort(["ycentroid", "xcentroid"])
+    sources["id"] = np.arange(1, len(sources) + 1)
+    return sources
+
+
+def _find_stars_tile(
+    image_tile, core, padded, shape, fwhm, threshold, median, std, detector
+):
+    """detection on one tile in a process of the pool (see find_stars_parallel)"""
+    sources = p2.find_stars(image_tile, fwhm, threshold, median, std, detector)
+    return _owned_sources(sources, core, padded, shape)
+
+
+def _detect_tiles(tiles, shape, fwhm, threshold, median, std, detector, workers=1):
+    """
+    detection of the tiles (image_tile, core, padded) of an iterator, one after
+    the other or in a pool of processes : at most 2 tiles by process wait in the
+    queue, so the copies of the tiles don't double the memory
+    """
+    workers = workers or os.cpu_count()
+    if workers <= 1:
+        return _merge_sources(
+            [
+                _find_stars_tile(
+                    image_tile,
+                    core,
+                    padded,
+                    shape,
+                    fwhm,
+                    threshold,
+                    median,
+                    std,
+                    detector,
+                )
+                for image_tile, core, padded in tiles
+            ]
+        )
+
+    tables = []
+    pending = set()
+    # spawn : the processes don't copy the threads of the caller (GUI, writers)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        for image_tile, core, padded in tiles:
+            if len(pending) >= 2 * workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                tables.extend(future.result() for future in done)
+            pending.add(
+                executor.submit(
+                    _find_stars_tile,
+                    image_tile,
+                    core,
+                    padded,
+                    shape,
+                    fwhm,
+                    threshold,
+                    median,
+                    std,
+                    detector,
+                )
+            )
+        tables.extend(future.result() for future in pending)
+    return _merge_sources(tables)
+
+
+def find_stars_parallel(
+    image_gray,
+    fwhm,
+    threshold,
+    median,
+    std,
+    workers=None,
+    tile=DEFAULT_TILE,
+    detector="daofind",
+    min_pixels=PARALLEL_MIN_PIXELS,
+):
+    """
+    Use DAOStarFinder (or another detector) on tiles of an image in a pool of processes
+
+    like detect_stars_tiled, each tile is read with a halo of detection_reach pixels
+    and the stars are kept by the tile which own their centroid, with the background
+    level and noise of the whole image : the stars are the same as one call of
+    find_stars on the whole image (sorted by position instead of the order of
+    DAOStarFinder). At most 2 tiles by process wait in the queue, so the copies of
+    the tiles don't double the memory.
+    With one worker, or an image smaller than min_pixels (or than a tile),
+    find_stars is called on the whole image.
+
+    :param image_gray: the grey image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param median: background level of the whole image
+    :param std: background noise of the whole image
+    :param workers: number of processes (None = number of CPU)
+    :param tile: size of the tiles
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :param min_pixels: smallest image detected in parallel
+    :return: table of stars positions (xcentroid, ycentroid) or None
+    """
+    workers = workers or os.cpu_count()
+    shape = image_gray.shape[:2]
+    small = shape[0] * shape[1] < min_pixels or (shape[0] <= tile and shape[1] <= tile)
+    if workers <= 1 or small:
+        return p2.find_stars(image_gray, fwhm, threshold, median, std, detector)
+
+    halo = detection_reach(fwhm)
+    tiles = (
+        (np.ascontiguousarray(image_gray[py0:py1, px0:px1]), core, padded)
+        for core, (py0, py1, px0, px1) in iter_tiles(shape, tile, halo)
+    )
+    return _detect_tiles(tiles, shape, fwhm, threshold, median, std, detector, workers)
+
+
+def detect_stars_parallel(
+    image_gray,
+    fwhm,
+    threshold,
+    sigma=3.0,
+    workers=None,
+    tile=DEFAULT_TILE,
+    detector="daofind",
+    background="global",
+):
+    """
+    Same as detect_stars of phase 2 with the detection in a pool of processes
+
+    the background level and noise are calculated once on the whole image,
+    then the tiles are shared out (see find_stars_parallel). With a mesh background,
+    the map of the level is subtracted before the cut in tiles.
+
+    :param image_gray: the grey image
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param sigma: std for delete outliers values
+    :param workers: number of processes (None = number of CPU)
+    :param tile: size of the tiles
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :param background: "global", "sampled" or "mesh" (see background.estimate_background)
+    :return: table of stars positions or None
+    """
+    median, std = estimate_background(image_gray, sigma, background)
+    if np.ndim(median) > 0:
+        image_gray = image_gray - median
+        median = 0.0
+    return find_stars_parallel(
+        image_gray, fwhm, threshold, median, std, workers, tile, detector
+    )
+
+
+def _sources_in(sources, region):
+    """
+    Select the stars of a part of the image with positions relative to this part
+
+    the selection is done on int(position) like star_mask, so the pixels
+    of the mask are the same as on the whole image
+    """
+    y0, y1, x0, x1 = region
+    x = sources["xcentroid"].astype(int)
+    y = sources["ycentroid"].astype(int)
+    inside = (x >= x0) & (x < x1) & (y >= y0) & (y < y1)
+    part = Table()
+    part["xcentroid"] = np.asarray(sources["xcentroid"][inside]) - x0
+    part["ycentroid"] = np.asarray(sources["ycentroid"][inside]) - y0
+    return part
+
+
+def output_array(shape, out=None, out_path=None):
+    """
+    Return the array which receive the result of a tiled process
+
+    :param shape: shape of the result
+    :param out: array already allocated
+    :param out_path: if given, a .npy file mapped in memory (for results bigger than RAM)
+    """
+    if out is not None:
+        return out
+    if out_path is not None:
+        return np.lib.format.open_memmap(
+            out_path, mode="w+", dtype=np.float32, shape=shape
+        )
+    return np.empty(shape, dtype=np.float32)
+
+
+def process_standard_tiled(
+    path: str,
+    fwhm,
+    threshold,
+    erode_kernel,
+    nb_iter,
+    kernelDilate=(3, 3),
+    kernelGaussian=(3, 3),
+    stats=None,
+    tile=DEFAULT_TILE,
+    out=None,
+    out_path=None,
+    detector="daofind",
+    workers=1,
+):
+    """
+    Calculate the final image of the standard model (phase 2) tile by tile
+
+    the memory used depends on the size of the tiles and not on the size of the image :
+    - pass 1 : min and max of the data for the normalization
+    - pass 2 : background statistics (only if stats isn't given)
+    - pass 3 : detection of stars (see detect_stars_tiled)
+    - pass 4 : mask, erosion and combination on each tile with a halo
+      which cover the dilation, the gaussian blur and the erosion
+
+    Without stats, the background is the "sampled" level of estimate_background.
+    With the same stats as the whole image (background_stats on the grey image)
+    the final image is exactly the same as the monolithic process.
+
+    :param path: the FITS file's path
+    :param fwhm: Full Width at Half Maximum = size of star in pixel
+    :param threshold: the detection threshold
+    :param erode_kernel: size of the erosion kernel
+    :param nb_iter: number of erosion iterations
+    :param kernelDilate: kernel of the dilation of the mask
+    :param kernelGaussian: kernel of the gaussian blur of the mask
+    :param stats: (median, std) of the background, estimated on a sample if None
+    :param tile: size of the tiles
+    :param out: array which receive the final image
+    :param out_path: .npy file which receive the final image
+    :param detector: name of the detector (see DETECTORS in detectors.py)
+    :param workers: number of processes for the detection (see detect_stars_tiled)
+    :return: the final image (the grey image if no stars, like the monolithic process)
+        and the table of stars positions (None if no stars)
+    """
+    with TiledFits(path) as reader:
+        bounds = reader.bounds(tile)
+        if stats is None:
+            stats = sampled_stats(reader, bounds, tile=tile)
+        median, std = stats
+
+        sources = detect_stars_tiled(
+            reader, bounds, fwhm, threshold, median, std, tile, detector, workers
+        )
+        final = output_array(reader.image_shape, out, out_path)
+        if sources is None:
+            # no stars : the grey image is kept as it is
+            for core, _ in iter_tiles(reader.image_shape, tile):
+                y0, y1, x0, x1 = core
+                final[y0:y1, x0:x1] = _gray_tile(reader, bounds, core)
+            return final, None
+
+        halo = max(
+            morph_reach(max(kernelDilate)) + gaussian_reach(max(kernelGaussian)),
+            morph_reach(erode_kernel, nb_iter),
+        )
+        for core, padded in iter_tiles(reader.image_shape, tile, halo):
+            image_gray = _gray_tile(reader, bounds, padded)
+            mask = p2.star_mask(image_gray, _sources_in(sources, padded), save=False)
+            mask_blur = p2.mask_effects(mask, kernelDilate, kernelGaussian, save=False)
+            Ierode = p2.erode_image(image_gray, (erode_kernel, erode_kernel), nb_iter)
+            final_tile = p2.combinate_mask_image(
+                mask_blur, Ierode, image_gray, save=False
+            )
+            y0, y1, x0, x1 = core
+            final[y0:y1, x0:x1] = crop_core(final_tile, core, padded)
+    return final, sources
+
+
+def _gray_bounds(reader, bounds, tile):
+    """(min, max) of the normalized grey image, read tile by tile"""
+    gray_min, gray_max = None, None
+    for core, _ in iter_tiles(reader.image_shape, tile):
+        gray = p3.convert_in_grey(p3.normalize_img(reader.section(*core), bounds))
+        tile_min, tile_max = min_max(gray)
+        if gray_min is None:
+            gray_min, gray_max = tile_min, tile_max
+        else:
+            gray_min = min(gray_min, tile_min)
+            gray_max = max(gray_max, tile_max)
+    return gray_min, gray_max
+
+
+def process_starnet_tiled(
+    starless_path: str,
+    staronly_path: str,
+    thresh,
+    alpha,
+    kernelDilate=(3, 3),
+    kernelGaussian=(3, 3),
+    iterations=1,
+    tile=DEFAULT_TILE,
+    out=None,
+    out_path=None,
+):
+    """
+    Calculate the final image of the starnet model (phase 3) tile by tile
+
+    the normalizations use the min and max of the whole images (calculated before
+    tile by tile), and the halo cover the dilation and the gaussian blur of the mask,
+    so the final image is exactly the same as the monolithic process.
+
+    :param starless_path: the starless FITS file's path
+    :param staronly_path: the staronly FITS file's path
+    :param thresh: threshold to say "here is a star" in the staronly image
+    :param alpha: reduction factor (0 = no reduction, 1 = full removal)
+    :param kernelDilate: kernel of the dilation of the mask
+    :param kernelGaussian: kernel of the gaussian blur of the mask
+    :param iterations: number of iterations for dilation
+    :param tile: size of the tiles
+    :param out: array which receive the final image
+    :param out_path: .npy file which receive the final image
+    :return: the final image
+    """
+    with TiledFits(starless_path) as starless, TiledFits(staronly_path) as staronly:
+        starless_bounds = starless.bounds(tile)
+        staronly_bounds = staronly.bounds(tile)
+        staronly_gray_bounds = _gray_bounds(staronly, staronly_bounds, tile)
+
+        halo = morph_reach(max(kernelDilate), iterations) + gaussian_reach(
+            max(kernelGaussian)
+        )
+        final = output_array(staronly.image_shape, out, out_path)
+        for core, padded in iter_tiles(staronly.image_shape, tile, halo):
+            starless_gray = p3.convert_in_grey(
+                p3.normalize_img(starless.section(*padded), starless_bounds)
+            )
+            staronly_gray = p3.convert_in_grey(
+                p3.normalize_img(staronly.section(*padded), staronly_bounds)
+            )
+            mask = p3.mask_from_stars_starnet(
+                staronly_gray, thresh, save=False, bounds=staronly_gray_bounds
+            )
+            mask_blur = p3.mask_effects(
+                mask, kernelDilate, kernelGaussian, iterations, save=False
+            )
+            star_reduced = p3.reduce_stars(staronly_gray, mask_blur, alpha, save=False)
+            final_tile = p3.combinate_mask_image(
+                starless_gray, star_reduced, save=False
+            )
+            y0, y1, x0, x1 = core
+            final[y0:y1, x0:x1] = crop_core(final_tile, core, padded)
+    return final
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+    import sys
+    import time
+    import warnings
+
+    from photutils.utils.exceptions import NoDetectionsWarning
+
+    warnings.simplefilter("ignore", NoDetectionsWarning)
+    path = sys.argv[1] if len(sys.argv) > 1 else "./examples/HorseHead.fits"
+    fwhm = 4.0
+    threshold = 5.0
+    with contextlib.redirect_stdout(io.StringIO()):
+        data, header = p2.load_fits(path)
+        image_gray = p2.convert_in_grey(p2.handler_color_image(data, save=False))
+    mean, median, std = sigma_clipped_stats(image_gray, sigma=3.0)
+    print(f"{path} : {image_gray.shape[1]}x{image_gray.shape[0]}, {os.cpu_count()} CPU")
+
+    start = time.perf_counter()
+    reference = p2.find_stars(image_gray, fwhm, threshold, median, std)
+    single_time = time.perf_counter() - start
+    if reference is not None:
+        reference.sort(["ycentroid", "xcentroid"])
+    print(f"{'workers':>7} {'stars':>7} {'time (s)':>9} {'speedup':>8} same")
+    print(
+        f"{'single':>7} {0 if reference is None else len(reference):>7} {single_time:>9.3f}"
+    )
+    workers = 2
+    while workers <= max(2, os.cpu_count()):
+        start = time.perf_counter()
+        sources = find_stars_parallel(
+            image_gray, fwhm, threshold, median, std, workers, min_pixels=0
+        )
+        seconds = time.perf_counter() - start
+        if reference is None or sources is None:
+            same = reference is None and sources is None
+        else:
+            same = len(reference) == len(sources) and all(
+                np.allclose(reference[name], sources[name], equal_nan=True)
+                for name in reference.colnames
+                if name != "id"
+            )
+        print(
+            f"{workers:>7} {0 if sources is None else len(sources):>7} "
+            f"{seconds:>9.3f} {single_time / seconds:>7.1f}x {same}"
+        )
+        workers *= 2
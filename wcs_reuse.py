@@ -0,0 +1,236 @@
+import math
+import time
+
+import cv2 as cv
+import numpy as np
+from astropy.table import Table
+from astropy.wcs import WCS
+
+from cache import content_hash
+from rasterize import rasterize_stars
+
+# longest side of the images used for the correlation (the shift is measured at this scale)
+WORK_SIDE = 1024
+# under this peak of the phase correlation, the frame doesn't look like the reference
+# (other target, rotation) and must be solved
+MIN_RESPONSE = 0.05
+# names of the columns of world coordinates, in the corr files and in the catalogs
+RA_COLUMNS = ("index_ra", "ra", "RA", "RA_ICRS", "raj2000", "RAJ2000")
+DEC_COLUMNS = ("index_dec", "dec", "DEC", "DE_ICRS", "dej2000", "DEJ2000")
+
+
+def _column(table, names):
+    """first column of the table with one of the names (None if there is none)"""
+    for name in names:
+        if name in table.colnames:
+            return np.asarray(table[name], dtype=np.float64)
+    return None
+
+
+def _work_image(image_gray, factor):
+    """reduce the image by factor and keep only what is above the background (the stars)"""
+    h, w = image_gray.shape[:2]
+    small = np.asarray(image_gray, dtype=np.float32)
+    if factor > 1:
+        small = cv.resize(
+            small,
+            (max(1, w // factor), max(1, h // factor)),
+            interpolation=cv.INTER_AREA,
+        )
+    return np.clip(small - np.median(small), 0, None)
+
+
+def _correlate(template, frame):
+    """shift of frame compared to template and peak of the phase correlation"""
+    window = cv.createHanningWindow(frame.shape[::-1], cv.CV_32F)
+    return cv.phaseCorrelate(template, frame, window)
+
+
+class WcsReference:
+    """
+    Plate solution of a reference frame, reused for the next frames of the same target
+
+    the stars of the reference (world coordinates of the corr file or of a catalog)
+    are projected with the WCS of the solve, then the shift of each new frame
+    (drift of the mount, dithering) is measured with a phase correlation between
+    the frame and an image of the projected stars. No upload and no detection :
+    the positions of the stars of a frame cost two FFT of a reduced image.
+    Only a translation is measured, a frame rotated or of another target has
+    a weak correlation and project return None.
+    """
+
+    def __init__(self, wcs_header, sources):
+        """
+        Project the stars of the reference
+
+        :param wcs_header: WCS header of the solve of the reference frame
+        :param sources: table of the stars with world coordinates (index_ra/index_dec
+            of a corr file, ra/dec of a catalog) or only xcentroid/ycentroid
+            (1-indexed, like the positions of a corr file)
+        """
+        self.wcs = WCS(wcs_header)
+        ra = _column(sources, RA_COLUMNS)
+        dec = _column(sources, DEC_COLUMNS)
+        if ra is not None and dec is not None:
+            # the positions are kept like in the corr file (FITS, origin 1),
+            # the images of the stars are drawn at x - 1, y - 1 (numpy, origin 0)
+            self.x, self.y = self.wcs.all_world2pix(ra, dec, 1)
+        else:
+            self.x = np.asarray(sources["xcentroid"], dtype=np.float64)
+            self.y = np.asarray(sources["ycentroid"], dtype=np.float64)
+        self._templates = {}
+
+    @classmethod
+    def from_solution(cls, solution):
+        """
+        Reference from a solution of Astrometry.net (see SolveCache.get)
+
+        :param solution: dict with corr and wcs
+        """
+        from astrometry_cache import read_corr_sources
+
+        return cls(solution["wcs"], read_corr_sources(solution["corr"]))
+
+    @classmethod
+    def from_cache(cls, cache, image_gray):
+        """
+        Reference from the cache of the solutions, for an image already solved
+
+        :param cache: SolveCache of the solutions
+        :param image_gray: the grey image of the reference frame
+        :return: the reference or None if the image was not solved
+        """
+        solution = cache.get(content_hash(image_gray))
+        return None if solution is None else cls.from_solution(solution)
+
+    @classmethod
+    def from_catalog(cls, wcs_header, path, **kwargs):
+        """
+        Reference from a local catalog file (FITS, CSV, VOTable... with ra/dec columns)
+
+        :param wcs_header: WCS header of the solve of the reference frame
+        :param path: the catalog's path
+        :param kwargs: options of Table.read (format...)
+        """
+        return cls(wcs_header, Table.read(path, **kwargs))
+
+    def _template(self, shape, factor):
+        """
+        image of the projected stars at the scale of the correlation (kept by shape)
+
+        the center of the pixel i of the image is at (i + 0.5) / factor - 0.5 in the
+        reduced image (cv.INTER_AREA), the stars are drawn with sub-pixel positions
+        """
+        key = (shape, factor)
+        if key not in self._templates:
+            h, w = shape[0] // factor, shape[1] // factor
+            points = rasterize_stars(
+                (h, w),
+                (self.x - 0.5) / factor - 0.5,
+                (self.y - 0.5) / factor - 0.5,
+                antialias=True,
+            )
+            self._templates[key] = cv.GaussianBlur(points, (5, 5), 1.0)
+        return self._templates[key]
+
+    def offset(self, image_gray):
+        """
+        Measure the shift of a frame compared to the reference
+
+        :param image_gray: the grey image of the frame
+        :return: (dx, dy, response) : shift in pixels of the frame and peak of the
+            phase correlation (near 0 : no match)
+        """
+        h, w = image_gray.shape[:2]
+        factor = max(1, math.ceil(max(h, w) / WORK_SIDE))
+        frame = _work_image(image_gray, factor)
+        template = self._template((h, w), factor)
+        (dx, dy), response = _correlate(template, frame)
+        dx, dy = dx * factor, dy * factor
+        if factor > 1 and response >= MIN_RESPONSE:
+            # the reduced images give the shift at factor pixels near,
+            # a crop at full resolution in the center give the rest
+            y0, x0 = max(0, (h - WORK_SIDE) // 2), max(0, (w - WORK_SIDE) // 2)
+            crop = image_gray[y0 : y0 + WORK_SIDE, x0 : x0 + WORK_SIDE]
+            points = rasterize_stars(
+                crop.shape, self.x - 1 + dx - x0, self.y - 1 + dy - y0, antialias=True
+            )
+            template = cv.GaussianBlur(points, (5, 5), 1.0)
+            (rx, ry), _ = _correlate(template, _work_image(crop, 1))
+            dx, dy = dx + rx, dy + ry
+        return dx, dy, response
+
+    def project(self, image_gray, min_response=MIN_RESPONSE):
+        """
+        Return the stars of a frame of the same target, without upload and detection
+
+        :param image_gray: the grey image of the frame
+        :param min_response: weakest correlation accepted
+        :return: table of stars positions (xcentroid, ycentroid, 1-indexed like a corr file)
+            in the frame, or None if the frame doesn't match the reference (it must be solved)
+        """
+        dx, dy, response = self.offset(image_gray)
+        if response < min_response:
+            return None
+        h, w = image_gray.shape[:2]
+        x = self.x + dx
+        y = self.y + dy
+        inside = (x >= 0.5) & (x < w + 0.5) & (y >= 0.5) & (y < h + 0.5)
+        sources = Table()
+        sources["id"] = np.arange(1, np.count_nonzero(inside) + 1)
+        sources["xcentroid"] = x[inside]
+        sources["ycentroid"] = y[inside]
+        return sources
+
+
+if __name__ == "__main__":
+    import contextlib
+    import io
+
+    from detectors import match_stars, synthetic_field
+    from mock_nova import wcs_header
+
+    import main_p3_API as api
+
+    # a sequence of frames of the same field, shifted by the drift of the mount
+    shape = (2048, 2048)
+    reference_image, x, y, amplitude = synthetic_field(shape, 3000, 4.0)
+    header = wcs_header(shape[1], shape[0])
+    ra, dec = WCS(header).all_pix2world(x + 1, y + 1, 1)
+    catalog = Table({"ra": ra, "dec": dec})
+    reference = WcsReference(header, catalog)
+
+    rng = np.random.default_rng(1)
+    print(f"frames {shape[1]}x{shape[0]}, 3000 stars, reference solved once")
+    print(
+        f"{'shift':>14} {'measured':>16} {'project (s)':>12} {'detect (s)':>11} "
+        f"{'recall':>7} {'error (px)':>10}"
+    )
+    for i in range(5):
+        dx, dy = rng.uniform(-40, 40, 2)
+        move = np.float32([[1, 0, dx], [0, 1, dy]])
+        frame = cv.warpAffine(reference_image, move, shape[::-1], borderValue=0.1)
+        frame += rng.normal(0, 0.005, shape).astype(np.float32)
+
+        start = time.perf_counter()
+        sources = reference.project(frame)
+        project_time = time.perf_counter() - start
+        mdx, mdy, response = reference.offset(frame)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            api.detect_stars(frame, 4.0, 5.0)
+        detect_time = time.perf_counter() - start
+
+        recall, precision, error = match_stars(
+            x + 1 + dx, y + 1 + dy, sources["xcentroid"], sources["ycentroid"]
+        )
+        print(
+            f"{dx:>6.1f},{dy:>6.1f} px {mdx:>7.1f},{mdy:>7.1f} px "
+            f"{project_time:>12.3f} {detect_time:>11.3f} {recall:>7.1%} {error:>10.3f}"
+        )
+
+    other, *_ = synthetic_field(shape, 3000, 4.0, seed=99)
+    print(
+        f"\nother field : {reference.project(other)} (response {reference.offset(other)[2]:.3f})"
+    )